@@ -1,14 +1,29 @@
+import atexit
+import collections
+import concurrent.futures
 import couchdb
+import heapq
+import http.client
 import json
 import logging
+import numpy
 import os
 import pydicom
+import queue
 import requests
+import ssl
+import struct
 import tempfile
+import threading
+import time
 import urllib.request, urllib.parse, urllib.error
 import unittest
+import zipfile
 
 from __main__ import vtk, qt, ctk, slicer
+from SlicerChronicleLib.CouchStreams import ChangesLineFramer, ViewRowParser
+from SlicerChronicleLib.OffscreenRenderer import OffscreenRenderer
+from SlicerChronicleLib.StreamingZip import StreamingZipError, ZipIngestPipeline
 from DICOMLib import DICOMUtils
 #from DICOMLib import DICOMDetailsPopup
 import EditorLib
@@ -124,7 +139,7 @@ class SlicerChronicleWidget:
     self.logic = SlicerChronicleLogic(default_couchDB_URL)
 
   def cleanup(self):
-    self.logic.stopStepWatcher()
+    self.logic.cleanup()
 
   def toggleStepWatch(self,checked):
     if checked:
@@ -157,7 +172,7 @@ class SlicerChronicleWidget:
 class SlicerChronicleLogic:
   """
   """
-  def __init__(self,couchDB_URL,chronicleDatabaseName='chronicle', operationDatabaseName='segmentation-server'):
+  def __init__(self,couchDB_URL,chronicleDatabaseName='chronicle', operationDatabaseName='segmentation-server', downloadWorkers=8, instanceCache=None):
 
     self.chronicleDatabaseName=chronicleDatabaseName
     self.operationDatabaseName=operationDatabaseName
@@ -175,67 +190,170 @@ class SlicerChronicleLogic:
             "LesionSegmenter" : self.chronicleLesionSegmenter,
     }
     self.activeRequestID = None
+    self.activeLease = None
+    self.leaseSweepTimer = None
+    self.nodeRemovedObserver = None
 
+    # only open steps are of interest to the step watcher
+    self.openStepSelector = {'type': 'ch.step', 'status': 'open'}
 
-    # path to Chronicle utility source code
-    import os
-    self.recordPath = os.path.join(os.environ['HOME'], 'chronicle/Chronicle/bin/record.py')
+    # queue of steps seen on the changes feed, run from the event loop
+    self.stepScheduler = StepScheduler(self.openStep, self.performStep)
+
+    # parallel fetcher for instance downloads
+    self.downloader = InstanceDownloader(maxWorkers=downloadWorkers)
+
+    # workers of a pool share slicer's temporary directory, so each one
+    # keeps its checkpoint, caches, databases and renders in its own
+    workerID = os.environ.get('CHRONICLE_WORKER')
+    self.temporaryPath = slicer.app.temporaryPath
+    if workerID:
+      self.temporaryPath = os.path.join(self.temporaryPath, 'SlicerChronicle-%s' % workerID)
+      os.makedirs(self.temporaryPath, exist_ok=True)
+
+    # instance files kept on disk between requests
+    self.instanceCache = instanceCache or InstanceCache.shared(
+                            os.path.join(self.temporaryPath, 'SlicerChronicleInstanceCache'))
+
+    # per series geometry for mapping seeds to RAS
+    self.geometryIndex = SeriesGeometryIndex()
+
+    # lightbox secondary captures without the slice views
+    self.offscreenRenderer = OffscreenRenderer()
+
+    # secondary captures are encoded here and recorded directly
+    self.secondaryCaptureBuilder = SecondaryCaptureBuilder()
 
     # connect to the database and register the changes API callback
     self.couch = couchdb.Server(couchDB_URL)
     try:
       self.operationDB = self.couch[self.operationDatabaseName]
+      self.progressReporter = ProgressReporter(self.operationDB)
+      self.stepClaimer = StepClaimer(self.operationDB, workerID=workerID)
     except Exception as e:
       import traceback
       traceback.print_exc()
 
     try:
       self.chronicleDB = self.couch[self.chronicleDatabaseName]
+      self.chronicleRecorder = ChronicleRecorder(self.chronicleDB, self.downloader.session)
+      self.tagIndex = InstanceTagIndex(self.chronicleDB, self.downloader.session)
+      self.geometryIndex.tagIndex = self.tagIndex
     except Exception as e:
       import traceback
       traceback.print_exc()
 
   def startStepWatcher(self):
     self.stopStepWatcher()
-    self.changes = CouchChanges(self.operationDB, self.stepWatcherChangesCallback)
+    # resume where the last session stopped reading
+    checkpointPath = os.path.join(self.temporaryPath,
+                        'SlicerChronicle-%s-checkpoint.json' % self.operationDatabaseName)
+    self.changes = CouchChanges(self.operationDB, self.stepWatcherChangesCallback,
+                        selector=self.openStepSelector, includeDocs=True,
+                        predicate=self.isOpenStepChange,
+                        checkpoint=FileCheckpoint(checkpointPath),
+                        pending=self.stepScheduler.pending)
+    # steps abandoned by other workers never show up on the feed
+    self.leaseSweepTimer = qt.QTimer()
+    self.leaseSweepTimer.setInterval(int(self.stepClaimer.leaseDuration * 1000 / 2))
+    self.leaseSweepTimer.connect('timeout()', self.submitExpiredSteps)
+    self.leaseSweepTimer.start()
+    self.submitExpiredSteps()
+
+  def cleanup(self):
+    """Stop the step watcher, the progress reporter's thread and the
+    scene observer"""
+    self.stopStepWatcher()
+    if hasattr(self, 'progressReporter'):
+      self.progressReporter.stop()
+    if self.nodeRemovedObserver is not None:
+      slicer.mrmlScene.RemoveObserver(self.nodeRemovedObserver)
+      self.nodeRemovedObserver = None
 
   def stopStepWatcher(self):
     if self.changes:
       self.changes.stop()
       self.changes = None
+    if self.leaseSweepTimer:
+      self.leaseSweepTimer.stop()
+      self.leaseSweepTimer = None
+    self.stepScheduler.clear()
+
+  def submitExpiredSteps(self):
+    """Queue steps whose worker stopped renewing its lease"""
+    selector = dict(self.openStepSelector)
+    del selector['status']
+    try:
+      for doc in self.stepClaimer.expiredSteps(selector):
+        self.stepScheduler.submit(doc['_id'], doc, again=True)
+    except Exception as e:
+      print('Could not look for expired steps: %s' % e)
 
   def stepWatcherChangesCallback(self, operationDB, line):
+    """Queue the document named by a line of the changes feed.
+    Only parsing happens here so the feed keeps being read while
+    steps run; the step scheduler does the rest."""
     try:
-      print('decoding', line)
       line = line.decode()
       if line != "":
         change = json.loads(line)
-        doc = operationDB[change['id']]
-        if 'type' in list(doc.keys()) and doc['type'] == 'ch.step':
-          print(doc)
-          print('got doc, checking status')
-          if 'status' in list(doc.keys()) and doc['status'] == 'open':
-            print('got open step')
-            if self.canPerformStep(doc):
-              operation = doc['desiredProvenance']['operation']
-              print("yes, we can do this!!!")
-              print("let's %s!" % operation)
-              self.activeRequestID = change['id']
-              self.operations[operation](doc)
-              self.activeRequestID = None
+        if 'id' in change:
+          self.stepScheduler.submit(change['id'], change.get('doc'))
     except Exception as e:
       import traceback
       traceback.print_exc()
 
-  def postStatus(self,status, progressString):
+  def isOpenStepChange(self, change):
+    """Client side equivalent of openStepSelector.  Changes without
+    an inline document (e.g. the last_seq line) are let through."""
+    if 'doc' not in change:
+      return True
+    doc = change['doc']
+    return all([doc.get(key) == value for key, value in self.openStepSelector.items()])
+
+  def openStep(self, docID, doc=None):
+    """Return the step document if it is an open step (or one whose
+    lease expired) that we can perform, otherwise None"""
+    if doc is None:
+      doc = self.operationDB[docID]
+    if 'type' in list(doc.keys()) and doc['type'] == 'ch.step':
+      if self.stepClaimer.claimable(doc):
+        if self.canPerformStep(doc):
+          return doc
+    return None
+
+  def performStep(self, doc):
+    """Claim an open step document and run the operation it requests.
+    The step is left 'closed', or 'failed' if the operation raised."""
+    lease = self.stepClaimer.claim(doc)
+    if not lease:
+      logging.debug("step %s was claimed by another worker" % doc['_id'])
+      return
+    operation = doc['desiredProvenance']['operation']
+    print("let's %s!" % operation)
+    self.activeRequestID = doc['_id']
+    self.activeLease = lease
+    status = 'failed'
+    try:
+      self.operations[operation](lease.doc)
+      status = 'closed'
+    finally:
+      self.progressReporter.flush()
+      try:
+        lease.release(status)
+      except Exception as e:
+        print('Could not release step %s: %s' % (doc['_id'], e))
+      self.activeRequestID = None
+      self.activeLease = None
+
+  def postStatus(self,status, progressString, immediate=False):
+      """Report status of the active request.  Progress messages are
+      batched by the progress reporter; 'result' statuses, or any status
+      posted with immediate=True, are saved right away and the (id, rev)
+      of the saved document is returned."""
       print((self.activeRequestID, status, progressString))
       try:
-        id_, rev = self.operationDB.save({
-          'requestID' : self.activeRequestID,
-          'type' : status,
-          'progress' : progressString,
-        })
-        return (id_,rev)
+        return self.progressReporter.post(self.activeRequestID, status, progressString, immediate)
       except:
         print('...failed to save progress!!!')
 
@@ -251,54 +369,104 @@ class SlicerChronicleLogic:
     operationMatch = prov['operation'] in list(self.operations.keys())
     print('trying operation: ', operationMatch)
     print (applicationMatch, versionMatch, operationMatch)
-    return (applicationMatch and versionMatch and operationMatch)
+    # leave requests for other users to their workers
+    userMatch = True
+    if 'CHRONICLE_USER' in os.environ:
+      for inputData in prov.get('inputData', []):
+        if inputData.get('user', os.environ['CHRONICLE_USER']) != os.environ['CHRONICLE_USER']:
+          print("Skipping request for other user")
+          userMatch = False
+    return (applicationMatch and versionMatch and operationMatch and userMatch)
 
   def fetchAndLoadSeriesArchetype(self,seriesUID):
-    tmpdir = tempfile.mkdtemp()
+    # the volume's storage node reads the cached files, so keep them
+    # from being evicted until the node is removed from the scene
+    self.instanceCache.pin(seriesUID)
+    node = None
+    try:
+      filesToLoad = self.fetchSeriesArchetypeFiles(seriesUID)
+      if filesToLoad != []:
+        status, node = slicer.util.loadVolume(filesToLoad[0], {}, returnNode=True)
+    finally:
+      if node:
+        node.SetAttribute('SlicerChronicle.cacheGroup', seriesUID)
+        self.observeNodeRemoval()
+      else:
+        self.instanceCache.unpin(seriesUID)
+    return node
 
-    api = "/_design/instances/_view/seriesInstances?reduce=false"
-    args = '&key="%s"' % seriesUID
-    seriesInstancesURL = self.chronicleDB.resource().url + api + args
-    urlFile = urllib.request.urlopen(seriesInstancesURL)
-    instancesJSON = urlFile.read()
-    instances = json.loads(instancesJSON)
-    logging.info("Got the following response for seriesUID " + seriesUID + str(instances))
-    filesToLoad = []
-    if len(instances['rows']) == 0:
-      logging.warn("No instances associated with seriesUID %s" % seriesUID)
-    for instance in instances['rows']:
+  def observeNodeRemoval(self):
+    if self.nodeRemovedObserver is None:
+      self.nodeRemovedObserver = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, node):
+    """Unpin the cached files of a removed archetype volume"""
+    group = node.GetAttribute('SlicerChronicle.cacheGroup')
+    if group:
+      self.instanceCache.unpin(group)
+
+  def instanceRevisions(self, instanceUIDs):
+    """Return {instanceUID: _rev} of the instance documents, from one
+    _all_docs request"""
+    revisions = {}
+    if instanceUIDs:
+      for row in self.viewRows('/_all_docs', keys=list(instanceUIDs)):
+        if 'value' in row:
+          revisions[row['key']] = row['value']['rev']
+    return revisions
+
+  def viewRows(self,api,params=None,keys=None):
+    """Yield the rows of a chronicle view as they arrive"""
+    url = self.chronicleDB.resource().url + api
+    return ViewRowParser().rows(self.downloader.session, url, params, keys, timeout=self.downloader.timeout)
+
+  def fetchSeriesArchetypeFiles(self,seriesUID):
+    """Download the image instances of the series into the instance
+    cache and return their paths.  Safe to call from worker threads."""
+    api = "/_design/instances/_view/seriesInstances"
+    instances = self.viewRows(api, {'reduce': 'false', 'key': json.dumps(seriesUID)})
+    instanceUIDs = []
+    instanceCount = 0
+    for instance in instances:
+      instanceCount += 1
       classUID,instanceUID = instance['value']
       if classUID in self.imageClasses:
-        doc = self.chronicleDB[instanceUID]
-        print(("need to download ", doc['_id']))
-        instanceURL = self.chronicleDB.resource().url + '/' + doc['_id'] + "/object.dcm"
-        instanceFileName = doc['_id']
-        instanceFilePath = os.path.join(tmpdir, instanceFileName)
-        urllib.request.urlretrieve(instanceURL, instanceFilePath)
-        filesToLoad.append(instanceFilePath);
+        instanceUIDs.append(instanceUID)
       else:
         print(('this instance is not a class we can load: %s' % classUID))
-    node = None
-    if filesToLoad != []:
-      status, node = slicer.util.loadVolume(filesToLoad[0], {}, returnNode=True)
-    return node
+    # unchanged documents are answered from the cache without a request
+    revisions = self.instanceRevisions(instanceUIDs)
+    filesToLoad = []
+    for instanceUID in instanceUIDs:
+      print(("fetching ", instanceUID))
+      instanceURL = self.chronicleDB.resource().url + '/' + instanceUID + "/object.dcm"
+      # grouped by series so the archetype's directory holds just this series
+      instanceFilePath = self.instanceCache.fetch(instanceURL, instanceUID,
+                                  revision=revisions.get(instanceUID), group=seriesUID)
+      filesToLoad.append(instanceFilePath);
+    if instanceCount == 0:
+      logging.warn("No instances associated with seriesUID %s" % seriesUID)
+    self.instanceCache.save()
+    return filesToLoad
 
   def fetchAndIndexInstanceURLs(self,instanceURLs):
-    tmpdir = tempfile.mkdtemp()
-    instanceFilePath = os.path.join(tmpdir, 'instance.dcm')
-    for instanceURL in instanceURLs:
-      urllib.request.urlretrieve(instanceURL, instanceFilePath)
+    # urls are of the form <db>/<instanceUID>/object.dcm
+    instanceUIDs = [urllib.parse.unquote(instanceURL.split('/')[-2]) for instanceURL in instanceURLs]
+    revisions = self.instanceRevisions(instanceUIDs)
+    for instanceURL, instanceUID in zip(instanceURLs, instanceUIDs):
+      instanceFilePath = self.instanceCache.fetch(instanceURL, instanceUID, revision=revisions.get(instanceUID))
       self.postStatus('progress', "Inserting %s" % instanceURL)
       slicer.dicomDatabase.insert(instanceFilePath)
+    self.instanceCache.save()
 
   def operatingDICOMDatabase(self,operation):
     """Specify a database to use for the tagged operation (directory name)
     Only open a new one if it differs from the currently selected database
     """
-    tempDatabaseDir = slicer.app.temporaryPath + '/' + operation
+    tempDatabaseDir = os.path.join(self.temporaryPath, operation)
     if tempDatabaseDir != os.path.split(slicer.dicomDatabase.databaseFilename)[0]:
-      # originalDatabaseDirectory = DICOMUtils.openTemporaryDatabase(tempDatabaseDir, absolutePath=True)
-      originalDatabaseDirectory = DICOMUtils.openTemporaryDatabase(tempDatabaseDir)
+      originalDatabaseDirectory = DICOMUtils.openTemporaryDatabase(tempDatabaseDir, absolutePath=True)
       return originalDatabaseDirectory
     else:
       return tempDatabaseDir
@@ -311,22 +479,32 @@ class SlicerChronicleLogic:
     return seriesVolumeNode
 
   def fetchAndLoadInstanceURLs(self,instanceUIDURLPairs, seriesUID):
-    tmpdir = tempfile.mkdtemp()
-
-    filesToLoad = []
+    downloads = []
+    present = 0
     for instanceUID,instanceURL in instanceUIDURLPairs:
       filePath = slicer.dicomDatabase.fileForInstance(instanceUID)
       if filePath != '' and os.access(filePath, os.F_OK):
-        self.postStatus('progress', "Already in database: %s as %s" % (instanceUID, filePath))
+        present += 1
       else:
-        instanceFileName = "object-%d.dcm" % len(filesToLoad)
-        instanceFilePath = os.path.join(tmpdir, instanceFileName)
-        filesToLoad.append(instanceFilePath)
-        self.postStatus('progress', "Downloading %s to %s" % (instanceURL, instanceFilePath))
-        urllib.request.urlretrieve(instanceURL, instanceFilePath)
-        self.postStatus('progress', "Inserting %s" % instanceUID)
+        downloads.append(instanceURL)
+
+    # downloads run in the worker pool, inserts stay on this (main) thread;
+    # insert copies the files into the database, so the downloads go
+    # once they are all in
+    errors = []
+    if not os.path.exists(self.temporaryPath):
+      os.makedirs(self.temporaryPath)
+    with tempfile.TemporaryDirectory(dir=self.temporaryPath) as tmpdir:
+      downloads = [(instanceURL, os.path.join(tmpdir, "object-%d.dcm" % index)) for index, instanceURL in enumerate(downloads)]
+      for instanceURL, instanceFilePath, error in self.downloader.fetchAll(downloads):
+        if error:
+          errors.append((instanceURL, error))
+          continue
         slicer.dicomDatabase.insert(instanceFilePath)
-      self.postStatus('progress', "Downloaded %d of %d" % (len(filesToLoad), len(instanceUIDURLPairs)))
+    status = "Inserted %d of %d instances, %d already in database" % (len(downloads) - len(errors), len(downloads), present)
+    if errors:
+      status += "; could not download %d, first %s: %s" % (len(errors), errors[0][0], errors[0][1])
+    self.postStatus('progress', status)
 
     #detailsPopup = DICOMDetailsPopup()
     #detailsPopup.offerLoadables(seriesUID, 'Series')
@@ -380,32 +558,22 @@ class SlicerChronicleLogic:
         importDicom(outputDirectory)
 
   def studyUIDforInstanceUID(self,instanceUID):
-    """Pulls down the instance and gets the studyUID from it"""
-    doc = self.chronicleDB.get(instanceUID)
-    try:
-      return doc['dataset']['0020000D']['Value']
-    except KeyError:
-      return None
+    """Looks up the studyUID of the instance in the tag index"""
+    return self.tagIndex.value(instanceUID, '0020000D')
 
   def studyInstanceURLs(self,studyUID):
     """Return the urls of all instances that have this studyUID"""
     instanceURLs = []
-    # construct the url to fetch the seriesList for this study
-    api = "/_design/tags/_view/byTagAndValue?reduce=false"
+    # the instances tagged with this studyUID
+    api = "/_design/tags/_view/byTagAndValue"
     studyUIDTag = "0020000D"
     key = [studyUIDTag, studyUID]
-    args = '&startkey=%s' % json.dumps(key)
+    params = {'reduce': 'false', 'startkey': json.dumps(key)}
     key.append({})
-    args += '&endkey=%s' % json.dumps(key)
-    instanceListURL = self.chronicleDB.resource().url + api + args
-
-    # get the instance list and iterate
-    # - each row is an instanceUID
-    urlFile = urllib.request.urlopen(instanceListURL)
-    instanceListJSON = urlFile.read()
-    instanceList = json.loads(instanceListJSON)
-    rows = instanceList['rows']
-    for row in rows:
+    params['endkey'] = json.dumps(key)
+
+    # each row is an instanceUID
+    for row in self.viewRows(api, params):
       instanceURL = self.chronicleDB.resource().url + "/" + row['id'] + "/object.dcm"
       instanceURLs.append(instanceURL)
     return instanceURLs
@@ -414,42 +582,52 @@ class SlicerChronicleLogic:
     """Download the study data from chronicle and make
     a set of secondary captures"""
 
-    # construct the url to fetch the seriesList for this study
-    api = "/_design/instances/_view/context?reduce=true"
-    args = '&group_level=3'
-    args += '&startkey=%s' % json.dumps(studyKey)
+    # the series of this study
+    api = "/_design/instances/_view/context"
+    params = {'reduce': 'true', 'group_level': '3', 'startkey': json.dumps(studyKey)}
     studyKey.append({})
-    args += '&endkey=%s' % json.dumps(studyKey)
-    seriesListURL = self.chronicleDB.resource().url + api + args
+    params['endkey'] = json.dumps(studyKey)
     studyDescription = studyKey[1][0]
 
-    # get the series list and iterate
-    # - each row is a series and the key contains the UID and descriptions
-    urlFile = urllib.request.urlopen(seriesListURL)
-    seriesListJSON = urlFile.read()
-    seriesList = json.loads(seriesListJSON)
-    rows = seriesList['rows']
-    orientations = ('Axial', 'Sagittal', 'Coronal')
-    studyVolumeNodes = []
-    for row in [rows[0],]:
+    # each row is a series and the key contains the UID and descriptions
+    series = []
+    for row in self.viewRows(api, params):
       instanceCount = row['value']
       seriesUID = row['key'][2][2]
       seriesDescription = row['key'][2][1]
       print((seriesUID + ' should have ' + str(instanceCount) + ' instances' ))
-      seriesVolumeNode = self.fetchAndLoadSeriesArchetype(seriesUID)
-      if seriesVolumeNode:
-          studyVolumeNodes.append(seriesVolumeNode)
-          for orientation in orientations:
-            self.seriesRender(seriesVolumeNode,seriesDescription,orientation=orientation)
-    if studyVolumeNodes != []:
-      for orientation in orientations:
-        self.studyRender(studyVolumeNodes,studyDescription,orientation=orientation)
-
-  def indexDICOMDirectory(self,path):
-    for root, subFolders, files in os.walk(path):
-      for file_ in files:
-        filePath = os.path.join(root,file_)
-        slicer.dicomDatabase.insert(filePath)
+      series.append((seriesUID, seriesDescription))
+
+    def load(seriesUID, files):
+      status, node = slicer.util.loadVolume(files[0], {}, returnNode=True)
+      if not node:
+        return None
+      # the renders only need the voxels, so keep a copy of them and
+      # don't leave every study's volumes in the scene of a long running worker
+      array, ijkToRAS, window, level = self.offscreenRenderer.volumeArray(node)
+      array = array.copy()
+      slicer.mrmlScene.RemoveNode(node)
+      return array, ijkToRAS, window, level
+    def renderSeries(volume, orientation):
+      array, ijkToRAS, window, level = volume
+      return self.offscreenRenderer.encodeJPEG(self.offscreenRenderer.lightbox(array, ijkToRAS, orientation, window, level))
+    def renderStudy(volumes, orientation):
+      return self.offscreenRenderer.encodeJPEG(self.offscreenRenderer.centerSlices(volumes, orientation))
+    pipeline = StudyRenderPipeline(self.fetchSeriesArchetypeFiles, load, renderSeries, renderStudy,
+                                   self.recordSecondaryCapture, fetchWorkers=self.downloader.maxWorkers)
+    # series are fetched ahead of loading and their files are read again
+    # as upload references, so keep later fetches from evicting them
+    for seriesUID, seriesDescription in series:
+      self.instanceCache.pin(seriesUID)
+    try:
+      statistics = pipeline.run(series)
+    finally:
+      for seriesUID, seriesDescription in series:
+        self.instanceCache.unpin(seriesUID)
+    for stage, uid, error in pipeline.errors:
+      self.postStatus('progress', "Could not %s %s: %s" % (stage, uid or studyDescription, error))
+    self.postStatus('progress', "Rendered %d series of %s in %.1fs" %
+                        (statistics.get('series', 0), studyDescription, statistics['seconds']))
 
   def chronicleLoad(self,stepDoc):
     """Load the study from inputData
@@ -466,59 +644,49 @@ class SlicerChronicleLogic:
     if inputData['dataFormat'] != 'zip':
       print("Cannot load non-zip data")
       return;
-    if 'CHRONICLE_USER' in os.environ and 'user' in inputData:
-      if os.environ['CHRONICLE_USER'] != inputData['user']:
-        print("Skipping request for other user")
-        return;
-
     slicer.util.delayDisplay('Processing study from load request...')
     slicer.util.showStatusMessage('Processing load request...')
-    zipTmpDir = tempfile.mkdtemp()
-    zipFilePath = os.path.join(zipTmpDir, "study.zip")
-    print(('downloading', inputData['dataURL'], zipFilePath))
+    dicomTmpDir = tempfile.mkdtemp()
+    print(('downloading', inputData['dataURL'], dicomTmpDir))
     slicer.util.showStatusMessage('Downloading study zip...')
 
+    # members are extracted in a worker thread while the archive downloads
+    # and indexed here in batches as they arrive, so the zip itself never
+    # hits the disk
+    headers = {}
+    if inputData['dataToken'] != "":
+      headers['Authorization'] = 'bearer ' + inputData['dataToken']
+    pipeline = ZipIngestPipeline(inputData['dataURL'], dicomTmpDir, headers=headers)
+    indexer = BulkDICOMIndexer(slicer.dicomDatabase)
     try:
-      import requests
-      headers = {}
-      if inputData['dataToken'] != "":
-        headers['Authorization'] = 'bearer ' + inputData['dataToken']
-      response = requests.get(inputData['dataURL'], headers=headers)
-      chunkCount = 0
-      if(response.ok):
-        with open(zipFilePath, 'wb') as fd:
-          for chunk in response.iter_content(chunk_size=1024*128):
-            fd.write(chunk)
-            slicer.util.showStatusMessage('Downloading chunk %d...' % chunkCount)
-            chunkCount += 1
-      else:
-        print((response.reason))
-        slicer.util.showStatusMessage('Could not download')
-        return
-    except ImportError:
-      urllib.request.urlretrieve(inputData['dataURL'], zipFilePath)
-
-    dicomTmpDir = tempfile.mkdtemp()
-    slicer.app.applicationLogic().Unzip(zipFilePath, dicomTmpDir)
-    slicer.util.showStatusMessage('Unzipping study...')
-    print(('Unzip', zipFilePath, dicomTmpDir))
-    slicer.util.showStatusMessage('Processing DICOM...')
-    self.indexDICOMDirectory(dicomTmpDir)
+      indexed = indexer.indexFiles(pipeline.files(),
+          progress=lambda statistics: slicer.util.showStatusMessage('Inserted %d files...' % statistics['inserted']))
+      print("Indexed %s: %s" % (dicomTmpDir, indexed))
+    except (requests.RequestException, StreamingZipError, zipfile.BadZipFile) as e:
+      print(e)
+      slicer.util.showStatusMessage('Could not download')
+      return
+    statistics = pipeline.statistics()
+    print("Ingest: download %.1f MB/s, extract %.1f files/s, insert %.1f files/s, %d non-DICOM members skipped" %
+        (statistics['downloadMBPerSecond'], statistics['extractFilesPerSecond'],
+         statistics['insertFilesPerSecond'], statistics['extractSkipped']))
 
     slicer.util.showStatusMessage('Loading Study...')
-    detailsPopup = DICOMDetailsPopup()
-    detailsPopup.offerLoadables(inputData['studyUID'], 'Study')
-    detailsPopup.examineForLoading()
-    detailsPopup.loadCheckedLoadables()
+    # through DICOMUtils rather than the details popup, workers have no main window
+    seriesUIDs = list(slicer.dicomDatabase.seriesForStudy(inputData['studyUID']))
+    if seriesUIDs:
+      DICOMUtils.loadSeriesByUID(seriesUIDs)
+    else:
+      self.postStatus('progress', "No series of study %s were indexed" % inputData['studyUID'])
 
     slicer.util.showStatusMessage('Cleaning up...')
-    os.remove(zipFilePath)
     import shutil
     shutil.rmtree(dicomTmpDir)
 
     slicer.util.showStatusMessage('Study Loaded.')
 
-    slicer.util.selectModule('SubjectHierarchy')
+    if slicer.util.mainWindow():
+      slicer.util.selectModule('SubjectHierarchy')
 
 
   def chronicleStudyRender(self,stepDoc):
@@ -559,26 +727,7 @@ class SlicerChronicleLogic:
     # calculate the RAS coordinate of the seed and place a fiducial
     # - seed is in 0-1 slice space of seedInstanceUID (origin is upper left)
     #
-    imagePositionPatientTag = '0020,0032'
-    imageOrientationPatientTag = '0020,0037'
-    rowsTag = '0028,0010'
-    columsTag = '0028,0011'
-    spacingTag = '0028,0030'
-    positionLPS = list(map(float, slicer.dicomDatabase.instanceValue(seedInstanceUID, imagePositionPatientTag).split('\\')))
-    orientationLPS = list(map(float, slicer.dicomDatabase.instanceValue(seedInstanceUID, imageOrientationPatientTag).split('\\')))
-    spacing = list(map(float, slicer.dicomDatabase.instanceValue(seedInstanceUID, spacingTag).split('\\')))
-    rows = float(slicer.dicomDatabase.instanceValue(seedInstanceUID, rowsTag))
-    colums = float(slicer.dicomDatabase.instanceValue(seedInstanceUID, columsTag))
-    pixelSeed = [seed[0] * colums, seed[1] * rows]
-    orientationLPS = list(map(float, slicer.dicomDatabase.instanceValue(seedInstanceUID, imageOrientationPatientTag).split('\\')))
-    position = [-1. * positionLPS[0], -1. * positionLPS[1], positionLPS[2]]
-
-    # here slice spacing doesn't come into play because seed is in plane of seedInstanceUID
-    row = [-1. * spacing[0] * orientationLPS[0], -1. * spacing[0] * orientationLPS[1], orientationLPS[2]]
-    column = [-1. * spacing[1] * orientationLPS[3], -1. * spacing[1] * orientationLPS[4], orientationLPS[5]]
-    seedRAS = [ position[0] + pixelSeed[0] * row[0] + pixelSeed[1] * column[0],
-                position[1] + pixelSeed[0] * row[1] + pixelSeed[1] * column[1],
-                position[2] + pixelSeed[0] * row[2] + pixelSeed[1] * column[2] ]
+    seedRAS = self.geometryIndex.seedToRAS(inputSeriesUID, seedInstanceUID, seed)
 
     markupsLogic = slicer.modules.markups.logic()
     fiducialIndex = markupsLogic.AddFiducial(*seedRAS)
@@ -608,7 +757,7 @@ class SlicerChronicleLogic:
     self.postStatus('progress', 'Lesion segmenter completed')
 
     #
-    # threshold in the Editor
+    # threshold the level set into a label map
     #
     volumesLogic = slicer.modules.volumes.logic()
     lesionLabelNode = volumesLogic.CreateAndAddLabelVolume( slicer.mrmlScene, lesionLevelsetNode, lesionLevelsetNode.GetName() + '-label' )
@@ -619,23 +768,30 @@ class SlicerChronicleLogic:
     selectionNode.SetReferenceActiveLabelVolumeID( lesionLabelNode.GetID() )
     slicer.app.applicationLogic().PropagateVolumeSelection(0)
 
-    slicer.util.selectModule('Editor')
-    slicer.util.delayDisplay('Entered Editor', 100)
-    toolsBox = slicer.modules.EditorWidget.toolsBox
-    helper = slicer.modules.EditorWidget.helper
-    toolsBox.selectEffect('ThresholdEffect')
-    thresholdTool = toolsBox.currentTools[0]
-    thresholdTool.min = 0.
-    thresholdTool.max = lesionLevelsetNode.GetImageData().GetScalarRange()[1]
-    thresholdTool.apply()
+    # what the Editor's threshold effect did with label 1, without its
+    # widgets, so that headless workers can do it too
+    levelSetImage = lesionLevelsetNode.GetImageData()
+    threshold = vtk.vtkImageThreshold()
+    threshold.SetInputData(levelSetImage)
+    threshold.ThresholdBetween(0., levelSetImage.GetScalarRange()[1])
+    threshold.SetInValue(1)
+    threshold.SetOutValue(0)
+    threshold.SetOutputScalarType(lesionLabelNode.GetImageData().GetScalarType())
+    threshold.Update()
+    lesionLabelNode.SetAndObserveImageData(threshold.GetOutput())
     slicer.util.delayDisplay('Thresholded', 100)
-    toolsBox.selectEffect('DefaultTool')
 
     lesionLabelNode.SetName(seriesVolumeNode.GetName() + "-label")
-    helper.setVolumes(seriesVolumeNode, lesionLabelNode)
-    helper.structureListWidget.split()
-    EditUtil.exportAsDICOMSEG(seriesVolumeNode)
-    self.postStatus('progress', 'Exported SEG to database')
+    if slicer.util.mainWindow():
+      # the SEG export works from the Editor's per structure label maps
+      slicer.util.selectModule('Editor')
+      helper = slicer.modules.EditorWidget.helper
+      helper.setVolumes(seriesVolumeNode, lesionLabelNode)
+      helper.structureListWidget.split()
+      EditUtil.exportAsDICOMSEG(seriesVolumeNode)
+      self.postStatus('progress', 'Exported SEG to database')
+    else:
+      self.postStatus('progress', 'No SEG export without a main window for the Editor')
 
     segmentationFile = None
     modalityTag = "0008,0060"
@@ -657,16 +813,24 @@ class SlicerChronicleLogic:
     # attach screenshot and seg object
     #
     slicer.util.delayDisplay('Saving Pixmap...', 200)
-    id_, rev = self.postStatus('progress', 'saving pixmap')
-    pixmap = qt.QPixmap().grabWidget(slicer.util.mainWindow())
+    id_, rev = self.postStatus('progress', 'saving pixmap', immediate=True)
     tmpdir = tempfile.mkdtemp()
-    imagePath = os.path.join(tmpdir,'image.png')
-    pixmap.save(imagePath)
+    if slicer.util.mainWindow():
+      imageName = 'image.png'
+      pixmap = qt.QPixmap().grabWidget(slicer.util.mainWindow())
+      pixmap.save(os.path.join(tmpdir, imageName))
+    else:
+      # nothing to grab, render the series offscreen instead
+      imageName = 'image.jpg'
+      array, ijkToRAS, window, level = self.offscreenRenderer.volumeArray(seriesVolumeNode)
+      mosaic = self.offscreenRenderer.lightbox(array, ijkToRAS, 'Axial', window, level)
+      self.offscreenRenderer.writeJPEG(mosaic, os.path.join(tmpdir, imageName))
+    imagePath = os.path.join(tmpdir, imageName)
     doc = self.operationDB.get(id_)
     fp = open(imagePath,'rb')
-    self.operationDB.put_attachment(doc, fp, "image.png")
+    self.operationDB.put_attachment(doc, fp, imageName)
     fp.close()
-    imageURL = self.couch.resource().url + "/" + self.operationDatabaseName + "/" + id_ + "/image.png"
+    imageURL = self.couch.resource().url + "/" + self.operationDatabaseName + "/" + id_ + "/" + imageName
     segURL = "Unknown"
     if segmentationFile:
       fp = open(segmentationFile,'rb')
@@ -689,15 +853,12 @@ class SlicerChronicleLogic:
     inputSeriesUID = stepDoc['desiredProvenance']['inputSeriesUID']
     seedInstanceUID = stepDoc['desiredProvenance']['seedInstanceUID']
     seed = stepDoc['desiredProvenance']['seed']
-    stepDoc['status'] = 'working'
-    self.operationDB.save(stepDoc)
+    # the step was claimed as 'working' before we got here and is
+    # closed once we return
     originalDatabaseDirectory = self.operatingDICOMDatabase('LesionSegmenter')
     self.fetchAndSegmentSeries(inputInstanceUIDURLPairs, inputSeriesUID, seedInstanceUID, seed)
     DICOMUtils.openDatabase(originalDatabaseDirectory)
 
-    stepDoc['status'] = 'closed'
-    self.operationDB.save(stepDoc)
-
   def saveSliceViews(self,sliceNode,filePath):
     """Frame grab the slice view widgets and save
     them to the given file"""
@@ -708,109 +869,1618 @@ class SlicerChronicleLogic:
     pixmap.save(filePath)
 
   def makeAndRecordSecondaryCapture(self,filePaths,seriesDescription,studyReferenceFilePath):
-    """Convert the image to a secondary capture associated with
-    the given reference DICOM file, then record it in chronicle"""
-    import DICOMLib
-
-    # first, run img2dcm to make a dicom secondary capture
-    args = ['-k', 'SeriesDescription=%s' % seriesDescription,
-            '--study-from', studyReferenceFilePath,
-            filePaths[0], filePaths[1]
-            ]
-    DICOMLib.DICOMCommand('img2dcm', args).start()
-
-    # then run the chronicle record script to upload it
-    print(( "running %s with %s" % (self.recordPath, [filePaths[1],]) ))
-    process = qt.QProcess()
-    print("PythonSlicer", [self.recordPath, filePaths[1],] )
-    process.start("PythonSlicer", [self.recordPath, filePaths[1],] )
-    process.waitForFinished()
-    if process.exitStatus() == qt.QProcess.CrashExit or process.exitCode() != 0:
-      stdout = process.readAllStandardOutput()
-      stderr = process.readAllStandardError()
-      print(('exit status is: %d' % process.exitStatus()))
-      print(('exit code is: %d' % process.exitCode()))
-      print(('error is: %d' % process.error()))
-      print(('standard out is: %s' % stdout))
-      print(('standard error is: %s' % stderr))
-      raise UserWarning
+    """Wrap the jpeg image (filePaths[0]) in a secondary capture associated
+    with the given reference DICOM file, save it to filePaths[1] and record
+    it in chronicle with the jpeg attached"""
+    with open(filePaths[0], 'rb') as fp:
+      jpegBytes = fp.read()
+    dataset, dicomBytes = self.recordSecondaryCapture(jpegBytes, seriesDescription, studyReferenceFilePath)
+    with open(filePaths[1], 'wb') as fp:
+      fp.write(dicomBytes)
     print(('dicom saved to', filePaths[1]))
 
-    # finally attach the original image to the new document
-    # - it will have been given a new UID by img2dcm, and that
-    #   will be the id used in chronicle
-    dataset = pydicom.read_file(filePaths[1])
-    print(('expecting to find', dataset.SOPInstanceUID))
-    doc = self.chronicleDB.get(dataset.SOPInstanceUID)
-    print(('attempting to attach', filePaths[0]))
-    fp = open(filePaths[0])
-    self.chronicleDB.put_attachment(doc, fp, 'image.jpg')
-    fp.close()
+  def recordSecondaryCapture(self,jpegBytes,seriesDescription,studyReferenceFilePath):
+    """Record jpeg bytes in chronicle as a secondary capture, returning
+    the dataset and its encoding.  Safe to call from worker threads."""
+    referenceDataset = pydicom.dcmread(studyReferenceFilePath, stop_before_pixels=True)
+    dataset = self.secondaryCaptureBuilder.build(jpegBytes, seriesDescription, referenceDataset)
+    dicomBytes = self.secondaryCaptureBuilder.encode(dataset)
+    # the instance document and both attachments in one request
+    self.chronicleRecorder.record(dataset, collections.OrderedDict([
+      ('object.dcm', ('application/dicom', dicomBytes)),
+      ('image.jpg', ('image/jpeg', jpegBytes)),
+    ]))
+    print(('recorded', dataset.SOPInstanceUID))
+    return dataset, dicomBytes
 
   def seriesRender(self,seriesVolumeNode,seriesDescription,orientation):
     """Make a mosaic with images covering the volume range for
     the given orientation"""
-    import CompareVolumes
-    compareLogic = CompareVolumes.CompareVolumesLogic()
-    sliceNodeByViewName = compareLogic.volumeLightbox(seriesVolumeNode,orientation=orientation)
+    array, ijkToRAS, window, level = self.offscreenRenderer.volumeArray(seriesVolumeNode)
+    mosaic = self.offscreenRenderer.lightbox(array, ijkToRAS, orientation, window, level)
     referenceFile = seriesVolumeNode.GetStorageNode().GetFileName()
-    jpgFilePath = os.path.join(slicer.app.temporaryPath, "%s-%s.jpg" % (orientation, 'seriesRender'))
-    self.saveSliceViews(list(sliceNodeByViewName.values())[0],jpgFilePath)
-    dcmFilePath = os.path.join(slicer.app.temporaryPath, "%s-%s.dcm" % (orientation, 'seriesRender'))
+    jpgFilePath = os.path.join(self.temporaryPath, "%s-%s.jpg" % (orientation, 'seriesRender'))
+    self.offscreenRenderer.writeJPEG(mosaic, jpgFilePath)
+    dcmFilePath = os.path.join(self.temporaryPath, "%s-%s.dcm" % (orientation, 'seriesRender'))
     self.makeAndRecordSecondaryCapture((jpgFilePath,dcmFilePath),"Slicer Series Render", referenceFile)
 
   def studyRender(self,studyVolumeNodes,studyDescription,orientation):
-    """Make a mosaic with one viewer for each series in the study"""
-    import CompareVolumes
-    compareLogic = CompareVolumes.CompareVolumesLogic()
-    sliceNodeByViewName = compareLogic.viewerPerVolume(volumeNodes=studyVolumeNodes,orientation=orientation)
+    """Make a mosaic with one tile for each series in the study"""
+    volumes = [self.offscreenRenderer.volumeArray(volumeNode) for volumeNode in studyVolumeNodes]
+    mosaic = self.offscreenRenderer.centerSlices(volumes, orientation)
     referenceFile = studyVolumeNodes[0].GetStorageNode().GetFileName()
-    jpgFilePath = os.path.join(slicer.app.temporaryPath, "%s-%s.jpg" % (orientation, 'seriesRender'))
-    self.saveSliceViews(list(sliceNodeByViewName.values())[0],jpgFilePath)
-    dcmFilePath = os.path.join(slicer.app.temporaryPath, "%s-%s.dcm" % (orientation, 'seriesRender'))
+    jpgFilePath = os.path.join(self.temporaryPath, "%s-%s.jpg" % (orientation, 'seriesRender'))
+    self.offscreenRenderer.writeJPEG(mosaic, jpgFilePath)
+    dcmFilePath = os.path.join(self.temporaryPath, "%s-%s.dcm" % (orientation, 'seriesRender'))
     self.makeAndRecordSecondaryCapture((jpgFilePath,dcmFilePath),"Slicer Study Render", referenceFile)
 
+class StudyRenderPipeline:
+  """Render all the series of a study concurrently.
+
+  Series archetypes are fetched by fetchWorkers threads.  Each one is
+  loaded on the calling (main) thread as soon as it arrives, since that
+  touches the scene, and each of its orientations is rendered as a
+  separate task by renderWorkers threads.  Finished captures go through
+  a queue of at most uploadQueueSize entries to uploadWorkers threads,
+  so rendering waits when uploads fall behind instead of piling up
+  images.  Once every series is in, the study mosaics are rendered and
+  uploaded the same way.
+
+  The stages are callables:
+    fetch(seriesUID) -> files
+    load(seriesUID, files) -> volume or None
+    renderSeries(volume, orientation) -> image
+    renderStudy(volumes, orientation) -> image
+    upload(image, description, referenceFile)
+  """
+
+  def __init__(self, fetch, load, renderSeries, renderStudy, upload,
+                orientations=('Axial', 'Sagittal', 'Coronal'),
+                fetchWorkers=8, renderWorkers=4, uploadWorkers=2, uploadQueueSize=6):
+    self.fetch = fetch
+    self.load = load
+    self.renderSeries = renderSeries
+    self.renderStudy = renderStudy
+    self.upload = upload
+    self.orientations = orientations
+    self.fetchWorkers = fetchWorkers
+    self.renderWorkers = renderWorkers
+    self.uploadWorkers = uploadWorkers
+    self.uploadQueueSize = uploadQueueSize
+    self.lock = threading.Lock()
+    self.counters = collections.Counter()
+    self.errors = []
+    self.uploads = None
+
+  def count(self, counter):
+    with self.lock:
+      self.counters[counter] += 1
+
+  def renderAndQueue(self, render, arguments, description, referenceFile):
+    image = render(*arguments)
+    self.count('rendered')
+    self.uploads.put((image, description, referenceFile))
+    with self.lock:
+      self.counters['maxUploadQueueDepth'] = max(self.counters['maxUploadQueueDepth'], self.uploads.qsize())
+
+  def uploadLoop(self):
+    while True:
+      item = self.uploads.get()
+      if item is None:
+        return
+      try:
+        self.upload(*item)
+        self.count('uploaded')
+      except Exception as e:
+        self.errors.append(('upload', item[1], e))
+
+  def run(self, series):
+    """Render the (seriesUID, seriesDescription) list, return statistics()"""
+    start = time.time()
+    self.uploads = queue.Queue(maxsize=self.uploadQueueSize)
+    uploaders = [threading.Thread(target=self.uploadLoop, name='StudyRenderUpload') for index in range(self.uploadWorkers)]
+    for uploader in uploaders:
+      uploader.daemon = True
+      uploader.start()
+    volumes = []
+    renders = []
+    try:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetchWorkers) as fetchPool, \
+           concurrent.futures.ThreadPoolExecutor(max_workers=self.renderWorkers) as renderPool:
+        fetches = {fetchPool.submit(self.fetch, seriesUID): seriesUID for seriesUID, seriesDescription in series}
+        for future in concurrent.futures.as_completed(fetches):
+          seriesUID = fetches[future]
+          try:
+            files = future.result()
+            volume = self.load(seriesUID, files) if files else None
+          except Exception as e:
+            self.errors.append(('fetch', seriesUID, e))
+            continue
+          if volume is None:
+            continue
+          self.count('series')
+          volumes.append((volume, files[0]))
+          for orientation in self.orientations:
+            renders.append(renderPool.submit(self.renderAndQueue, self.renderSeries,
+                                (volume, orientation), "Slicer Series Render", files[0]))
+        if volumes:
+          for orientation in self.orientations:
+            renders.append(renderPool.submit(self.renderAndQueue, self.renderStudy,
+                                ([volume for volume, referenceFile in volumes], orientation),
+                                "Slicer Study Render", volumes[0][1]))
+        for future in concurrent.futures.as_completed(renders):
+          if future.exception():
+            self.errors.append(('render', None, future.exception()))
+    finally:
+      for uploader in uploaders:
+        self.uploads.put(None)
+      for uploader in uploaders:
+        uploader.join()
+    self.counters['seconds'] = time.time() - start
+    return self.statistics()
+
+  def statistics(self):
+    statistics = dict(self.counters)
+    statistics['errors'] = len(self.errors)
+    return statistics
+
+class SecondaryCaptureBuilder:
+  """Wrap a jpeg image in a DICOM Secondary Capture that belongs to the
+  patient and study of a reference dataset, the way img2dcm does with
+  --study-from.  The jpeg is encapsulated as is (JPEG Baseline transfer
+  syntax), only its header is read for the image dimensions.
+  """
+
+  # patient and general study modules, copied from the reference
+  studyKeywords = (
+    'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'PatientAge',
+    'StudyInstanceUID', 'StudyDate', 'StudyTime', 'StudyID', 'StudyDescription',
+    'AccessionNumber', 'ReferringPhysicianName',
+  )
+
+  def jpegInfo(self, jpegBytes):
+    """Return (rows, columns, components) from the jpeg's start of frame"""
+    offset = 2
+    while offset + 4 <= len(jpegBytes):
+      if jpegBytes[offset] != 0xFF:
+        break
+      marker = jpegBytes[offset + 1]
+      length, = struct.unpack('>H', jpegBytes[offset+2:offset+4])
+      if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+        rows, columns, components = struct.unpack('>HHB', jpegBytes[offset+5:offset+10])
+        return rows, columns, components
+      offset += 2 + length
+    raise ValueError('No jpeg frame header found')
+
+  def build(self, jpegBytes, seriesDescription, referenceDataset):
+    import pydicom.dataset
+    import pydicom.encaps
+    import pydicom.uid
+    rows, columns, components = self.jpegInfo(jpegBytes)
+    dataset = pydicom.dataset.Dataset()
+    for keyword in self.studyKeywords:
+      if keyword in referenceDataset:
+        setattr(dataset, keyword, referenceDataset.data_element(keyword).value)
+    now = time.localtime()
+    dataset.SOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+    dataset.SOPInstanceUID = pydicom.uid.generate_uid()
+    dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
+    dataset.SeriesDescription = seriesDescription
+    dataset.SeriesNumber = 1000
+    dataset.InstanceNumber = 1
+    dataset.Modality = 'OT'
+    dataset.ConversionType = 'WSD'
+    dataset.ContentDate = dataset.InstanceCreationDate = time.strftime('%Y%m%d', now)
+    dataset.ContentTime = dataset.InstanceCreationTime = time.strftime('%H%M%S', now)
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.SamplesPerPixel = components
+    dataset.PhotometricInterpretation = 'MONOCHROME2' if components == 1 else 'YBR_FULL_422'
+    if components > 1:
+      dataset.PlanarConfiguration = 0
+    dataset.BitsAllocated = dataset.BitsStored = 8
+    dataset.HighBit = 7
+    dataset.PixelRepresentation = 0
+    dataset.LossyImageCompression = '01'
+    dataset.PixelData = pydicom.encaps.encapsulate([jpegBytes])
+    dataset['PixelData'].VR = 'OB'
+
+    dataset.file_meta = pydicom.dataset.FileMetaDataset()
+    dataset.file_meta.MediaStorageSOPClassUID = dataset.SOPClassUID
+    dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+    dataset.file_meta.TransferSyntaxUID = pydicom.uid.JPEGBaseline8Bit \
+        if hasattr(pydicom.uid, 'JPEGBaseline8Bit') else pydicom.uid.JPEGBaseline
+    return dataset
+
+  def encode(self, dataset):
+    """Return the dataset as DICOM part 10 bytes"""
+    import io
+    buffer = io.BytesIO()
+    try:
+      pydicom.dcmwrite(buffer, dataset, enforce_file_format=True)
+    except TypeError:
+      # pydicom before 3.0
+      dataset.is_little_endian = True
+      dataset.is_implicit_VR = False
+      pydicom.dcmwrite(buffer, dataset, write_like_original=False)
+    return buffer.getvalue()
+
+class ChronicleRecorder:
+  """Record DICOM instances in a chronicle database.
+
+  Documents follow chronicle's record.py: the _id is the SOPInstanceUID
+  and 'dataset' maps "GGGGEEEE" tags to {'vr', 'Value'}, with binary
+  values left out.  The document and its attachments are sent in one
+  multipart/related PUT.
+  """
+
+  binaryVRs = ('OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN', 'OB or OW', 'US or OW', 'US or SS or OW')
+
+  def __init__(self, db, session=None):
+    self.db = db
+    self.session = session or requests.Session()
+
+  def elementValue(self, value):
+    if isinstance(value, pydicom.dataset.Dataset):
+      return self.datasetToJSON(value)
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue, pydicom.sequence.Sequence)):
+      return [self.elementValue(item) for item in value]
+    if isinstance(value, (int, float)):
+      return value
+    return str(value)
+
+  def datasetToJSON(self, dataset):
+    jsonDataset = {}
+    for dataElement in dataset:
+      if dataElement.VR in self.binaryVRs:
+        continue
+      jsonDataset['%04X%04X' % (dataElement.tag.group, dataElement.tag.element)] = {
+        'vr': dataElement.VR,
+        'Value': self.elementValue(dataElement.value),
+      }
+    return jsonDataset
+
+  def record(self, dataset, attachments):
+    """Create the instance document with attachments, a dict of
+    name -> (contentType, bytes).  Returns (id, rev)."""
+    import uuid
+    doc = {
+      '_id': str(dataset.SOPInstanceUID),
+      'dataset': self.datasetToJSON(dataset),
+      '_attachments': {},
+    }
+    for name, (contentType, data) in attachments.items():
+      doc['_attachments'][name] = {'follows': True, 'content_type': contentType, 'length': len(data)}
+    # attachment parts follow the json in the order of _attachments
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+    body += ('--%s\r\nContent-Type: application/json\r\n\r\n' % boundary).encode()
+    body += json.dumps(doc).encode() + b'\r\n'
+    for name, (contentType, data) in attachments.items():
+      body += ('--%s\r\nContent-Disposition: attachment; filename="%s"\r\n'
+               'Content-Type: %s\r\nContent-Length: %d\r\n\r\n' % (boundary, name, contentType, len(data))).encode()
+      body += data + b'\r\n'
+    body += ('--%s--' % boundary).encode()
+    url = self.db.resource().url + '/' + urllib.parse.quote(doc['_id'], safe='')
+    response = self.session.put(url, data=bytes(body),
+                  headers={'Content-Type': 'multipart/related; boundary="%s"' % boundary})
+    if response.status_code == 409:
+      raise couchdb.ResourceConflict(('conflict', 'Document update conflict.'))
+    response.raise_for_status()
+    result = response.json()
+    return result['id'], result['rev']
+
+class StepScheduler:
+  """Run steps one at a time from the Qt event loop.
+
+  submit() only records a document id, so it is cheap enough to call from
+  the changes feed callback.  Pending ids are resolved to step documents
+  by the resolve callable (which returns None for anything that is not a
+  step we should run) and executed in order of the step's 'priority'
+  field (higher first, then first come first served).  An id is never
+  executed twice, however many times it appears on the feed.
+  Control returns to the event loop between steps.
+  """
+
+  def __init__(self, resolve, execute, historySize=10000):
+    self.resolve = resolve
+    self.execute = execute
+    self.historySize = historySize
+    self.incoming = collections.OrderedDict() # docID -> (doc, submitTime)
+    self.queue = [] # heap of (-priority, sequence, docID, doc, submitTime)
+    self.queued = set()
+    self.history = collections.OrderedDict() # ids already executed
+    self.sequence = 0
+    self.dispatchPending = False
+    self.running = False
+    self.current = None # docID being executed
+    self.metrics = {
+      'submitted' : 0,
+      'duplicates' : 0,
+      'ignored' : 0,
+      'maxQueueDepth' : 0,
+      'operations' : {},
+    }
+
+  def submit(self, docID, doc=None, again=False):
+    """Note that docID changed; doc may be given if already fetched.
+    With again=True an id that already ran may be queued once more,
+    e.g. for a step whose worker stopped renewing its lease."""
+    self.metrics['submitted'] += 1
+    if again:
+      self.history.pop(docID, None)
+    if docID in self.queued or docID in self.incoming or docID in self.history:
+      self.metrics['duplicates'] += 1
+      return
+    self.incoming[docID] = (doc, time.time())
+    self.metrics['maxQueueDepth'] = max(self.metrics['maxQueueDepth'], self.queueDepth())
+    self.scheduleDispatch()
+
+  def queueDepth(self):
+    return len(self.incoming) + len(self.queue)
+
+  def pending(self, docID):
+    """True while docID is waiting to be resolved or run, or running"""
+    return docID in self.incoming or docID in self.queued or docID == self.current
+
+  def clear(self):
+    """Drop steps that have not started yet"""
+    self.incoming.clear()
+    self.queue = []
+    self.queued.clear()
+
+  def statistics(self):
+    """Return the metrics along with the current queue depth.
+    Per operation: count, failures, total and max waitTime and
+    executionTime in seconds."""
+    statistics = dict(self.metrics)
+    statistics['queueDepth'] = self.queueDepth()
+    return statistics
+
+  def scheduleDispatch(self):
+    if not self.dispatchPending:
+      self.dispatchPending = True
+      qt.QTimer.singleShot(0, self.dispatch)
+
+  def resolveIncoming(self):
+    while self.incoming:
+      docID, (doc, submitTime) = self.incoming.popitem(last=False)
+      try:
+        doc = self.resolve(docID, doc)
+      except Exception as e:
+        import traceback
+        traceback.print_exc()
+        doc = None
+      if doc is None:
+        self.metrics['ignored'] += 1
+        continue
+      self.sequence += 1
+      heapq.heappush(self.queue, (-doc.get('priority', 0), self.sequence, docID, doc, submitTime))
+      self.queued.add(docID)
+
+  def dispatch(self):
+    """Run the highest priority step and reschedule if more remain.
+    Does nothing if called while a step is already running (e.g. from
+    processEvents inside an operation)."""
+    self.dispatchPending = False
+    if self.running:
+      return
+    self.running = True
+    try:
+      self.resolveIncoming()
+      if not self.queue:
+        return
+      _, _, docID, doc, submitTime = heapq.heappop(self.queue)
+      self.queued.discard(docID)
+      self.history[docID] = True
+      while len(self.history) > self.historySize:
+        self.history.popitem(last=False)
+      try:
+        operation = doc['desiredProvenance']['operation']
+      except (KeyError, TypeError):
+        operation = None
+      operationMetrics = self.metrics['operations'].setdefault(operation, {
+        'count' : 0, 'failures' : 0,
+        'waitTime' : 0., 'maxWaitTime' : 0.,
+        'executionTime' : 0., 'maxExecutionTime' : 0.,
+      })
+      startTime = time.time()
+      self.current = docID
+      try:
+        self.execute(doc)
+      except Exception as e:
+        operationMetrics['failures'] += 1
+        import traceback
+        traceback.print_exc()
+      finally:
+        self.current = None
+      endTime = time.time()
+      waitTime = startTime - submitTime
+      executionTime = endTime - startTime
+      operationMetrics['count'] += 1
+      operationMetrics['waitTime'] += waitTime
+      operationMetrics['maxWaitTime'] = max(operationMetrics['maxWaitTime'], waitTime)
+      operationMetrics['executionTime'] += executionTime
+      operationMetrics['maxExecutionTime'] = max(operationMetrics['maxExecutionTime'], executionTime)
+    finally:
+      self.running = False
+    if self.queueDepth() > 0:
+      self.scheduleDispatch()
+
+class StepLeaseLost(Exception):
+  """Another worker has taken over a step we were working on"""
+
+class StepLease:
+  """This worker's claim on a step document.
+
+  The lease is renewed from a background thread every heartbeatInterval
+  seconds by moving lease.expires forward.  Every write goes through
+  save(), which is conditioned on the _rev this worker last saw.  After
+  a conflict the document is read again and the write is retried only
+  if the lease still names this worker; otherwise StepLeaseLost is
+  raised.  Once the lease is released a late heartbeat does nothing.
+  """
+
+  def __init__(self, claimer, doc):
+    self.claimer = claimer
+    self.db = claimer.db
+    self.doc = doc
+    self.lost = False
+    self.released = False
+    self.lock = threading.RLock()
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run, name='StepLease')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while not self.stopped.wait(self.claimer.heartbeatInterval):
+      try:
+        self.renew()
+      except StepLeaseLost:
+        logging.warning("Lost the lease on step %s" % self.doc['_id'])
+        return
+      except Exception as e:
+        logging.warning("Could not renew the lease on step %s: %s" % (self.doc['_id'], e))
+
+  def renew(self):
+    def heartbeat(doc):
+      now = time.time()
+      return {'lease': dict(doc['lease'], heartbeat=now, expires=now + self.claimer.leaseDuration)}
+    with self.lock:
+      if self.released:
+        return self.doc
+      return self.save(heartbeat)
+
+  def save(self, changes):
+    """Apply changes to the step document and save it.  changes is a
+    dict, or a function of the document returning one, which is called
+    again on the current document after a conflict.
+    """
+    with self.lock:
+      if self.lost:
+        raise StepLeaseLost(self.doc['_id'])
+      doc = dict(self.doc)
+      doc.update(changes(doc) if callable(changes) else changes)
+      while True:
+        try:
+          self.db.save(doc)
+          self.doc = doc
+          return doc
+        except couchdb.ResourceConflict:
+          current = self.db[doc['_id']]
+          if not self.claimer.ownsLease(current):
+            self.lost = True
+            self.claimer.counters['lost'] += 1
+            raise StepLeaseLost(doc['_id'])
+          doc = dict(current)
+          doc.update(changes(doc) if callable(changes) else changes)
+
+  def release(self, status='closed'):
+    """Stop the heartbeat and leave the step in status"""
+    self.stopped.set()
+    with self.lock:
+      doc = self.save(lambda doc: {'status': status, 'lease': dict(doc['lease'], released=time.time())})
+      self.released = True
+      return doc
+
+class StepClaimer:
+  """Claim step documents so that each step runs exactly once, however
+  many workers watch the same operation database.
+
+  A claim is an update of the step document, conditioned on the _rev it
+  was read at, that sets status to 'working' and records a lease:
+  {'worker', 'claimed', 'heartbeat', 'expires'} with times in seconds
+  since the epoch.  If another worker saved the document first CouchDB
+  answers with a conflict and the claim is abandoned.  A step whose
+  lease expired without being renewed, because its worker died, can be
+  claimed again; expiredSteps() finds them.
+  """
+
+  def __init__(self, db, workerID=None, leaseDuration=300., heartbeatInterval=None):
+    import socket
+    import uuid
+    self.db = db
+    self.workerID = workerID or '%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    self.leaseDuration = leaseDuration
+    self.heartbeatInterval = heartbeatInterval or leaseDuration / 3.
+    self.counters = collections.Counter()
+
+  def ownsLease(self, doc):
+    return doc.get('status') == 'working' and doc.get('lease', {}).get('worker') == self.workerID
+
+  def leaseExpired(self, doc):
+    lease = doc.get('lease')
+    return doc.get('status') == 'working' and bool(lease) and lease.get('expires', 0) < time.time()
+
+  def claimable(self, doc):
+    return doc.get('status') == 'open' or self.leaseExpired(doc)
+
+  def claim(self, doc):
+    """Return a StepLease on doc, or None if it was claimed elsewhere"""
+    if not self.claimable(doc):
+      self.counters['unclaimable'] += 1
+      return None
+    now = time.time()
+    claimed = dict(doc)
+    claimed['status'] = 'working'
+    claimed['lease'] = {
+      'worker': self.workerID,
+      'claimed': now,
+      'heartbeat': now,
+      'expires': now + self.leaseDuration,
+    }
+    if self.leaseExpired(doc):
+      claimed['lease']['previousWorker'] = doc['lease'].get('worker')
+    try:
+      self.db.save(claimed)
+    except couchdb.ResourceConflict:
+      self.counters['conflicts'] += 1
+      return None
+    self.counters['claimed'] += 1
+    if 'previousWorker' in claimed['lease']:
+      self.counters['reclaimed'] += 1
+    return StepLease(self, claimed)
+
+  def expiredSteps(self, selector=None):
+    """Steps matching selector whose lease has run out"""
+    query = dict(selector or {})
+    query['status'] = 'working'
+    query['lease.expires'] = {'$lt': time.time()}
+    return list(self.db.find({'selector': query}))
+
+class ProgressReporter:
+  """Write status documents to the operation database in batches.
+
+  Progress messages are buffered and flushed from a background thread
+  with Database.update (one _bulk_docs request) once flushInterval seconds
+  have passed or maxMessages are waiting.  Within a flush, messages for
+  the same request and status are coalesced into documents of up to
+  maxMessages entries whose 'progress' is the latest message and whose
+  'messages' lists them all.
+  Other statuses (e.g. 'result') flush anything pending and are then
+  saved immediately, so they always arrive after earlier progress.
+  """
+
+  def __init__(self, db, flushInterval=1., maxMessages=100):
+    self.db = db
+    self.flushInterval = flushInterval
+    self.maxMessages = maxMessages
+    self.pending = []
+    self.condition = threading.Condition()
+    self.writeLock = threading.Lock()
+    self.counters = {
+      'posted' : 0,     # messages handed to post()
+      'coalesced' : 0,  # messages merged into another document
+      'written' : 0,    # documents saved to the database
+      'failed' : 0,     # documents that could not be saved
+      'requests' : 0,   # save or _bulk_docs round trips
+    }
+    self.running = True
+    self.thread = threading.Thread(target=self._run, name='ProgressReporter')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def post(self, requestID, status, progressString, immediate=False):
+    """Queue a progress message, or save a non-progress status now and
+    return its (id, rev)"""
+    if status != 'progress' or immediate:
+      self.flush()
+      with self.writeLock:
+        self.counters['posted'] += 1
+        self.counters['requests'] += 1
+        try:
+          id_, rev = self.db.save({
+            'requestID' : requestID,
+            'type' : status,
+            'progress' : progressString,
+          })
+        except:
+          self.counters['failed'] += 1
+          raise
+        self.counters['written'] += 1
+        return (id_, rev)
+    with self.condition:
+      self.pending.append((requestID, status, progressString))
+      self.counters['posted'] += 1
+      if len(self.pending) == 1 or len(self.pending) >= self.maxMessages:
+        self.condition.notify()
+      running = self.running
+    if not running:
+      self.flush()
+
+  def flush(self):
+    """Write all pending messages with a single bulk request"""
+    with self.writeLock:
+      with self.condition:
+        messages, self.pending = self.pending, []
+      if messages == []:
+        return
+      docs = []
+      docsByKey = {}
+      for requestID, status, progressString in messages:
+        key = (requestID, status)
+        doc = docsByKey.get(key)
+        if doc and len(doc['messages']) < self.maxMessages:
+          doc['progress'] = progressString
+          doc['messages'].append(progressString)
+          self.counters['coalesced'] += 1
+        else:
+          docsByKey[key] = {
+            'requestID' : requestID,
+            'type' : status,
+            'progress' : progressString,
+            'messages' : [progressString],
+          }
+          docs.append(docsByKey[key])
+      self.counters['requests'] += 1
+      try:
+        for success, docID, revOrError in self.db.update(docs):
+          if success:
+            self.counters['written'] += 1
+          else:
+            self.counters['failed'] += 1
+            print('...failed to save progress %s: %s' % (docID, revOrError))
+      except Exception as e:
+        self.counters['failed'] += len(docs)
+        print('...failed to save progress!!! %s' % e)
+
+  def stop(self):
+    """Flush pending messages and end the background thread.  Messages
+    posted afterwards are written as they arrive."""
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+    self.thread.join()
+    self.flush()
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while self.running and self.pending == []:
+          self.condition.wait()
+        if self.running and len(self.pending) < self.maxMessages:
+          # let the window fill up
+          self.condition.wait(self.flushInterval)
+        running = self.running
+      self.flush()
+      if not running:
+        return
+
+class InstanceCache:
+  """Keep downloaded instance files on disk between requests.
+
+  Entries are keyed by SOPInstanceUID and remember the ETag of the
+  download and, when the caller knows it, the document _rev.  A fetch
+  with a matching revision is answered from disk with no request at all;
+  otherwise the copy is revalidated with If-None-Match and only
+  downloaded again if it changed.  Files are written under a temporary
+  name and renamed into place, and least recently used entries are
+  evicted once the cache holds more than maxBytes, except those of a
+  group pinned with pin() (e.g. a series whose volume is loaded from the
+  cached files) until it is unpinned.  The index is saved at most every
+  saveInterval seconds, on save() and at exit.
+  """
+
+  sharedCaches = {}
+
+  @classmethod
+  def shared(cls, directory=None):
+    """Return the one cache instance for the directory"""
+    if directory is None:
+      directory = os.path.join(slicer.app.temporaryPath, 'SlicerChronicleInstanceCache')
+    if directory not in cls.sharedCaches:
+      cls.sharedCaches[directory] = cls(directory)
+    return cls.sharedCaches[directory]
+
+  def __init__(self, directory, maxBytes=4*1024**3, saveInterval=5.):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.saveInterval = saveInterval
+    self.indexPath = os.path.join(directory, 'index.json')
+    self.lock = threading.RLock()
+    self.session = requests.Session()
+    self.entries = collections.OrderedDict() # least recently used first
+    self.pins = collections.Counter() # group -> pin count
+    self.totalBytes = 0
+    self.dirty = False
+    self.saveTime = time.time()
+    self.counters = {
+      'hits' : 0,        # fetches answered from disk
+      'misses' : 0,      # fetches that downloaded the file
+      'revalidated' : 0, # hits confirmed by a 304 response
+      'bytesSaved' : 0,
+      'bytesFetched' : 0,
+      'evictions' : 0,
+    }
+    os.makedirs(directory, exist_ok=True)
+    self.load()
+    atexit.register(self.save)
+
+  def load(self):
+    """Read the index, dropping entries whose files are gone and
+    files that are not in the index"""
+    try:
+      with open(self.indexPath) as fp:
+        entries = json.load(fp, object_pairs_hook=collections.OrderedDict)
+    except (IOError, ValueError):
+      entries = collections.OrderedDict()
+    for key, entry in entries.items():
+      if os.path.exists(self.filePath(entry)):
+        self.entries[key] = entry
+        self.totalBytes += entry['size']
+    known = set([self.filePath(entry) for entry in self.entries.values()])
+    known.add(self.indexPath)
+    for root, subFolders, files in os.walk(self.directory):
+      for file_ in files:
+        filePath = os.path.join(root, file_)
+        if filePath not in known:
+          os.remove(filePath)
+
+  def save(self):
+    with self.lock:
+      if not self.dirty:
+        return
+      tmpPath = self.indexPath + '.tmp'
+      with open(tmpPath, 'w') as fp:
+        json.dump(self.entries, fp)
+      os.replace(tmpPath, self.indexPath)
+      self.dirty = False
+      self.saveTime = time.time()
+
+  def statistics(self):
+    with self.lock:
+      statistics = dict(self.counters)
+      statistics['entries'] = len(self.entries)
+      statistics['bytes'] = self.totalBytes
+      return statistics
+
+  def filePath(self, entry):
+    return os.path.join(self.directory, entry['path'])
+
+  def pin(self, group):
+    """Keep the entries of group until a matching unpin()"""
+    with self.lock:
+      self.pins[group] += 1
+
+  def unpin(self, group):
+    with self.lock:
+      self.pins[group] -= 1
+      if self.pins[group] <= 0:
+        del self.pins[group]
+        self.evict()
+
+  def relativePath(self, key, group):
+    return os.path.join(urllib.parse.quote(group or '_', safe=''),
+                          urllib.parse.quote(key, safe='') + '.dcm')
+
+  def fetch(self, url, key, revision=None, group=None):
+    """Return the path of an up to date local copy of url.
+    group puts the file in a subdirectory shared only with other files
+    fetched with the same group (e.g. the instances of one series)."""
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry and not os.path.exists(self.filePath(entry)):
+        self.discard(key)
+        entry = None
+      if entry and revision is not None and entry.get('revision') == revision:
+        return self.hit(key, group)
+
+    headers = {}
+    if entry and entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    response = self.session.get(url, headers=headers, stream=True, timeout=60)
+    if response.status_code == 304 and entry:
+      response.close()
+      with self.lock:
+        self.counters['revalidated'] += 1
+        if revision is not None:
+          self.entries[key]['revision'] = revision
+        return self.hit(key, group)
+    response.raise_for_status()
+
+    relativePath = self.relativePath(key, group)
+    filePath = os.path.join(self.directory, relativePath)
+    os.makedirs(os.path.dirname(filePath), exist_ok=True)
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(filePath), suffix='.partial')
+    size = 0
+    try:
+      with os.fdopen(fd, 'wb') as fp:
+        for chunk in response.iter_content(chunk_size=1024*128):
+          fp.write(chunk)
+          size += len(chunk)
+      os.replace(tmpPath, filePath)
+    except:
+      os.remove(tmpPath)
+      raise
+
+    with self.lock:
+      if key in self.entries:
+        oldEntry = self.entries.pop(key)
+        self.totalBytes -= oldEntry['size']
+        if oldEntry['path'] != relativePath and os.path.exists(self.filePath(oldEntry)):
+          os.remove(self.filePath(oldEntry))
+      self.entries[key] = {
+        'path' : relativePath,
+        'etag' : response.headers.get('ETag'),
+        'revision' : revision,
+        'group' : group,
+        'size' : size,
+      }
+      self.totalBytes += size
+      self.counters['misses'] += 1
+      self.counters['bytesFetched'] += size
+      self.evict(keep=key)
+      self.changed()
+    return filePath
+
+  def cachedPath(self, key):
+    """Return the path of the local copy of key without any request,
+    or None if it isn't cached"""
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry and os.path.exists(self.filePath(entry)):
+        return self.hit(key, None)
+      return None
+
+  def hit(self, key, group):
+    entry = self.entries[key]
+    if group is not None:
+      relativePath = self.relativePath(key, group)
+      if entry['path'] != relativePath:
+        filePath = os.path.join(self.directory, relativePath)
+        os.makedirs(os.path.dirname(filePath), exist_ok=True)
+        os.replace(self.filePath(entry), filePath)
+        entry['path'] = relativePath
+        entry['group'] = group
+    self.entries.move_to_end(key)
+    self.counters['hits'] += 1
+    self.counters['bytesSaved'] += entry['size']
+    self.changed()
+    return self.filePath(entry)
+
+  def discard(self, key):
+    entry = self.entries.pop(key)
+    self.totalBytes -= entry['size']
+    if os.path.exists(self.filePath(entry)):
+      os.remove(self.filePath(entry))
+    self.changed()
+
+  def evict(self, keep=None):
+    for key, entry in list(self.entries.items()):
+      if self.totalBytes <= self.maxBytes:
+        break
+      if key != keep and entry.get('group') not in self.pins:
+        self.discard(key)
+        self.counters['evictions'] += 1
+
+  def changed(self):
+    self.dirty = True
+    if time.time() - self.saveTime > self.saveInterval:
+      self.save()
+
+class InstanceDownloader:
+  """Download instance files with a bounded pool of worker threads.
+
+  All workers share one requests.Session whose connection pool is sized
+  to the number of workers, so connections to the same host are kept
+  alive and reused from one instance to the next.  Failed transfers are
+  retried with exponential backoff when the failure is transient: a
+  connection error, a 5xx response or 429 Too Many Requests.
+  """
+
+  def __init__(self, maxWorkers=8, retries=3, backoff=0.5, timeout=60, chunkSize=1024*128):
+    self.maxWorkers = maxWorkers
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.chunkSize = chunkSize
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=maxWorkers, pool_maxsize=maxWorkers)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def fetch(self, url, filePath):
+    """Stream the url to filePath, retrying transient failures"""
+    attempt = 0
+    while True:
+      try:
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+          response.raise_for_status()
+          with open(filePath, 'wb') as fp:
+            for chunk in response.iter_content(chunk_size=self.chunkSize):
+              fp.write(chunk)
+        return filePath
+      except (requests.RequestException, IOError) as e:
+        attempt += 1
+        if attempt > self.retries or not self.transient(e):
+          raise
+        logging.warning("Retrying %s after error: %s" % (url, e))
+        time.sleep(self.backoff * 2 ** (attempt - 1))
+
+  @staticmethod
+  def transient(error):
+    """True unless the server answered with a status that will not change"""
+    response = getattr(error, 'response', None)
+    if response is None:
+      return True
+    return response.status_code >= 500 or response.status_code == 429
+
+  def fetchAll(self, urlPathPairs):
+    """Download each (url, filePath) pair in the pool and yield
+    (url, filePath, error) tuples in completion order.  error is None
+    on success.  Iterate from the main thread so that consumers can
+    safely touch the scene or the dicom database.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+      futures = {}
+      for url, filePath in urlPathPairs:
+        futures[executor.submit(self.fetch, url, filePath)] = (url, filePath)
+      for future in concurrent.futures.as_completed(futures):
+        url, filePath = futures[future]
+        yield url, filePath, future.exception()
+
+class InstanceTagIndex:
+  """Selected tag values of chronicle instances, fetched in bulk and
+  kept column-wise.
+
+  Chronicle documents carry the instance header as a 'dataset' of
+  "GGGGEEEE" -> {'vr', 'Value'}.  load() requests only the wanted tags
+  of up to batchSize instances at a time, with a Mango _find projection,
+  or with _all_docs and include_docs on servers without _find.  Each
+  tag becomes a column mapping instanceUID to its Value, None when the
+  instance doesn't have the tag.  Lookups of loaded tags make no
+  request.  Instances chronicle doesn't have are kept in a set of
+  absent ones rather than in the columns, and are only asked for again
+  after invalidate() or when load() is called with retry.
+  """
+
+  def __init__(self, db, session=None, batchSize=500):
+    self.db = db
+    self.session = session or requests.Session()
+    self.batchSize = batchSize
+    self.useFind = True
+    self.columns = {} # tag -> {instanceUID: value}
+    self.absent = set()
+    self.counters = collections.Counter()
+
+  @staticmethod
+  def tagKey(tag):
+    """'0020,000d' or '0020000D' -> '0020000D'"""
+    return tag.replace(',', '').upper()
+
+  def invalidate(self, instanceUIDs=None):
+    if instanceUIDs is None:
+      self.columns.clear()
+      self.absent.clear()
+      return
+    self.absent.difference_update(instanceUIDs)
+    for column in self.columns.values():
+      for instanceUID in instanceUIDs:
+        column.pop(instanceUID, None)
+
+  def load(self, instanceUIDs, tags, retry=False):
+    """Make sure the tags of the instances are in the index.  With
+    retry, instances found absent before are asked for again."""
+    tags = [self.tagKey(tag) for tag in tags]
+    columns = [self.columns.setdefault(tag, {}) for tag in tags]
+    missing = []
+    for instanceUID in instanceUIDs:
+      if instanceUID in self.absent and not retry:
+        continue
+      if any([instanceUID not in column for column in columns]):
+        missing.append(instanceUID)
+    missing = list(collections.OrderedDict.fromkeys(missing))
+    for start in range(0, len(missing), self.batchSize):
+      batch = missing[start:start + self.batchSize]
+      found = set()
+      for doc in self.datasets(batch, tags):
+        found.add(doc['_id'])
+        dataset = doc.get('dataset') or {}
+        for tag, column in zip(tags, columns):
+          element = dataset.get(tag)
+          column[doc['_id']] = element.get('Value') if isinstance(element, dict) else None
+      self.absent.difference_update(found)
+      self.absent.update(set(batch) - found)
+
+  def datasets(self, instanceUIDs, tags):
+    """Yield the documents of the instances, projected to the tags
+    when the server allows"""
+    url = self.db.resource().url
+    self.counters['requests'] += 1
+    if self.useFind:
+      query = {
+        'selector': {'_id': {'$in': instanceUIDs}},
+        'fields': ['_id'] + ['dataset.' + tag for tag in tags],
+        'limit': len(instanceUIDs),
+      }
+      response = self.session.post(url + '/_find', json=query)
+      if response.status_code in (400, 404):
+        # couchdb before 2.0
+        self.useFind = False
+      else:
+        response.raise_for_status()
+        for doc in response.json()['docs']:
+          yield doc
+        return
+    rows = ViewRowParser().rows(self.session, url + '/_all_docs', {'include_docs': 'true'}, keys=instanceUIDs)
+    for row in rows:
+      if row.get('doc'):
+        yield row['doc']
+
+  def column(self, tag):
+    return self.columns.get(self.tagKey(tag), {})
+
+  def value(self, instanceUID, tag):
+    column = self.column(tag)
+    if instanceUID not in column and instanceUID not in self.absent:
+      self.load([instanceUID], [tag])
+      column = self.column(tag)
+    else:
+      self.counters['hits'] += 1
+    return column.get(instanceUID)
+
+  def values(self, tag, instanceUIDs):
+    """The tag's value for each instance, in one request for those
+    not yet loaded"""
+    self.load(instanceUIDs, [tag])
+    column = self.column(tag)
+    return [column.get(instanceUID) for instanceUID in instanceUIDs]
+
+class SeriesGeometryIndex:
+  """Image plane geometry of the instances in a series, kept in NumPy
+  arrays so that many seeds can be mapped to RAS at once.
+
+  An instance's geometry is read from the dicom database the first time
+  a seed on it is mapped, with one lookup per tag, so a single seed
+  costs a handful of lookups however long the series.  After that each
+  query only checks the series' instance list, and the series is read
+  again when instances were added or removed.  Call invalidate() to drop
+  series explicitly.  With a tagIndex the tags of all the instances of a
+  series are requested from chronicle at once each time it is built, and
+  the dicom database is only consulted for instances that chronicle
+  doesn't have.
+  """
+
+  imagePositionPatientTag = '0020,0032'
+  imageOrientationPatientTag = '0020,0037'
+  rowsTag = '0028,0010'
+  columnsTag = '0028,0011'
+  spacingTag = '0028,0030'
+
+  def __init__(self, database=None, tagIndex=None):
+    self._database = database
+    self.tagIndex = tagIndex
+    self.series = {}
+    self.counters = collections.Counter()
+
+  @property
+  def database(self):
+    return self._database or slicer.dicomDatabase
+
+  def invalidate(self, seriesUID=None):
+    if seriesUID:
+      self.series.pop(seriesUID, None)
+    else:
+      self.series.clear()
+
+  def values(self, instanceUID, tag, count):
+    """Parse a backslash separated value, NaN when it is missing or malformed"""
+    value = self.tagIndex.value(instanceUID, tag) if self.tagIndex else None
+    try:
+      if value is None:
+        values = list(map(float, self.database.instanceValue(instanceUID, tag).split('\\')))
+      elif isinstance(value, list):
+        values = list(map(float, value))
+      else:
+        values = [float(value)]
+    except (ValueError, TypeError):
+      values = []
+    if len(values) != count:
+      return [numpy.nan] * count
+    return values
+
+  def geometry(self, seriesUID):
+    instanceUIDs = tuple(self.database.instancesForSeries(seriesUID))
+    geometry = self.series.get(seriesUID)
+    if geometry and geometry['instanceUIDs'] == instanceUIDs:
+      self.counters['hits'] += 1
+      return geometry
+    self.counters['builds'] += 1
+    if self.tagIndex:
+      # instances found absent before are tried once more per build
+      self.tagIndex.load(instanceUIDs, [self.imagePositionPatientTag, self.imageOrientationPatientTag,
+                                        self.rowsTag, self.columnsTag, self.spacingTag], retry=True)
+    count = len(instanceUIDs)
+    geometry = {
+      'instanceUIDs': instanceUIDs,
+      'rows': {instanceUID: row for row, instanceUID in enumerate(instanceUIDs)},
+      'read': numpy.zeros(count, dtype=bool),
+      'position': numpy.empty((count, 3)),
+      'orientation': numpy.empty((count, 6)),
+      'spacing': numpy.empty((count, 2)),
+      'dimensions': numpy.empty((count, 2)),
+    }
+    self.series[seriesUID] = geometry
+    return geometry
+
+  def readRows(self, geometry, rows):
+    """Fill in the geometry of the rows that have not been read yet"""
+    for row in set(rows):
+      if geometry['read'][row]:
+        continue
+      instanceUID = geometry['instanceUIDs'][row]
+      geometry['position'][row] = self.values(instanceUID, self.imagePositionPatientTag, 3)
+      geometry['orientation'][row] = self.values(instanceUID, self.imageOrientationPatientTag, 6)
+      geometry['spacing'][row] = self.values(instanceUID, self.spacingTag, 2)
+      geometry['dimensions'][row] = (self.values(instanceUID, self.columnsTag, 1) +
+                                       self.values(instanceUID, self.rowsTag, 1))
+      geometry['read'][row] = True
+
+  def seedsToRAS(self, seriesUID, instanceUIDs, seeds):
+    """Return an (N,3) array of RAS points for N seeds, each given in
+    the 0-1 slice space (origin upper left) of the matching instance
+    """
+    geometry = self.geometry(seriesUID)
+    try:
+      rows = [geometry['rows'][instanceUID] for instanceUID in instanceUIDs]
+    except KeyError as e:
+      raise ValueError("Instance %s is not in series %s" % (e.args[0], seriesUID))
+    self.readRows(geometry, rows)
+    seeds = numpy.asarray(seeds, dtype=float).reshape(-1, 2)
+    position = geometry['position'][rows]
+    orientation = geometry['orientation'][rows]
+    spacing = geometry['spacing'][rows]
+    pixelSeeds = seeds * geometry['dimensions'][rows]
+
+    # LPS to RAS; slice spacing doesn't come into play because each seed
+    # is in the plane of its instance
+    flip = numpy.array([-1., -1., 1.])
+    rowScale = numpy.ones((len(rows), 3))
+    rowScale[:, :2] = spacing[:, 0:1]
+    columnScale = numpy.ones((len(rows), 3))
+    columnScale[:, :2] = spacing[:, 1:2]
+    rowVectors = flip * orientation[:, 0:3] * rowScale
+    columnVectors = flip * orientation[:, 3:6] * columnScale
+    return position * flip + pixelSeeds[:, 0:1] * rowVectors + pixelSeeds[:, 1:2] * columnVectors
+
+  def seedToRAS(self, seriesUID, instanceUID, seed):
+    return [float(value) for value in self.seedsToRAS(seriesUID, [instanceUID], [seed])[0]]
+
+class BulkDICOMIndexer:
+  """Index a directory of DICOM files into a ctkDICOMDatabase in batches.
+
+  Headers are read in a pool of worker threads, stopping before the
+  pixel data, to find each file's SOPInstanceUID.  Files that are not
+  DICOM, repeat an instance seen earlier or are already in the database
+  are skipped, and the rest are committed in batches of batchSize
+  through a ctkDICOMIndexer instead of one insert per file.  Commits
+  happen on the calling thread.
+
+  Threads rather than processes: forking the running Slicer would copy
+  a process that already has background threads, and spawned workers
+  cannot import this module outside of Slicer.
+  """
+
+  def __init__(self, database, batchSize=500, workers=None, scanChunkSize=100, insertBatch=None):
+    self.database = database
+    self.batchSize = batchSize
+    self.workers = workers or os.cpu_count() or 1
+    self.scanChunkSize = scanChunkSize
+    self.insertBatch = insertBatch or self.indexerInsertBatch
+    self.indexer = None
+    self.counters = collections.Counter()
+    self.timings = collections.Counter()
+
+  @staticmethod
+  def scanHeaders(filePaths):
+    """Return (filePath, sopInstanceUID) pairs, with None for files that are not DICOM"""
+    results = []
+    for filePath in filePaths:
+      try:
+        dataset = pydicom.dcmread(filePath, stop_before_pixels=True, specific_tags=['SOPInstanceUID'])
+        results.append((filePath, str(dataset.SOPInstanceUID)))
+      except Exception:
+        results.append((filePath, None))
+    return results
+
+  def indexerInsertBatch(self, filePaths):
+    if not self.indexer:
+      self.indexer = ctk.ctkDICOMIndexer()
+      self.indexer.database = self.database
+    # copied, since the files are usually in a temporary directory
+    self.indexer.addListOfFiles(filePaths, True)
+    if hasattr(self.indexer, 'waitForImportFinished'):
+      self.indexer.waitForImportFinished()
+
+  def inDatabase(self, instanceUID):
+    filePath = self.database.fileForInstance(instanceUID)
+    return filePath != '' and os.access(filePath, os.F_OK)
+
+  def commit(self, batch):
+    start = time.time()
+    self.insertBatch(list(batch))
+    self.timings['insert'] += time.time() - start
+    self.counters['inserted'] += len(batch)
+    self.counters['batches'] += 1
+    del batch[:]
+
+  def index(self, path):
+    """Index all files below path and return statistics()"""
+    filePaths = []
+    for root, subFolders, files in os.walk(path):
+      for file_ in files:
+        filePaths.append(os.path.join(root, file_))
+    return self.indexFiles(filePaths)
+
+  def indexFiles(self, filePaths, progress=None):
+    """Index the files and return statistics().  filePaths may be a
+    generator, e.g. of files as they are extracted; it is read only a
+    few chunks ahead of the header scans.  progress(statistics) is called
+    after each batch is committed."""
+    start = time.time()
+    seen = set()
+    batch = []
+
+    def chunks():
+      chunk = []
+      for filePath in filePaths:
+        self.counters['files'] += 1
+        chunk.append(filePath)
+        if len(chunk) >= self.scanChunkSize:
+          yield chunk
+          chunk = []
+      if chunk:
+        yield chunk
+
+    def add(results):
+      for filePath, instanceUID in results:
+        if instanceUID is None:
+          self.counters['skipped'] += 1
+        elif instanceUID in seen or self.inDatabase(instanceUID):
+          self.counters['duplicates'] += 1
+        else:
+          seen.add(instanceUID)
+          batch.append(filePath)
+          if len(batch) >= self.batchSize:
+            self.commit(batch)
+            if progress:
+              progress(self.statistics())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+      # results are used in order, headers for later chunks are read
+      # while earlier batches are committed
+      pending = collections.deque()
+      for chunk in chunks():
+        pending.append(executor.submit(self.scanHeaders, chunk))
+        if len(pending) > self.workers:
+          add(pending.popleft().result())
+      while pending:
+        add(pending.popleft().result())
+      if batch:
+        self.commit(batch)
+        if progress:
+          progress(self.statistics())
+    self.timings['total'] += time.time() - start
+    return self.statistics()
+
+  def statistics(self):
+    statistics = dict(self.counters)
+    for stage, seconds in self.timings.items():
+      statistics[stage + 'Seconds'] = seconds
+    if self.timings['total'] > 0:
+      statistics['filesPerSecond'] = self.counters['files'] / self.timings['total']
+    return statistics
+
+class FileCheckpoint:
+  """Keep the last processed sequence of a changes feed in a local file"""
+
+  def __init__(self, path):
+    self.path = path
+
+  def load(self):
+    try:
+      with open(self.path) as fp:
+        return json.load(fp)['seq']
+    except (IOError, ValueError, KeyError):
+      return None
+
+  def save(self, seq):
+    # write then rename so a crash never leaves a truncated file
+    tmpPath = self.path + '.tmp'
+    with open(tmpPath, 'w') as fp:
+      json.dump({'seq': seq}, fp)
+    os.replace(tmpPath, self.path)
+
+class LocalDocCheckpoint:
+  """Keep the last processed sequence of a changes feed in a _local
+  document, which lives in the database but is never replicated"""
+
+  def __init__(self, db, docID='_local/SlicerChronicle-checkpoint'):
+    self.db = db
+    self.docID = docID
+    self.doc = None
+
+  def load(self):
+    self.doc = self.db.get(self.docID)
+    if self.doc:
+      return self.doc.get('seq')
+    return None
+
+  def save(self, seq, retries=3):
+    for attempt in range(retries + 1):
+      if self.doc is None:
+        self.doc = self.db.get(self.docID) or {'_id': self.docID}
+      self.doc['seq'] = seq
+      try:
+        self.db.save(self.doc)
+        return
+      except couchdb.ResourceConflict:
+        # someone else wrote it, take their revision and try again
+        self.doc = None
+        if attempt == retries:
+          raise
+
 class CouchChanges:
   """Use the changes API of couchdb to
   trigger actions in slicer
+
+  The feed can be narrowed on the server, either with a design document
+  filter function (filter='ddoc/name') or with a Mango selector
+  (selector={'type': 'ch.step'}, needs CouchDB 2.0 or later), and
+  includeDocs=True delivers each changed document inline so callbacks
+  need not fetch it.  predicate is a client side check applied to every
+  decoded change before the callback; it is also the fallback when the
+  server rejects the selector.
+
+  With a checkpoint (see FileCheckpoint and LocalDocCheckpoint) the feed
+  resumes after the last change handled by a previous session instead of
+  at the current update_seq.  The checkpoint is written after every
+  checkpointEvery changes or checkpointInterval seconds, whichever comes
+  first, and on stop.  If the callback only queues work for a change,
+  pass pending=callable(docID) answering whether that work is still to
+  be done: the checkpoint then stops short of the first change (in feed
+  order) whose document is pending, so it is delivered again after a
+  restart.  If the connection fails or the feed closes it is reopened
+  from the last handled change, waiting reconnectDelay seconds and
+  doubling the wait after each failure up to maxReconnectDelay.
   """
 
-  def __init__(self,db,callback,filter=None):
+  def __init__(self,db,callback,filter=None,selector=None,includeDocs=False,predicate=None,
+               checkpoint=None,checkpointEvery=100,checkpointInterval=10.,
+               pending=None,reconnectDelay=1.,maxReconnectDelay=60.):
     self.db = db
     self.callback = callback
     self.filter = filter
-
-    update_seq = db.info()['update_seq']
-    api = "/_changes?feed=continuous"
-    args = "&since=%d" % update_seq
-    args += "&heartbeat=5000"
-    self.couchChangesURL = db.resource().url + api + args
+    self.selector = selector
+    self.includeDocs = includeDocs
+    self.predicate = predicate
+    self.filteredCount = 0
+    self.checkpoint = checkpoint
+    self.checkpointEvery = checkpointEvery
+    self.checkpointInterval = checkpointInterval
+    self.pending = pending
+    self.handled = collections.deque() # (seq, docID) not yet checkpointed
+    self.initialReconnectDelay = reconnectDelay
+    self.reconnectDelay = reconnectDelay
+    self.maxReconnectDelay = maxReconnectDelay
+    self.changesSocket = None
+    self.notifier = None
+    self.stopped = False
+    self.readBuffer = bytearray(64 * 1024)
+    self.readView = memoryview(self.readBuffer)
+
+    self.seq = None
+    if checkpoint:
+      self.seq = checkpoint.load()
+    if self.seq is None:
+      self.seq = db.info()['update_seq']
+    self.checkpointedSeq = self.seq
+    self.completedSeq = self.seq
+    self.changesSinceCheckpoint = 0
+    self.checkpointTime = time.time()
     self.start()
 
   def onSocketNotify(self,fileno):
-    line = self.changesSocket.readline().strip()
-    if line == "":
+    """Read everything the socket has without blocking and handle
+    each complete line; a partial line waits for the next call."""
+    if self.changesSocket is None:
+      return
+    closed = False
+    lines = []
+    while True:
+      try:
+        count = self.changesSocket.recv_into(self.readBuffer)
+      except (BlockingIOError, ssl.SSLWantReadError):
+        break
+      except OSError as e:
+        print('Lost the changes feed: %s' % e)
+        closed = True
+        break
+      if count == 0:
+        closed = True
+        break
+      lines.extend(self.framer.feed(self.readView[:count]))
+    for line in lines:
+      self.handleLine(line)
+    if closed or self.framer.finished:
+      # end of the stream, the server closed the feed
+      self.scheduleReconnect()
+
+  def handleLine(self,line):
+    if line == b"":
       # heartbeat
       #print('heartbeat')
-      pass
-    self.callback(self.db,line)
+      self.checkpointIfDue()
+      self.callback(self.db,line)
+      return
+    change = json.loads(line)
+    if self.predicate and not self.predicate(change):
+      self.filteredCount += 1
+    else:
+      self.callback(self.db,line)
+    self.changeHandled(change.get('seq', change.get('last_seq')), change.get('id'))
+
+  def changeHandled(self, seq, docID=None):
+    if seq is None:
+      return
+    self.seq = seq
+    if self.pending:
+      self.handled.append((seq, docID))
+    self.changesSinceCheckpoint += 1
+    if self.changesSinceCheckpoint >= self.checkpointEvery:
+      self.saveCheckpoint()
+    else:
+      self.checkpointIfDue()
+
+  def checkpointIfDue(self):
+    if time.time() - self.checkpointTime > self.checkpointInterval:
+      self.saveCheckpoint()
+
+  def saveCheckpoint(self):
+    self.changesSinceCheckpoint = 0
+    self.checkpointTime = time.time()
+    seq = self.safeSeq()
+    if self.checkpoint and seq != self.checkpointedSeq:
+      try:
+        self.checkpoint.save(seq)
+        self.checkpointedSeq = seq
+      except Exception as e:
+        print('Could not save changes checkpoint: %s' % e)
+
+  def safeSeq(self):
+    """The last seq before the first change whose work is pending"""
+    if self.pending is None:
+      return self.seq
+    while self.handled:
+      seq, docID = self.handled[0]
+      if docID is not None and self.pending(docID):
+        break
+      self.handled.popleft()
+      self.completedSeq = seq
+    return self.completedSeq
+
+  def changesRequest(self):
+    """Return (method, url, body, headers) for the feed with the
+    current filtering"""
+    if self.selector is not None:
+      body = json.dumps({'selector': self.selector}).encode()
+      return ('POST', self.couchChangesURL + "&filter=_selector",
+                body, {'Content-Type': 'application/json'})
+    if self.filter is not None:
+      return ('GET', self.couchChangesURL + "&filter=%s" % urllib.parse.quote(self.filter), None, {})
+    return ('GET', self.couchChangesURL, None, {})
+
+  def openFeed(self):
+    """Send the feed request and read the response headers.  Returns
+    the connection, its socket and the response."""
+    method, url, body, headers = self.changesRequest()
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == 'https':
+      connection = http.client.HTTPSConnection(parts.netloc, timeout=30)
+    else:
+      connection = http.client.HTTPConnection(parts.netloc, timeout=30)
+    connection.request(method, parts.path + '?' + parts.query, body, headers)
+    # keep the socket, the connection drops it if the response will close
+    sock = connection.sock
+    return connection, sock, connection.getresponse()
 
   def start(self):
     """start a connection to the continuous feed of
-    couchdb changes.
+    couchdb changes, from the last change handled.
     """
+    api = "/_changes?feed=continuous"
+    args = "&since=%s" % urllib.parse.quote(str(self.seq))
+    args += "&heartbeat=5000"
+    if self.includeDocs:
+      args += "&include_docs=true"
+    self.couchChangesURL = self.db.resource().url + api + args
+
     try:
-      self.changesSocket = urllib.request.urlopen(self.couchChangesURL)
-    except IOError as e:
-      print('Got an IOError trying to connect to the database')
+      connection, sock, response = self.openFeed()
+    except (IOError, http.client.HTTPException) as e:
+      print('Got an IOError trying to connect to the database: %s' % e)
+      self.scheduleReconnect()
+      return
+    if response.status >= 400:
+      reason = response.read()
+      connection.close()
+      if self.selector is not None and self.predicate is not None:
+        # e.g. CouchDB 1.x has no _selector filter
+        print('Server rejected the changes selector (%s), filtering in the client' % reason)
+        self.selector = None
+        return self.start()
+      print('Changes feed request failed: %d %s' % (response.status, reason))
+      self.scheduleReconnect()
+      return
+    self.reconnectDelay = self.initialReconnectDelay
+
+    self.connection = connection
+    self.response = response
+    self.changesSocket = sock
+    self.changesSocket.setblocking(False)
+    chunked = response.getheader('transfer-encoding', '').lower() == 'chunked'
+    self.framer = ChangesLineFramer(chunked=chunked)
+    # body bytes that arrived along with the headers are already buffered
+    try:
+      buffered = response.fp.read1(len(self.readBuffer))
+    except (BlockingIOError, ssl.SSLWantReadError):
+      buffered = b""
+    for line in self.framer.feed(buffered):
+      self.handleLine(line)
 
-    socketFileNumber = self.changesSocket.fp.fileno()
+    socketFileNumber = self.changesSocket.fileno()
     self.notifier = qt.QSocketNotifier(socketFileNumber, qt.QSocketNotifier.Read)
     self.notifier.connect('activated(int)', self.onSocketNotify)
 
+  def closeSocket(self):
+    if self.notifier:
+      self.notifier.setEnabled(False)
+      self.notifier = None
+    if self.changesSocket:
+      self.response.close()
+      self.connection.close()
+      self.changesSocket.close()
+      self.changesSocket = None
+
+  def scheduleReconnect(self):
+    self.closeSocket()
+    self.saveCheckpoint()
+    if self.stopped:
+      return
+    delay = self.reconnectDelay
+    self.reconnectDelay = min(2 * self.reconnectDelay, self.maxReconnectDelay)
+    print('Reconnecting to the changes feed in %g seconds' % delay)
+    qt.QTimer.singleShot(int(1000 * delay), self.reconnect)
+
+  def reconnect(self):
+    if not self.stopped:
+      self.start()
+
   def stop(self):
-    self.changesSocket.close()
-    self.notifier = None
+    self.stopped = True
+    self.closeSocket()
+    self.saveCheckpoint()
 
 class SlicerChronicleBrowser:
   """
@@ -852,10 +2522,37 @@ class SlicerChronicleContext:
   and chlib/context.js
 
   https://github.com/pieper/ch/blob/246a3ab9d7e533f2013b77c4b9afd0124a98b2f3/chlib/context.js#L17-L59
+
+  View responses are cached with their ETag and revalidated with
+  If-None-Match, over one keep-alive session.  A whole level of the
+  tree can be loaded in one request (loadLevel) after which its nodes
+  are expanded locally, and expanding levelThreshold or more nodes at
+  once loads the level automatically.  While watchChanges() is active
+  cached responses are used without revalidation and are dropped when a
+  changed instance mentions one of their UIDs.
+
+  The iter* methods page through a level instead (pageSize rows per
+  request, the next page fetched while the current one is consumed) so
+  browsing and export of large databases runs in bounded memory; pages
+  are not cached.
+
+  instanceDataset() reads instances that are not in the instance cache
+  straight into memory, and with headerOnly it requests only as many
+  leading bytes as the header needs.
   """
 
-  def __init__(self,chronicleDB):
+  contextView = "/_design/instances/_view/context"
+  seriesInstancesView = "/_design/instances/_view/seriesInstances"
+
+  def __init__(self,chronicleDB,instanceCache=None,session=None,levelThreshold=10,pageSize=1000,
+               headerBytes=64*1024,spoolBytes=64*1024**2):
     self.chronicleDB = chronicleDB
+    self.instanceCache = instanceCache or InstanceCache.shared()
+    self.session = session or requests.Session()
+    self.levelThreshold = levelThreshold
+    self.pageSize = pageSize
+    self.headerBytes = headerBytes
+    self.spoolBytes = spoolBytes
 
     self._commonOptions = {
       'reduce': 'true',
@@ -865,84 +2562,294 @@ class SlicerChronicleContext:
       'endkey': '',
     }
 
+    self.cache = {} # request -> {'etag', 'rows', 'strings', 'ranged'}
+    self.levels = {} # group level -> request key of the loaded level
+    self.changes = None
+    self.counters = collections.Counter()
+
+  def keyStrings(self,value,strings):
+    """Collect the strings in a (nested) key"""
+    if isinstance(value, str):
+      strings.add(value)
+    elif isinstance(value, (list, tuple)):
+      for item in value:
+        self.keyStrings(item, strings)
+    return strings
+
+  def requestKey(self,view,params,keys=None):
+    return json.dumps([view, params, keys], sort_keys=True)
+
+  def cachedView(self,view,params,keys=None):
+    """Cache entry for a view query, revalidated unless the changes
+    feed is watched.  With keys the query is a POST of {'keys': keys}."""
+    request = self.requestKey(view, params, keys)
+    entry = self.cache.get(request)
+    if entry and self.changes:
+      self.counters['hits'] += 1
+      return entry
+    headers = {}
+    if entry and entry['etag']:
+      headers['If-None-Match'] = entry['etag']
+    url = self.chronicleDB.resource().url + view
+    self.counters['requests'] += 1
+    if keys is None:
+      response = self.session.get(url, params=params, headers=headers)
+    else:
+      response = self.session.post(url, params=params, json={'keys': keys}, headers=headers)
+    if response.status_code == 304 and entry:
+      self.counters['notModified'] += 1
+      return entry
+    response.raise_for_status()
+    rows = response.json().get('rows', [])
+    strings = self.keyStrings([row['key'] for row in rows], set())
+    self.keyStrings([params.get('startkey', ''), params.get('key', ''), keys or []], strings)
+    entry = {
+      'etag': response.headers.get('ETag'),
+      'rows': rows,
+      'strings': strings,
+      'ranged': 'startkey' in params or 'key' in params or keys is not None,
+    }
+    self.cache[request] = entry
+    return entry
 
-  def viewList(self,options):
-    """Returns the list associated with the passed options"""
+  def viewRows(self,view,params,keys=None):
+    return self.cachedView(view, params, keys)['rows']
 
-    # construct the url to fetch the seriesList for this study
-    api = "/_design/instances/_view/context?reduce=%s" % options['reduce']
+  def contextParams(self,options):
+    params = {'reduce': options['reduce'], 'stale': options['stale']}
     if options['reduce'] == 'true':
-      args = '&group_level=%s' % options['group_level']
+      params['group_level'] = options['group_level']
     if options['startkey'] != '':
-      args += '&startkey=%s' % json.dumps(options['startkey'])
+      params['startkey'] = json.dumps(options['startkey'])
     if options['endkey'] != '':
-      args += '&endkey=%s' % json.dumps(options['endkey'])
-    args += '&stale=%s' % options['stale']
-
-    # each row is an entry and the key contains the UID and descriptions
-    viewListURL = self.chronicleDB.resource().url + api + args
-    print(viewListURL)
-    request = requests.get(viewListURL)
-    viewList = json.loads(request.text)
-    if 'rows' in viewList:
-      return(viewList['rows'])
-    else:
-      return([])
+      params['endkey'] = json.dumps(options['endkey'])
+    return params
 
+  def viewList(self,options):
+    """Returns the list associated with the passed options"""
+    return self.viewRows(self.contextView, self.contextParams(options))
+
+  def levelOptions(self,groupLevel,parent=None):
+    options = dict(self._commonOptions)
+    options['group_level'] = str(groupLevel)
+    if parent is not None:
+      options['startkey'] = parent
+      options['endkey'] = list(parent)
+      options['endkey'].append({})
+    return options
+
+  def loadLevel(self,groupLevel):
+    """Fetch every node of a level (1 patients, 2 studies, 3 series)
+    in one request and index them by parent"""
+    params = self.contextParams(self.levelOptions(groupLevel))
+    entry = self.cachedView(self.contextView, params)
+    if entry.get('children') is None:
+      children = collections.OrderedDict()
+      for row in entry['rows']:
+        children.setdefault(json.dumps(row['key'][:groupLevel-1]), []).append(row)
+      entry['children'] = children
+    self.levels[groupLevel] = self.requestKey(self.contextView, params)
+    return entry['children']
+
+  def levelLoaded(self,groupLevel):
+    return self.levels.get(groupLevel) in self.cache
+
+  def children(self,parents,groupLevel):
+    """Return a list of child rows for each parent key"""
+    if len(parents) >= self.levelThreshold or self.levelLoaded(groupLevel):
+      children = self.loadLevel(groupLevel)
+      return [children.get(json.dumps(list(parent)), []) for parent in parents]
+    return [self.viewList(self.levelOptions(groupLevel, parent)) for parent in parents]
 
   def patients(self):
     """returns a list of patients
     patient is a tuple of [institution,mrn]
     """
-    options = dict(self._commonOptions)
-    options['group_level'] = '1'
-    return self.viewList(options)
+    return self.viewList(self.levelOptions(1))
 
   def studiesForPatient(self,patient):
     """returns a list of studies
     """
-    options = dict(self._commonOptions)
-    options['group_level'] = '2'
-    options['startkey'] = patient
-    options['endkey'] = list(patient)
-    options['endkey'].append({})
-    return self.viewList(options)
+    return self.children([patient], 2)[0]
+
+  def studiesForPatients(self,patients):
+    """returns a list of studies for each patient"""
+    return self.children(patients, 2)
 
   def seriesForStudy(self,study):
     """returns a list of series
     """
-    options = dict(self._commonOptions)
-    options['group_level'] = '3'
-    options['startkey'] = study
-    options['endkey'] = list(study)
-    options['endkey'].append({})
-    return self.viewList(options)
+    return self.children([study], 3)[0]
+
+  def seriesForStudies(self,studies):
+    """returns a list of series for each study"""
+    return self.children(studies, 3)
 
   def instancesForSeries(self,series):
     """returns a list of instances
     """
-    api = "/_design/instances/_view/seriesInstances?reduce=false"
     seriesUID = series[2][2]
-    args = '&key="%s"' % seriesUID
-    seriesInstancesURL = self.chronicleDB.resource().url + api + args
-    request = requests.get(seriesInstancesURL)
-    print(seriesInstancesURL)
-    print(request.text)
-    instances = json.loads(request.text)['rows']
-    return instances
-
-  def instanceDataset(self,instance):
+    return self.viewRows(self.seriesInstancesView, {'reduce': 'false', 'key': json.dumps(seriesUID)})
+
+  def instancesForSeriesList(self,seriesList):
+    """returns a list of instances for each series, in one request"""
+    seriesUIDs = [series[2][2] for series in seriesList]
+    rows = self.viewRows(self.seriesInstancesView, {'reduce': 'false'}, keys=seriesUIDs)
+    instances = collections.OrderedDict([(seriesUID, []) for seriesUID in seriesUIDs])
+    for row in rows:
+      instances[row['key']].append(row)
+    return list(instances.values())
+
+  def pages(self,view,params,pageSize=None,prefetch=True):
+    """Yield the rows of a view query, fetching pageSize + 1 rows per
+    request and starting the next request at the extra row, as
+    Database.iterview does.  With prefetch the next page is requested in
+    the background while this one is consumed, so at most two pages are
+    held.  Rows changed between pages may be missed or repeated."""
+    pageSize = pageSize or self.pageSize
+    if pageSize <= 0:
+      raise ValueError('pageSize must be 1 or more')
+    url = self.chronicleDB.resource().url + view
+
+    def fetch(params):
+      self.counters['pages'] += 1
+      response = self.session.get(url, params=dict(params, limit=str(pageSize + 1)))
+      response.raise_for_status()
+      return response.json().get('rows', [])
+
+    def following(rows):
+      if len(rows) <= pageSize:
+        return None
+      start = rows[pageSize]
+      nextParams = dict(params, startkey=json.dumps(start['key']))
+      if 'id' in start:
+        nextParams['startkey_docid'] = start['id']
+      return nextParams
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+      rows = fetch(params)
+      while True:
+        nextParams = following(rows)
+        nextPage = None
+        if nextParams and executor:
+          nextPage = executor.submit(fetch, nextParams)
+        for row in rows[:pageSize]:
+          yield row
+        if not nextParams:
+          break
+        rows = nextPage.result() if nextPage else fetch(nextParams)
+    finally:
+      if executor:
+        executor.shutdown(wait=False)
+
+  def iterLevel(self,groupLevel,parent=None,pageSize=None,prefetch=True):
+    """Yield the nodes of a level (1 patients, 2 studies, 3 series),
+    optionally only those under parent, page by page"""
+    params = self.contextParams(self.levelOptions(groupLevel, parent))
+    return self.pages(self.contextView, params, pageSize, prefetch)
+
+  def iterPatients(self,pageSize=None,prefetch=True):
+    return self.iterLevel(1, None, pageSize, prefetch)
+
+  def iterStudies(self,patient=None,pageSize=None,prefetch=True):
+    return self.iterLevel(2, patient, pageSize, prefetch)
+
+  def iterSeries(self,study=None,pageSize=None,prefetch=True):
+    return self.iterLevel(3, study, pageSize, prefetch)
+
+  def iterInstances(self,series,pageSize=None,prefetch=True):
+    """Yield the instances of a series page by page"""
+    seriesUID = json.dumps(series[2][2])
+    params = {'reduce': 'false', 'startkey': seriesUID, 'endkey': seriesUID}
+    return self.pages(self.seriesInstancesView, params, pageSize, prefetch)
+
+  def watchChanges(self):
+    """Trust cached responses, invalidating them from the changes feed"""
+    if not self.changes:
+      self.changes = CouchChanges(self.chronicleDB, self.onChange, includeDocs=True)
+
+  def stopWatchingChanges(self):
+    if self.changes:
+      self.changes.stop()
+      self.changes = None
+
+  def onChange(self,db,line):
+    if line == b"":
+      return
+    change = json.loads(line.decode())
+    if 'id' not in change:
+      return
+    self.invalidate(change.get('doc'))
+
+  def invalidate(self,doc=None):
+    """Drop the cached responses a changed instance document may affect.
+    Whole level queries are always dropped, ranged ones only if they
+    mention one of the document's values; without a document (e.g. a
+    deletion) everything is dropped."""
+    if not doc or 'dataset' not in doc:
+      self.counters['invalidated'] += len(self.cache)
+      self.cache.clear()
+      return
+    strings = set()
+    for element in doc['dataset'].values():
+      self.keyStrings(element.get('Value') if isinstance(element, dict) else None, strings)
+    for request, entry in list(self.cache.items()):
+      if not entry['ranged'] or entry['strings'] & strings:
+        del self.cache[request]
+        self.counters['invalidated'] += 1
+
+  def instanceDataset(self,instance,headerOnly=False):
     """returns a pydicom dataset for the instance
+    (without the pixel data if headerOnly)
     """
     classUID,instanceUID = instance['value']
-    doc = self.chronicleDB[instanceUID]
-    instanceURL = self.chronicleDB.resource().url + '/' + doc['_id'] + "/object.dcm"
-    instanceFileName = doc['_id']
-    tmpdir = tempfile.mkdtemp()
-    instanceFilePath = os.path.join(tmpdir, instanceFileName)
-    urllib.request.urlretrieve(instanceURL, instanceFilePath)
-    ds = pydicom.read_file(instanceFilePath)
-    return ds
+    instanceFilePath = self.instanceCache.cachedPath(instanceUID)
+    if instanceFilePath:
+      return pydicom.dcmread(instanceFilePath, stop_before_pixels=headerOnly)
+    instanceURL = self.chronicleDB.resource().url + '/' + instanceUID + "/object.dcm"
+    if headerOnly:
+      return self.instanceHeader(instanceURL)
+    # in memory up to spoolBytes, then in an anonymous temporary file
+    response = self.session.get(instanceURL, stream=True, timeout=60)
+    try:
+      response.raise_for_status()
+      with tempfile.SpooledTemporaryFile(max_size=self.spoolBytes) as spool:
+        for chunk in response.iter_content(chunk_size=1024*128):
+          spool.write(chunk)
+        self.counters['bytes'] += spool.tell()
+        spool.seek(0)
+        return pydicom.dcmread(spool)
+    finally:
+      response.close()
+
+  def instanceHeader(self,instanceURL):
+    """Parse an instance up to its pixel data from a Range request for
+    the first headerBytes, requesting four times as much until the
+    header ends within the bytes received"""
+    import io
+    size = self.headerBytes
+    while True:
+      response = self.session.get(instanceURL, headers={'Range': 'bytes=0-%d' % (size - 1)},
+                                  stream=True, timeout=60)
+      data = bytearray()
+      try:
+        response.raise_for_status()
+        # a server without range support sends everything; read only the start
+        for chunk in response.iter_content(chunk_size=min(size, 1024*128)):
+          data += chunk
+          if len(data) >= size:
+            break
+      finally:
+        response.close()
+      self.counters['bytes'] += len(data)
+      self.counters['headerRequests'] += 1
+      headerFile = io.BytesIO(bytes(data))
+      dataset = pydicom.dcmread(headerFile, stop_before_pixels=True)
+      # reading stops at the pixel data, or at the end of what was received
+      if len(data) < size or headerFile.tell() < len(data):
+        return dataset
+      size *= 4
 
 
 class SlicerChronicleTest(unittest.TestCase):
@@ -1034,6 +2941,9 @@ class SlicerChronicleTest(unittest.TestCase):
     dataset = context.instanceDataset(instanceZero)
     self.delayDisplay("instance Zero is a " + dataset.SOPClassUID + " ", 200)
 
+    logic.cleanup()
+    self.assertFalse(logic.progressReporter.thread.is_alive())
+
 
   def test_SlicerChronicleWeb(self):
     """
@@ -0,0 +1,293 @@
+import asyncio
+import collections
+import couchdb
+import json
+import ssl
+import urllib.parse
+
+class AsyncSession:
+  """An asyncio counterpart of couchdb.http.Session for fan-out work.
+
+  Requests are HTTP/1.1 over keep-alive connections from
+  asyncio.open_connection, at most maxConnections per host, so hundreds
+  of requests can be in flight from one thread.  The semantics follow
+  couchdb.http: GET responses with an ETag are cached (within cacheBytes,
+  least recently used first) and revalidated with If-None-Match,
+  redirects are followed up to maxRedirects, error statuses raise the
+  couchdb exceptions, and failed connections are retried after each of
+  retryDelays.  A request that may have reached the server is only
+  retried when its method is idempotent, so a POST is never sent twice.
+  Use one session per event loop.
+  """
+
+  retryableErrors = (ConnectionError, asyncio.IncompleteReadError, OSError)
+  idempotentMethods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+  def __init__(self, maxConnections=50, timeout=60, maxRedirects=5, retryDelays=(0,), cacheBytes=4*1024*1024):
+    self.maxConnections = maxConnections
+    self.timeout = timeout
+    self.maxRedirects = maxRedirects
+    self.retryDelays = list(retryDelays)
+    self.cacheBytes = cacheBytes
+    self.cache = collections.OrderedDict() # url -> (etag, status, headers, body)
+    self.cacheSize = 0
+    self.idle = {} # (scheme, host, port) -> [(reader, writer)]
+    self.slots = {} # (scheme, host, port) -> asyncio.Semaphore
+    self.counters = collections.Counter()
+
+  async def close(self):
+    for connections in self.idle.values():
+      for reader, writer in connections:
+        writer.close()
+    self.idle.clear()
+
+  async def request(self, method, url, body=None, headers=None, redirects=0):
+    """Return (status, headers, body bytes) of the response"""
+    method = method.upper()
+    headers = dict(headers or {})
+    headers.setdefault('Accept', 'application/json')
+    if body is not None and not isinstance(body, (bytes, str)):
+      body = json.dumps(body)
+      headers.setdefault('Content-Type', 'application/json')
+    if isinstance(body, str):
+      body = body.encode('utf-8')
+    cached = self.cache.get(url) if method in ('GET', 'HEAD') else None
+    if cached:
+      headers['If-None-Match'] = cached[0]
+
+    delays = iter(self.retryDelays)
+    while True:
+      try:
+        status, responseHeaders, responseBody = await asyncio.wait_for(
+                                self.exchange(method, url, body, headers), self.timeout)
+        break
+      except self.retryableErrors as e:
+        delay = next(delays, None)
+        if delay is None or (getattr(e, 'requestSent', True) and method not in self.idempotentMethods):
+          raise
+        self.counters['retries'] += 1
+        await asyncio.sleep(delay)
+
+    # concurrent requests for the url may have replaced or evicted the
+    # entry read before the exchange
+    if status == 304 and cached:
+      self.counters['revalidated'] += 1
+      if url in self.cache:
+        self.cache.move_to_end(url)
+      return cached[1:]
+    if url in self.cache:
+      self.uncache(url)
+    if status in (301, 302, 303, 307) and 'location' in responseHeaders:
+      if redirects >= self.maxRedirects:
+        raise couchdb.http.RedirectLimit('Redirection limit exceeded')
+      if status == 303:
+        method, body = 'GET', None
+      location = urllib.parse.urljoin(url, responseHeaders['location'])
+      return await self.request(method, location, body, headers, redirects + 1)
+    if status >= 400:
+      error = responseBody
+      if 'application/json' in responseHeaders.get('content-type', ''):
+        error = json.loads(responseBody.decode('utf-8'))
+        error = error.get('error'), error.get('reason')
+      if status == 401:
+        raise couchdb.Unauthorized(error)
+      elif status == 404:
+        raise couchdb.ResourceNotFound(error)
+      elif status == 409:
+        raise couchdb.ResourceConflict(error)
+      elif status == 412:
+        raise couchdb.PreconditionFailed(error)
+      raise couchdb.ServerError((status, error))
+    if method == 'GET' and 'etag' in responseHeaders and len(responseBody) <= self.cacheBytes:
+      self.cache[url] = (responseHeaders['etag'], status, responseHeaders, responseBody)
+      self.cacheSize += len(responseBody)
+      while self.cacheSize > self.cacheBytes:
+        self.uncache(next(iter(self.cache)))
+    return status, responseHeaders, responseBody
+
+  def uncache(self, url):
+    self.cacheSize -= len(self.cache.pop(url)[3])
+
+  async def exchange(self, method, url, body, headers):
+    """Send one request on a pooled connection and read the response"""
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    key = (parts.scheme, parts.hostname, port)
+    slots = self.slots.setdefault(key, asyncio.Semaphore(self.maxConnections))
+    path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % parts.netloc]
+    lines += ['%s: %s' % item for item in headers.items()]
+    lines.append('Content-Length: %d' % len(body or b''))
+    message = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+    async with slots:
+      idle = self.idle.setdefault(key, [])
+      while idle and (idle[-1][0].at_eof() or idle[-1][1].is_closing()):
+        # closed by the server while idle
+        idle.pop()[1].close()
+        self.counters['stale'] += 1
+      reused = bool(idle)
+      while True:
+        if reused:
+          reader, writer = idle.pop()
+          self.counters['reused'] += 1
+        else:
+          try:
+            reader, writer = await asyncio.open_connection(parts.hostname, port,
+                                    ssl=ssl.create_default_context() if parts.scheme == 'https' else None)
+          except self.retryableErrors as e:
+            e.requestSent = False
+            raise
+          self.counters['connections'] += 1
+        try:
+          writer.write(message)
+          status, responseHeaders, responseBody, keepAlive = await self.readResponse(reader, method)
+          break
+        except self.retryableErrors as e:
+          writer.close()
+          if reused and getattr(e, 'unanswered', False) and method in self.idempotentMethods:
+            # the server gave up on the idle connection as we used it; try
+            # once more on a new one, in the slot we hold
+            self.counters['stale'] += 1
+            reused = False
+            continue
+          raise
+        except:
+          writer.close()
+          raise
+      if keepAlive:
+        idle.append((reader, writer))
+      else:
+        writer.close()
+    self.counters['requests'] += 1
+    return status, responseHeaders, responseBody
+
+  async def readResponse(self, reader, method):
+    try:
+      statusLine = await reader.readuntil(b'\r\n')
+    except (asyncio.IncompleteReadError, ConnectionResetError) as e:
+      # closed without answering, as an idle connection the server gave up on is
+      e.unanswered = not getattr(e, 'partial', b'')
+      raise
+    version, status = statusLine.split(None, 2)[:2]
+    status = int(status)
+    headers = {}
+    while True:
+      line = await reader.readuntil(b'\r\n')
+      if line == b'\r\n':
+        break
+      name, value = line.decode('latin-1').split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+    keepAlive = headers.get('connection', '').lower() != 'close' and version != b'HTTP/1.0'
+    if method == 'HEAD' or status in (204, 304) or status < 200:
+      body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+      body = bytearray()
+      while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+        if size == 0:
+          while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass # trailers
+          break
+        body += await reader.readexactly(size + 2)
+        del body[-2:]
+      body = bytes(body)
+    elif 'content-length' in headers:
+      body = await reader.readexactly(int(headers['content-length']))
+    else:
+      body = await reader.read()
+      keepAlive = False
+    return status, headers, body, keepAlive
+
+class AsyncResource:
+  """A URL on an AsyncSession, like couchdb.http.Resource"""
+
+  def __init__(self, url, session):
+    self.url = url.rstrip('/')
+    self.session = session
+
+  def __call__(self, *path):
+    return AsyncResource(self.url + ''.join(['/' + urllib.parse.quote(str(segment), safe='') for segment in path]),
+                         self.session)
+
+  def requestURL(self, path, params):
+    url = self.url if path is None else self(*([path] if isinstance(path, str) else path)).url
+    params = {name: (json.dumps(value) if not isinstance(value, str) else value)
+                for name, value in params.items() if value is not None}
+    return url + ('?' + urllib.parse.urlencode(params) if params else '')
+
+  async def request(self, method, path=None, body=None, headers=None, **params):
+    return await self.session.request(method, self.requestURL(path, params), body, headers)
+
+  async def requestJSON(self, method, path=None, body=None, headers=None, **params):
+    status, headers, data = await self.request(method, path, body, headers, **params)
+    if 'application/json' in headers.get('content-type', ''):
+      data = json.loads(data.decode('utf-8'))
+    return status, headers, data
+
+  async def get(self, path=None, headers=None, **params):
+    return await self.request('GET', path, headers=headers, **params)
+
+  async def get_json(self, path=None, headers=None, **params):
+    return await self.requestJSON('GET', path, headers=headers, **params)
+
+  async def put_json(self, path=None, body=None, headers=None, **params):
+    return await self.requestJSON('PUT', path, body, headers, **params)
+
+  async def post_json(self, path=None, body=None, headers=None, **params):
+    return await self.requestJSON('POST', path, body, headers, **params)
+
+  async def delete_json(self, path=None, headers=None, **params):
+    return await self.requestJSON('DELETE', path, headers=headers, **params)
+
+class AsyncDatabase:
+  """The document calls of couchdb.Database as coroutines, so that many
+  can be gathered at once:
+
+    async def fetch(url, ids):
+      db = AsyncDatabase(url)
+      try:
+        return await db.getMany(ids)
+      finally:
+        await db.session.close()
+    docs = asyncio.run(fetch(url, ids))
+  """
+
+  def __init__(self, url, session=None):
+    self.session = session or AsyncSession()
+    self.resource = AsyncResource(url, self.session)
+
+  async def get(self, id, default=None, **options):
+    try:
+      status, headers, doc = await self.resource.get_json(id, **options)
+    except couchdb.ResourceNotFound:
+      return default
+    return doc
+
+  async def getMany(self, ids, default=None):
+    """Fetch all the documents concurrently, in the order of ids"""
+    return await asyncio.gather(*[self.get(id, default) for id in ids])
+
+  async def save(self, doc):
+    """Create or update the document, returning (id, rev)"""
+    if '_id' in doc:
+      status, headers, data = await self.resource.put_json(doc['_id'], body=doc)
+    else:
+      status, headers, data = await self.resource.post_json(body=doc)
+    doc['_id'], doc['_rev'] = data['id'], data['rev']
+    return data['id'], data['rev']
+
+  async def delete(self, doc):
+    await self.resource.delete_json(doc['_id'], rev=doc['_rev'])
+
+  async def getAttachment(self, id, filename, default=None):
+    try:
+      status, headers, data = await self.resource(id, filename).get()
+    except couchdb.ResourceNotFound:
+      return default
+    return data
+
+  async def view(self, name, **options):
+    """Return the rows of design/view name"""
+    design, view = name.split('/')
+    status, headers, data = await self.resource('_design', design, '_view', view).get_json(**options)
+    return data['rows']
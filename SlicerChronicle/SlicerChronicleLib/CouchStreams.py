@@ -0,0 +1,195 @@
+"""Incremental decoding of couchdb responses as their bytes arrive.
+
+ViewRowParser is shared by the SlicerChronicle module (Python 3, fed
+from requests) and the couchdb client bundled with it (Python 2,
+couchdb.client.RowStream), so this file must stay importable by both.
+"""
+
+import codecs
+import re
+
+class ViewRowParser:
+  """Decode the rows of a couchdb view response as its body arrives.
+
+  feed() returns the rows completed by each piece of the body, so rows
+  can be used before the response has finished and a response can be
+  abandoned part way.  Only the unparsed tail of the body is kept.  The
+  other top level fields are collected in fields as they are seen;
+  couchdb sends total_rows and offset before the first row.
+
+  Rows are decoded with decode, couchdb.json.decode by default, so that
+  a decoder chosen with couchdb.json.use() applies.  Couchdb sends
+  one row per line and strings can't hold a raw newline, so the rows up
+  to the last newline of each piece are decoded together; otherwise
+  each row's end is found by scanning brackets outside of strings.
+  """
+
+  separator = re.compile(r'[\s,]*')
+  token = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+
+  @classmethod
+  def valueEnd(cls, text, position):
+    """Return the end of the object or array starting at position, or
+    -1 if it has not all arrived"""
+    depth = 0
+    for match in cls.token.finditer(text, position):
+      character = match.group()[0]
+      if character in '{[':
+        depth += 1
+      elif character in '}]':
+        depth -= 1
+        if depth == 0:
+          return match.end()
+    return -1
+
+  def __init__(self, decode=None):
+    if decode is None:
+      import couchdb.json
+      decode = couchdb.json.decode
+    self.decode = decode
+    self.text = ''
+    # Python 2 callers feed and decode str
+    self.utf8 = codecs.getincrementaldecoder('utf-8')() if bytes is not str else None
+    self.fields = {}
+    self.state = 'head'
+
+  @property
+  def totalRows(self):
+    return self.fields.get('total_rows')
+
+  @property
+  def offset(self):
+    return self.fields.get('offset')
+
+  def feed(self, data):
+    """Add a piece of the body and return the list of complete rows"""
+    self.text += self.utf8.decode(data) if self.utf8 else data
+    rows = []
+    if self.state == 'head':
+      start = self.text.find('"rows"')
+      bracket = self.text.find('[', start) if start >= 0 else -1
+      if bracket < 0:
+        return rows
+      self.fields.update(self.decode(self.text[:start].rstrip().rstrip(',') + '}'))
+      self.text = self.text[bracket + 1:]
+      self.state = 'rows'
+    if self.state == 'rows':
+      text = self.text
+      position = self.separator.match(text).end()
+      cut = text.rfind('\n')
+      batch = text[position:cut].rstrip().rstrip(',') if cut > position else ''
+      if batch:
+        try:
+          rows.extend(self.decode('[' + batch + ']'))
+          position = cut
+        except ValueError:
+          pass # the end of the rows, or not one row per line
+      while True:
+        position = self.separator.match(text, position).end()
+        if position == len(text):
+          break
+        if text[position] == ']':
+          position += 1
+          self.state = 'tail'
+          break
+        end = self.valueEnd(text, position)
+        if end < 0:
+          break # the rest of the row has not arrived
+        try:
+          rows.append(self.decode(text[position:end]))
+        except ValueError:
+          break # a bracket inside a string that has not ended
+        position = end
+      self.text = text[position:]
+    return rows
+
+  def close(self):
+    """Read the fields after the rows once the body has ended"""
+    if self.state == 'head':
+      raise ValueError('No rows in view response')
+    if self.state != 'tail':
+      raise ValueError('Truncated view response')
+    self.fields.update(self.decode('{' + self.text.strip().lstrip(',')))
+    self.text = ''
+    self.state = 'closed'
+
+  def rows(self, session, url, params=None, keys=None, chunkSize=1024*16, timeout=60):
+    """Request a view with a requests session and yield its rows as they
+    arrive.  Closing the generator early closes the response without
+    reading the rest."""
+    if keys is None:
+      response = session.get(url, params=params, stream=True, timeout=timeout)
+    else:
+      response = session.post(url, params=params, json={'keys': keys}, stream=True, timeout=timeout)
+    try:
+      response.raise_for_status()
+      for chunk in response.iter_content(chunk_size=chunkSize):
+        for row in self.feed(chunk):
+          yield row
+      self.close()
+    finally:
+      response.close()
+
+class ChangesLineFramer:
+  """Split the body of a changes feed into lines as bytes arrive.
+
+  Bytes can be fed in pieces of any size, straight from the socket.
+  Chunked transfer encoding is decoded here, and any trailing partial
+  line is kept until the rest of it arrives.  The buffers are compacted
+  once per feed() rather than once per line.
+  """
+
+  def __init__(self, chunked=True):
+    self.chunked = chunked
+    self.raw = bytearray() # transfer encoded bytes not yet decoded
+    self.body = bytearray() # decoded bytes after the last newline
+    self.chunkRemaining = 0
+    self.chunkTrailer = False
+    self.finished = False
+
+  def feed(self, data):
+    """Add data and return the list of complete lines, stripped"""
+    if self.chunked:
+      self.raw += data
+      self.decodeChunks()
+    else:
+      self.body += data
+    lines = []
+    body = self.body
+    start = 0
+    end = body.find(b'\n')
+    while end >= 0:
+      lines.append(bytes(body[start:end]).strip())
+      start = end + 1
+      end = body.find(b'\n', start)
+    del body[:start]
+    return lines
+
+  def decodeChunks(self):
+    raw = self.raw
+    position = 0
+    while not self.finished:
+      if self.chunkRemaining > 0:
+        count = min(self.chunkRemaining, len(raw) - position)
+        if count == 0:
+          break
+        self.body += raw[position:position + count]
+        position += count
+        self.chunkRemaining -= count
+        self.chunkTrailer = self.chunkRemaining == 0
+      elif self.chunkTrailer:
+        # CRLF after the chunk data
+        if len(raw) - position < 2:
+          break
+        position += 2
+        self.chunkTrailer = False
+      else:
+        end = raw.find(b'\r\n', position)
+        if end < 0:
+          break
+        size = int(bytes(raw[position:end]).split(b';')[0], 16)
+        position = end + 2
+        if size == 0:
+          self.finished = True
+        self.chunkRemaining = size
+    del raw[:position]
@@ -0,0 +1,130 @@
+import numpy
+
+from __main__ import vtk, slicer
+
+class OffscreenRenderer:
+  """Render lightbox mosaics of volumes straight from their voxel
+  arrays, without slice views, the layout manager or processEvents.
+
+  Slices are cut along the array axis closest to each orientation's
+  normal, so oblique acquisitions are shown in their own slice planes,
+  and are flipped to match Slicer's slice views (patient left on the
+  right of axial and coronal views, anterior on the left of sagittal
+  views, superior or anterior at the top).  Each slice is resampled to
+  square pixels by nearest neighbour lookup, windowed to 8 bits and
+  placed in a tile of a mosaic that is encoded as jpeg with VTK.
+  """
+
+  # RAS axis of the slice normal, and the RAS axis and direction of
+  # increasing screen rows (down) and columns (right)
+  orientations = {
+    'Axial': {'normal': 2, 'down': (1, -1), 'right': (0, -1)},
+    'Sagittal': {'normal': 0, 'down': (2, -1), 'right': (1, -1)},
+    'Coronal': {'normal': 1, 'down': (2, -1), 'right': (0, -1)},
+  }
+
+  def __init__(self, tileSize=256, rows=4, columns=6, quality=90):
+    self.tileSize = tileSize
+    self.rows = rows
+    self.columns = columns
+    self.quality = quality
+
+  def volumeArray(self, volumeNode):
+    """Return (array, ijkToRAS, window, level) for a scalar volume node"""
+    array = slicer.util.arrayFromVolume(volumeNode)
+    matrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(matrix)
+    ijkToRAS = numpy.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+    window, level = None, None
+    displayNode = volumeNode.GetDisplayNode()
+    if displayNode and not displayNode.GetAutoWindowLevel():
+      window, level = displayNode.GetWindow(), displayNode.GetLevel()
+    return array, ijkToRAS, window, level
+
+  def orient(self, array, ijkToRAS, orientation):
+    """Reorder a (k,j,i) array to (slice, down, right) in display order.
+    Returns the view and the (down, right) pixel spacing."""
+    axes = self.orientations[orientation]
+    ijk = array.transpose(2, 1, 0)
+    directions = ijkToRAS[:3, :3]
+    normalAxis = int(numpy.argmax(numpy.abs(directions[axes['normal']])))
+    remaining = [axis for axis in range(3) if axis != normalAxis]
+    rightAxis = max(remaining, key=lambda axis: abs(directions[axes['right'][0], axis]))
+    downAxis = [axis for axis in remaining if axis != rightAxis][0]
+    view = ijk.transpose(normalAxis, downAxis, rightAxis)
+    if directions[axes['normal'], normalAxis] < 0:
+      view = view[::-1]
+    if directions[axes['down'][0], downAxis] * axes['down'][1] < 0:
+      view = view[:, ::-1]
+    if directions[axes['right'][0], rightAxis] * axes['right'][1] < 0:
+      view = view[:, :, ::-1]
+    spacing = numpy.linalg.norm(directions, axis=0)
+    return view, (spacing[downAxis], spacing[rightAxis])
+
+  def windowLevel(self, array, window=None, level=None):
+    if window is None or level is None:
+      low, high = numpy.percentile(array[::4, ::4, ::4], (1, 99))
+      window, level = max(high - low, 1), (high + low) / 2.
+    return window, level
+
+  def tile(self, image, spacing, window, level):
+    """Scale a 2D slice to fit a square tile, keeping its aspect ratio"""
+    height, width = image.shape[0] * spacing[0], image.shape[1] * spacing[1]
+    scale = self.tileSize / max(height, width)
+    outputRows = max(1, int(round(height * scale)))
+    outputColumns = max(1, int(round(width * scale)))
+    rowIndices = ((numpy.arange(outputRows) + 0.5) * image.shape[0] / outputRows).astype(int)
+    columnIndices = ((numpy.arange(outputColumns) + 0.5) * image.shape[1] / outputColumns).astype(int)
+    resampled = image[rowIndices[:, None], columnIndices[None, :]]
+    scaled = (resampled.astype(numpy.float32) - (level - window / 2.)) * (255. / window)
+    tile = numpy.zeros((self.tileSize, self.tileSize), dtype=numpy.uint8)
+    top = (self.tileSize - outputRows) // 2
+    left = (self.tileSize - outputColumns) // 2
+    tile[top:top+outputRows, left:left+outputColumns] = numpy.clip(scaled, 0, 255)
+    return tile
+
+  def mosaic(self, tiles, columns):
+    rows = (len(tiles) + columns - 1) // columns
+    mosaic = numpy.zeros((rows * self.tileSize, columns * self.tileSize), dtype=numpy.uint8)
+    for index, tile in enumerate(tiles):
+      row, column = divmod(index, columns)
+      mosaic[row*self.tileSize:(row+1)*self.tileSize, column*self.tileSize:(column+1)*self.tileSize] = tile
+    return mosaic
+
+  def lightbox(self, array, ijkToRAS, orientation, window=None, level=None):
+    """Mosaic of rows*columns slices evenly spread through the volume"""
+    view, spacing = self.orient(array, ijkToRAS, orientation)
+    window, level = self.windowLevel(array, window, level)
+    count = self.rows * self.columns
+    sliceIndices = ((numpy.arange(count) + 0.5) * view.shape[0] / count).astype(int)
+    tiles = [self.tile(view[index], spacing, window, level) for index in sliceIndices]
+    return self.mosaic(tiles, self.columns)
+
+  def centerSlices(self, volumes, orientation):
+    """Mosaic with the center slice of each (array, ijkToRAS, window, level)"""
+    tiles = []
+    for array, ijkToRAS, window, level in volumes:
+      view, spacing = self.orient(array, ijkToRAS, orientation)
+      window, level = self.windowLevel(array, window, level)
+      tiles.append(self.tile(view[view.shape[0] // 2], spacing, window, level))
+    columns = int(numpy.ceil(numpy.sqrt(len(tiles))))
+    return self.mosaic(tiles, columns)
+
+  def encodeJPEG(self, image):
+    """Return the jpeg bytes of a 2D uint8 array, first row at the top"""
+    from vtk.util import numpy_support
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(image.shape[1], image.shape[0], 1)
+    # vtk images start at the bottom row
+    scalars = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(image[::-1]).ravel(), deep=True)
+    imageData.GetPointData().SetScalars(scalars)
+    writer = vtk.vtkJPEGWriter()
+    writer.SetQuality(self.quality)
+    writer.SetInputData(imageData)
+    writer.WriteToMemoryOn()
+    writer.Write()
+    return numpy_support.vtk_to_numpy(writer.GetResult()).tobytes()
+
+  def writeJPEG(self, image, filePath):
+    with open(filePath, 'wb') as fp:
+      fp.write(self.encodeJPEG(image))
@@ -0,0 +1,289 @@
+import logging
+import os
+import queue
+import requests
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+class StreamingZipError(Exception):
+  """The archive cannot be read member by member from a stream"""
+
+class StreamingZipReader:
+  """Read the members of a zip archive in order from a stream that
+  cannot seek, such as an http response.
+
+  zipfile needs the central directory at the end of the archive, so it
+  can only start once the whole file is available.  This reader walks
+  the local file headers instead, so each member can be extracted as
+  soon as its bytes arrive.  Stored members written with a trailing
+  data descriptor have no length in their header and raise
+  StreamingZipError, as do encrypted members and compression methods
+  other than stored and deflated.
+  """
+
+  localHeader = struct.Struct('<IHHHHHIIIHH')
+  localSignature = 0x04034b50
+  descriptorSignature = 0x08074b50
+
+  def __init__(self, stream, blockSize=1024*1024):
+    self.stream = stream
+    self.blockSize = blockSize
+    self.buffer = bytearray()
+    self.eof = False
+
+  def fill(self, count):
+    """Read from the stream until count bytes are buffered"""
+    while len(self.buffer) < count and not self.eof:
+      data = self.stream.read(self.blockSize)
+      if data:
+        self.buffer += data
+      else:
+        self.eof = True
+    return len(self.buffer) >= count
+
+  def take(self, count):
+    if not self.fill(count):
+      raise StreamingZipError('Archive is truncated')
+    data = bytes(self.buffer[:count])
+    del self.buffer[:count]
+    return data
+
+  def members(self):
+    """Yield (name, chunks) for each member, where chunks iterates over
+    the uncompressed bytes.  chunks must be consumed before asking for
+    the next member; anything left over is skipped.
+    """
+    while self.fill(4):
+      signature, = struct.unpack('<I', bytes(self.buffer[:4]))
+      if signature != self.localSignature:
+        # the central directory follows the last member
+        return
+      (_, _, flags, method, _, _, _,
+          compressedSize, size, nameLength, extraLength) = self.localHeader.unpack(self.take(self.localHeader.size))
+      name = self.take(nameLength).decode('utf-8' if flags & 0x800 else 'cp437')
+      extra = self.take(extraLength)
+      zip64 = 0xFFFFFFFF in (compressedSize, size)
+      if zip64:
+        size, compressedSize = self.zip64Sizes(extra, size, compressedSize)
+      if flags & 0x1:
+        raise StreamingZipError('Member %s is encrypted' % name)
+      hasDescriptor = flags & 0x8
+      if method == zipfile.ZIP_STORED:
+        if hasDescriptor:
+          raise StreamingZipError('Stored member %s has no length' % name)
+        chunks = self.stored(compressedSize)
+      elif method == zipfile.ZIP_DEFLATED:
+        chunks = self.inflate(None if hasDescriptor else compressedSize)
+      else:
+        raise StreamingZipError('Member %s uses compression method %d' % (name, method))
+      yield name, chunks
+      for chunk in chunks:
+        pass
+      if hasDescriptor:
+        if self.take(4) != struct.pack('<I', self.descriptorSignature):
+          # the signature is optional, what was read is the crc
+          self.take(16 if zip64 else 8)
+        else:
+          self.take(20 if zip64 else 12)
+
+  def zip64Sizes(self, extra, size, compressedSize):
+    """Replace the sizes that overflowed with the values from the zip64 extra field"""
+    offset = 0
+    while offset + 4 <= len(extra):
+      fieldID, fieldLength = struct.unpack('<HH', extra[offset:offset+4])
+      if fieldID == 0x0001:
+        values = extra[offset+4:offset+4+fieldLength]
+        if size == 0xFFFFFFFF:
+          size, = struct.unpack('<Q', values[:8])
+          values = values[8:]
+        if compressedSize == 0xFFFFFFFF:
+          compressedSize, = struct.unpack('<Q', values[:8])
+        break
+      offset += 4 + fieldLength
+    return size, compressedSize
+
+  def stored(self, count):
+    while count > 0:
+      if not self.fill(1):
+        raise StreamingZipError('Archive is truncated')
+      length = min(count, len(self.buffer))
+      chunk = bytes(self.buffer[:length])
+      del self.buffer[:length]
+      count -= length
+      yield chunk
+
+  def inflate(self, compressedSize=None):
+    """Decompress a deflated member.  Without a compressedSize the end
+    of the deflate stream marks the end of the member.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    remaining = compressedSize
+    while not decompressor.eof and remaining != 0:
+      if not self.fill(1):
+        raise StreamingZipError('Archive is truncated')
+      length = len(self.buffer) if remaining is None else min(remaining, len(self.buffer))
+      block = bytes(self.buffer[:length])
+      del self.buffer[:length]
+      if remaining is not None:
+        remaining -= length
+      chunk = decompressor.decompress(block)
+      if decompressor.unused_data:
+        self.buffer[:0] = decompressor.unused_data
+      if chunk:
+        yield chunk
+    chunk = decompressor.flush()
+    if chunk:
+      yield chunk
+
+class ZipIngestPipeline:
+  """Download a zip archive and extract its DICOM members in a worker
+  thread, so that files can be inserted into the dicom database while
+  the rest of the archive is still arriving.
+
+  Iterate files() on the main thread to get the extracted paths in
+  archive order.  Members without the DICM preamble are skipped.  If
+  the archive cannot be streamed (see StreamingZipReader) it is fetched
+  again into a spooled temporary file and read with zipfile, skipping
+  the members that were already extracted.
+
+  statistics() reports the throughput of the download, extract and
+  insert stages.  Download time is time spent waiting on the network,
+  extract time is the rest of the worker's time and insert time is the
+  time the consumer of files() spends between paths.
+  """
+
+  def __init__(self, url, directory, headers=None, spoolSize=64*1024*1024, chunkSize=1024*128):
+    self.url = url
+    self.directory = directory
+    self.headers = headers or {}
+    self.spoolSize = spoolSize
+    self.chunkSize = chunkSize
+    self.queue = queue.Queue()
+    self.extracted = set()
+    self.raw = None
+    self.thread = None
+    self.stages = {
+      'download': {'bytes': 0, 'seconds': 0.},
+      'extract': {'files': 0, 'skipped': 0, 'bytes': 0, 'seconds': 0.},
+      'insert': {'files': 0, 'seconds': 0.},
+    }
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def files(self):
+    """Yield extracted file paths as they become available, re-raising
+    any error from the worker once the paths before it are consumed.
+    """
+    if not self.thread:
+      self.start()
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      if isinstance(item, Exception):
+        raise item
+      start = time.time()
+      yield item
+      self.stages['insert']['files'] += 1
+      self.stages['insert']['seconds'] += time.time() - start
+
+  def run(self):
+    start = time.time()
+    try:
+      try:
+        self.streamMembers()
+      except StreamingZipError as e:
+        logging.warning("Cannot stream %s (%s), spooling it instead" % (self.url, e))
+        self.spoolMembers()
+      self.queue.put(None)
+    except Exception as e:
+      self.queue.put(e)
+    finally:
+      self.stages['extract']['seconds'] = time.time() - start - self.stages['download']['seconds']
+
+  def open(self):
+    response = requests.get(self.url, headers=self.headers, stream=True)
+    response.raise_for_status()
+    return response
+
+  def read(self, size):
+    """Read from the current response, timing the download stage"""
+    start = time.time()
+    data = self.raw.read(size)
+    self.stages['download']['bytes'] += len(data)
+    self.stages['download']['seconds'] += time.time() - start
+    return data
+
+  def streamMembers(self):
+    response = self.open()
+    try:
+      self.raw = response.raw
+      self.raw.decode_content = True
+      for name, chunks in StreamingZipReader(self).members():
+        self.extract(name, chunks)
+    finally:
+      response.close()
+
+  def spoolMembers(self):
+    response = self.open()
+    try:
+      self.raw = response.raw
+      self.raw.decode_content = True
+      with tempfile.SpooledTemporaryFile(max_size=self.spoolSize) as spool:
+        for chunk in iter(lambda: self.read(self.chunkSize), b''):
+          spool.write(chunk)
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as archive:
+          for info in archive.infolist():
+            if info.filename not in self.extracted:
+              with archive.open(info) as member:
+                self.extract(info.filename, iter(lambda: member.read(self.chunkSize), b''))
+    finally:
+      response.close()
+
+  def extract(self, name, chunks):
+    """Write the member to the output directory if it is a DICOM part 10 file"""
+    if name.endswith('/'):
+      return
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+      head += chunk
+      if len(head) >= 132:
+        break
+    if head[128:132] != b'DICM':
+      self.extracted.add(name)
+      self.stages['extract']['skipped'] += 1
+      return
+    filePath = os.path.join(self.directory, 'member-%d.dcm' % len(self.extracted))
+    with open(filePath, 'wb') as fp:
+      fp.write(head)
+      size = len(head)
+      for chunk in chunks:
+        fp.write(chunk)
+        size += len(chunk)
+    self.extracted.add(name)
+    self.stages['extract']['files'] += 1
+    self.stages['extract']['bytes'] += size
+    self.queue.put(filePath)
+
+  def statistics(self):
+    def rate(count, seconds):
+      return count / seconds if seconds > 0 else 0.
+    download, extract, insert = self.stages['download'], self.stages['extract'], self.stages['insert']
+    statistics = {
+      'downloadMBPerSecond': rate(download['bytes'] / 1e6, download['seconds']),
+      'extractFilesPerSecond': rate(extract['files'], extract['seconds']),
+      'insertFilesPerSecond': rate(insert['files'], insert['seconds']),
+    }
+    for stage, counters in self.stages.items():
+      for counter, value in counters.items():
+        statistics[stage + counter[0].upper() + counter[1:]] = value
+    return statistics
@@ -0,0 +1,224 @@
+import json
+import os
+import tempfile
+import time
+
+from __main__ import qt, slicer
+from SlicerChronicle import SlicerChronicleLogic, default_couchDB_URL
+
+class SlicerChronicleWorker:
+  """One headless worker of a WorkerPoolSupervisor.
+
+  Runs the step watcher of its own logic and writes a status file (json)
+  every statusInterval seconds and around every step, which the
+  supervisor reads to report utilisation.  The worker's identity for
+  step claims comes from CHRONICLE_WORKER, set by the supervisor.
+  """
+
+  def __init__(self, couchDB_URL, operationDatabaseName, statusPath, statusInterval=5.):
+    self.statusPath = statusPath
+    self.started = time.time()
+    self.activeSince = None
+    self.logic = SlicerChronicleLogic(couchDB_URL, operationDatabaseName=operationDatabaseName)
+    self.logic.stepScheduler.execute = self.performStep
+    self.statusTimer = qt.QTimer()
+    self.statusTimer.setInterval(int(statusInterval * 1000))
+    self.statusTimer.connect('timeout()', self.writeStatus)
+
+  def start(self):
+    self.logic.startStepWatcher()
+    self.statusTimer.start()
+    self.writeStatus()
+
+  def performStep(self, doc):
+    # the event loop doesn't run during a step, so report around it
+    self.activeSince = time.time()
+    self.writeStatus()
+    try:
+      self.logic.performStep(doc)
+    finally:
+      self.activeSince = None
+      self.writeStatus()
+
+  def writeStatus(self):
+    statistics = self.logic.stepScheduler.statistics()
+    operations = statistics['operations'].values()
+    status = {
+      'worker': self.logic.stepClaimer.workerID,
+      'pid': os.getpid(),
+      'started': self.started,
+      'updated': time.time(),
+      'activeSince': self.activeSince,
+      'busySeconds': sum([operation['executionTime'] for operation in operations]),
+      'steps': sum([operation['count'] for operation in operations]),
+      'failures': sum([operation['failures'] for operation in operations]),
+      'queueDepth': statistics['queueDepth'],
+      'claims': dict(self.logic.stepClaimer.counters),
+    }
+    temporaryPath = self.statusPath + '.partial'
+    with open(temporaryPath, 'w') as fp:
+      json.dump(status, fp)
+    os.replace(temporaryPath, self.statusPath)
+
+class WorkerPoolSupervisor:
+  """Run workerCount headless Slicer processes that each watch the
+  operation database for steps.
+
+  Steps are shared out by the workers' claims on the step documents
+  (see StepClaimer), so each runs exactly once whichever worker sees it
+  first.  The supervisor restarts workers that exit, waiting longer each
+  time a worker dies within minUptime of being started, and
+  statistics() reports per worker utilisation from the status files
+  the workers write.
+
+  By default workers are started as
+    Slicer --no-splash --no-main-window --python-code <start a SlicerChronicleWorker>
+  pass command=callable(index, statusPath) returning an argument list to
+  launch something else.
+  """
+
+  def __init__(self, workerCount=None, couchDB_URL=default_couchDB_URL, operationDatabaseName='segmentation-server',
+                executable=None, command=None, statusDirectory=None, pollInterval=1., reportInterval=60.,
+                minUptime=30., maxRestartDelay=300.):
+    self.workerCount = workerCount or os.cpu_count() or 1
+    self.couchDB_URL = couchDB_URL
+    self.operationDatabaseName = operationDatabaseName
+    self.executable = executable
+    self.command = command or self.slicerCommand
+    self.statusDirectory = statusDirectory or tempfile.mkdtemp(prefix='SlicerChronicleWorkers-')
+    self.pollInterval = pollInterval
+    self.reportInterval = reportInterval
+    self.minUptime = minUptime
+    self.maxRestartDelay = maxRestartDelay
+    self.poolID = '%d-%s' % (os.getpid(), time.strftime('%Y%m%d%H%M%S'))
+    self.workers = []
+    self.stopping = False
+    self.lastReport = time.time()
+    self.pollTimer = None
+
+  def slicerCommand(self, index, statusPath):
+    executable = self.executable or slicer.app.launcherExecutableFilePath
+    code = ("from SlicerChronicleLib import WorkerPool; "
+            "WorkerPool.slicerChronicleWorker = WorkerPool.SlicerChronicleWorker(%r, %r, %r); "
+            "WorkerPool.slicerChronicleWorker.start()" %
+              (self.couchDB_URL, self.operationDatabaseName, statusPath))
+    return [executable, '--no-splash', '--no-main-window', '--python-code', code]
+
+  def start(self):
+    self.stopping = False
+    for index in range(self.workerCount):
+      worker = {
+        'index': index,
+        'workerID': 'chronicle-%s-%d' % (self.poolID, index),
+        'statusPath': os.path.join(self.statusDirectory, 'worker-%d.json' % index),
+        'process': None,
+        'started': None,
+        'restarts': 0,
+        'restartDelay': 1.,
+        'restartAt': None,
+      }
+      self.workers.append(worker)
+      self.launch(worker)
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(int(self.pollInterval * 1000))
+    self.pollTimer.connect('timeout()', self.poll)
+    self.pollTimer.start()
+
+  def launch(self, worker):
+    import subprocess
+    environment = dict(os.environ)
+    environment['CHRONICLE_WORKER'] = worker['workerID']
+    worker['process'] = subprocess.Popen(self.command(worker['index'], worker['statusPath']), env=environment)
+    worker['started'] = time.time()
+    worker['restartAt'] = None
+    print("Started worker %s (pid %d)" % (worker['workerID'], worker['process'].pid))
+
+  def poll(self):
+    """Restart workers that exited and report when it is time"""
+    now = time.time()
+    for worker in self.workers:
+      if self.stopping:
+        break
+      if worker['restartAt'] is not None:
+        if now >= worker['restartAt']:
+          worker['restarts'] += 1
+          self.launch(worker)
+        continue
+      returnCode = worker['process'].poll()
+      if returnCode is None:
+        continue
+      # back off if the worker keeps dying right after it starts
+      if now - worker['started'] < self.minUptime:
+        worker['restartDelay'] = min(worker['restartDelay'] * 2, self.maxRestartDelay)
+      else:
+        worker['restartDelay'] = 1.
+      worker['restartAt'] = now + worker['restartDelay']
+      print("Worker %s exited with %d, restarting in %gs" % (worker['workerID'], returnCode, worker['restartDelay']))
+    if now - self.lastReport >= self.reportInterval:
+      self.lastReport = now
+      self.report()
+
+  def workerStatus(self, worker):
+    try:
+      with open(worker['statusPath']) as fp:
+        return json.load(fp)
+    except (IOError, ValueError):
+      return {}
+
+  def statistics(self):
+    """Per worker utilisation (busy fraction of the current process's
+    lifetime), steps, failures and restarts, plus pool totals"""
+    now = time.time()
+    workers = []
+    for worker in self.workers:
+      status = self.workerStatus(worker)
+      # status files outlive a crashed worker, only count the running process
+      if status.get('pid') != worker['process'].pid:
+        status = {}
+      busy = status.get('busySeconds', 0.)
+      if status.get('activeSince'):
+        busy += now - status['activeSince']
+      uptime = now - status.get('started', now)
+      workers.append({
+        'workerID': worker['workerID'],
+        'running': worker['process'].poll() is None,
+        'restarts': worker['restarts'],
+        'uptime': uptime,
+        'utilisation': busy / uptime if uptime > 0 else 0.,
+        'steps': status.get('steps', 0),
+        'failures': status.get('failures', 0),
+        'active': bool(status.get('activeSince')),
+      })
+    return {
+      'workers': workers,
+      'running': len([worker for worker in workers if worker['running']]),
+      'steps': sum([worker['steps'] for worker in workers]),
+      'restarts': sum([worker['restarts'] for worker in workers]),
+      'utilisation': sum([worker['utilisation'] for worker in workers]) / max(len(workers), 1),
+    }
+
+  def report(self):
+    statistics = self.statistics()
+    print("%d of %d workers running, %d steps, %d restarts, %.0f%% utilised" %
+            (statistics['running'], len(self.workers), statistics['steps'],
+             statistics['restarts'], 100 * statistics['utilisation']))
+    for worker in statistics['workers']:
+      print("  %s: %s, %d steps, %d failures, %.0f%% utilised" %
+              (worker['workerID'], 'busy' if worker['active'] else 'idle' if worker['running'] else 'down',
+               worker['steps'], worker['failures'], 100 * worker['utilisation']))
+    return statistics
+
+  def stop(self, timeout=10.):
+    self.stopping = True
+    if self.pollTimer:
+      self.pollTimer.stop()
+      self.pollTimer = None
+    for worker in self.workers:
+      if worker['process'].poll() is None:
+        worker['process'].terminate()
+    for worker in self.workers:
+      try:
+        worker['process'].wait(timeout)
+      except Exception:
+        worker['process'].kill()
+        worker['process'].wait()
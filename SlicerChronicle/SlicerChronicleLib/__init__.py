@@ -0,0 +1 @@
+"""Pieces of the SlicerChronicle module that are usable on their own."""
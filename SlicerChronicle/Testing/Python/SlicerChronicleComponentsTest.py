@@ -0,0 +1,1831 @@
+import asyncio
+import collections
+import couchdb
+import json
+import numpy
+import os
+import requests
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+import zipfile
+
+from __main__ import slicer
+from DICOMLib import DICOMUtils
+from SlicerChronicleLib.AsyncCouch import AsyncDatabase, AsyncSession
+from SlicerChronicleLib.CouchStreams import ViewRowParser
+from SlicerChronicleLib.OffscreenRenderer import OffscreenRenderer
+from SlicerChronicle import (BulkDICOMIndexer, ChronicleRecorder, CouchChanges, InstanceCache, InstanceDownloader,
+                             InstanceTagIndex, LocalDocCheckpoint, ProgressReporter, SecondaryCaptureBuilder,
+                             SeriesGeometryIndex, SlicerChronicleContext, SlicerChronicleLogic, StepClaimer,
+                             StepLeaseLost, StepScheduler, StudyRenderPipeline, default_couchDB_URL)
+from SlicerChronicleLib.StreamingZip import ZipIngestPipeline
+from SlicerChronicleLib.WorkerPool import WorkerPoolSupervisor
+
+class SlicerChronicleComponentsTest(unittest.TestCase):
+  """
+  Tests and synthetic benchmarks of the pieces SlicerChronicle is built
+  from.  Most run against local stand-in servers; the ones that use
+  default_couchDB_URL need a running couchdb.  Benchmarks return their
+  speedup so they can also be called from the python console.
+  """
+
+  def delayDisplay(self,message,msec=0):
+    """Report a result; these tests don't wait on the event loop"""
+    print(message)
+
+  def test_changesCheckpoint(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_changesCheckpoint()
+    '''
+    import http.server
+    import select
+
+    # a feed of three changes; 'a' is not a step, 'b' and 'c' are
+    lines = [{'seq': seq, 'id': docID} for seq, docID in ((1, 'a'), (2, 'b'), (3, 'c'))]
+    body = b''.join([json.dumps(line).encode() + b'\n' for line in lines + [{'last_seq': 3}]])
+    class ChangesHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        data = body if '_changes' in self.path else json.dumps({'db_name': 'steps', 'update_seq': 0}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if '_changes' in self.path:
+          # the end of the feed
+          self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+      def log_message(self, *args):
+        pass
+
+    class MemoryCheckpoint:
+      def __init__(self):
+        self.saved = []
+      def load(self):
+        return None
+      def save(self, seq):
+        self.saved.append(seq)
+
+    executed = []
+    scheduler = StepScheduler(lambda docID, doc: None if docID == 'a' else {'_id': docID},
+                              lambda doc: executed.append(doc['_id']))
+    def callback(db, line):
+      if line != b"" and 'id' in json.loads(line):
+        scheduler.submit(json.loads(line)['id'])
+    checkpoint = MemoryCheckpoint()
+    server = self.localServer(ChangesHandler)
+    try:
+      db = couchdb.Database('http://127.0.0.1:%d/steps' % server.server_address[1])
+      changes = CouchChanges(db, callback, checkpoint=checkpoint, pending=scheduler.pending)
+      changes.notifier.setEnabled(False)
+      while changes.changesSocket:
+        select.select([changes.changesSocket], [], [], 5)
+        changes.onSocketNotify(0)
+      self.assertEqual(changes.seq, 3)
+
+      # nothing is checkpointed while every step is still queued
+      changes.saveCheckpoint()
+      self.assertEqual(checkpoint.saved, [])
+      scheduler.resolveIncoming()
+      changes.saveCheckpoint()
+      scheduler.dispatch()
+      changes.saveCheckpoint()
+      # a stop while 'c' is still queued leaves it to the next session
+      changes.stop()
+      self.assertEqual(executed, ['b'])
+      self.assertEqual(checkpoint.saved, [1, 2])
+      scheduler.dispatch()
+      changes.saveCheckpoint()
+      self.assertEqual(checkpoint.saved, [1, 2, 3])
+    finally:
+      server.shutdown()
+      server.server_close()
+
+    # conflicts on a _local checkpoint are retried a bounded number of times
+    class ConflictingDB:
+      saves = 0
+      def get(self, docID):
+        return {'_id': docID, '_rev': '1-a'}
+      def save(self, doc):
+        self.saves += 1
+        raise couchdb.ResourceConflict(('conflict', 'Document update conflict.'))
+    conflicting = ConflictingDB()
+    with self.assertRaises(couchdb.ResourceConflict):
+      LocalDocCheckpoint(conflicting).save(7, retries=2)
+    self.assertEqual(conflicting.saves, 3)
+    self.delayDisplay('Checkpoints stop short of pending steps')
+
+  def test_stepScheduler(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_stepScheduler()
+    '''
+    docs = {
+      'low' : {'_id': 'low', 'desiredProvenance': {'operation': 'Load'}},
+      'high' : {'_id': 'high', 'priority': 10, 'desiredProvenance': {'operation': 'LesionSegmenter'}},
+      'progress' : {'_id': 'progress', 'type': 'progress'},
+    }
+    executed = []
+    def resolve(docID, doc):
+      doc = docs[docID]
+      return doc if 'desiredProvenance' in doc else None
+    scheduler = StepScheduler(resolve, lambda doc: executed.append(doc['_id']))
+    for docID in ('low', 'progress', 'high', 'low', 'high'):
+      scheduler.submit(docID)
+    self.assertEqual(scheduler.queueDepth(), 3)
+    while scheduler.queueDepth() > 0:
+      scheduler.dispatch()
+    scheduler.submit('high')
+    scheduler.dispatch()
+
+    statistics = scheduler.statistics()
+    self.delayDisplay("Scheduler statistics: %s" % statistics, 200)
+    self.assertEqual(executed, ['high', 'low'])
+    self.assertEqual(statistics['duplicates'], 3)
+    self.assertEqual(statistics['ignored'], 1)
+    self.assertEqual(statistics['operations']['Load']['count'], 1)
+
+  def test_progressReporter(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_progressReporter()
+    '''
+    couch = couchdb.Server(default_couchDB_URL)
+    operationDB = couch['segmentation-server']
+    reporter = ProgressReporter(operationDB, flushInterval=0.5)
+    for index in range(1000):
+      reporter.post('test_progressReporter', 'progress', 'message %d' % index)
+    id_, rev = reporter.post('test_progressReporter', 'result', 'done')
+    reporter.stop()
+    self.assertFalse(reporter.thread.is_alive())
+
+    counters = reporter.counters
+    self.delayDisplay("Progress counters: %s" % counters, 200)
+    self.assertEqual(counters['posted'], 1001)
+    self.assertEqual(counters['failed'], 0)
+    self.assertEqual(counters['written'] + counters['coalesced'], 1001)
+    self.assertTrue(counters['requests'] < 20)
+    self.assertEqual(operationDB[id_]['progress'], 'done')
+
+  def test_stepClaiming(self, workerCount=4, stepCount=50):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_stepClaiming()
+    '''
+    couch = couchdb.Server(default_couchDB_URL)
+    operationDB = couch['segmentation-server']
+    stepIDs = []
+    for index in range(stepCount):
+      doc_id, doc_rev = operationDB.save({'type': 'ch.step', 'status': 'open',
+                                           'desiredProvenance': {'operation': 'test_stepClaiming'}})
+      stepIDs.append(doc_id)
+
+    # every worker tries every step at the same time, one claim each should win
+    claimers = [StepClaimer(operationDB, workerID='worker-%d' % index, leaseDuration=2.) for index in range(workerCount)]
+    leases = collections.defaultdict(list)
+    def work(claimer):
+      for doc_id in stepIDs:
+        lease = claimer.claim(operationDB[doc_id])
+        if lease:
+          leases[doc_id].append(lease)
+    threads = [threading.Thread(target=work, args=(claimer,)) for claimer in claimers]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(sorted(leases.keys()), sorted(stepIDs))
+    self.assertTrue(all([len(stepLeases) == 1 for stepLeases in leases.values()]))
+    self.assertEqual(sum([claimer.counters['claimed'] for claimer in claimers]), stepCount)
+
+    # a worker that stops renewing loses the step to another worker
+    first, second = leases[stepIDs[0]][0], leases[stepIDs[1]][0]
+    first.stopped.set()
+    second.renew()
+    time.sleep(2.5)
+    second.renew()
+    expired = [doc['_id'] for doc in claimers[0].expiredSteps({'type': 'ch.step'})]
+    self.assertTrue(stepIDs[0] in expired)
+    self.assertFalse(stepIDs[1] in expired)
+    otherClaimer = [claimer for claimer in claimers if claimer is not first.claimer][0]
+    takeover = otherClaimer.claim(operationDB[stepIDs[0]])
+    self.assertTrue(takeover)
+    self.assertEqual(takeover.doc['lease']['previousWorker'], first.claimer.workerID)
+    self.assertRaises(StepLeaseLost, first.release)
+
+    for stepLeases in leases.values():
+      if not stepLeases[0].lost:
+        stepLeases[0].release()
+    takeover.release()
+    self.assertEqual(operationDB[stepIDs[0]]['status'], 'closed')
+    self.assertEqual(operationDB[stepIDs[0]]['lease']['worker'], otherClaimer.workerID)
+    self.delayDisplay("Claims: %s" % [dict(claimer.counters) for claimer in claimers], 200)
+    for doc_id in stepIDs:
+      operationDB.delete(operationDB[doc_id])
+
+  def test_stepLeaseRelease(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_stepLeaseRelease()
+    '''
+    class StepDB:
+      def __init__(self):
+        self.docs = {}
+        self.saves = 0
+      def __getitem__(self, docID):
+        return dict(self.docs[docID])
+      def save(self, doc):
+        self.saves += 1
+        self.docs[doc['_id']] = dict(doc)
+    stepDB = StepDB()
+    claimer = StepClaimer(stepDB, workerID='worker', leaseDuration=60.)
+    lease = claimer.claim({'_id': 'step', 'status': 'open'})
+    lease.stopped.set()
+
+    # a heartbeat that was waiting on the lock while the step was released
+    lease.lock.acquire()
+    heartbeat = threading.Thread(target=lease.renew)
+    heartbeat.start()
+    time.sleep(0.1)
+    lease.release()
+    lease.lock.release()
+    heartbeat.join()
+    lease.renew()
+    self.assertEqual(stepDB.saves, 2)
+    self.assertEqual(stepDB['step']['status'], 'closed')
+    self.assertTrue('released' in stepDB['step']['lease'])
+    self.delayDisplay('Heartbeats after a release leave the step alone')
+
+  def test_workerPoolSupervisor(self, workerCount=3):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_workerPoolSupervisor()
+    '''
+    import shutil
+    import sys
+
+    # stand-in workers: write a status file like SlicerChronicleWorker,
+    # and worker 0 crashes the first time it is started
+    statusDirectory = tempfile.mkdtemp()
+    crashMarker = os.path.join(statusDirectory, 'crashed')
+    script = """
+import json, os, sys, time
+index, statusPath, crashMarker = int(sys.argv[1]), sys.argv[2], sys.argv[3]
+started = time.time()
+with open(statusPath, 'w') as fp:
+  json.dump({'worker': os.environ['CHRONICLE_WORKER'], 'pid': os.getpid(), 'started': started - 10,
+             'busySeconds': 5., 'steps': 3, 'failures': 0, 'activeSince': None}, fp)
+if index == 0 and not os.path.exists(crashMarker):
+  open(crashMarker, 'w').close()
+  sys.exit(1)
+time.sleep(60)
+"""
+    command = lambda index, statusPath: [sys.executable, '-c', script, str(index), statusPath, crashMarker]
+    supervisor = WorkerPoolSupervisor(workerCount, command=command, statusDirectory=statusDirectory,
+                                      minUptime=5., reportInterval=3600.)
+    try:
+      supervisor.start()
+      supervisor.workers[0]['restartDelay'] = 0.25 # doubled to 0.5s after the quick crash
+      deadline = time.time() + 20
+      while time.time() < deadline:
+        supervisor.poll()
+        statistics = supervisor.statistics()
+        if (statistics['restarts'] == 1 and statistics['running'] == workerCount
+              and statistics['steps'] == 3 * workerCount):
+          break
+        time.sleep(0.1)
+      statistics = supervisor.report()
+      self.assertEqual(statistics['restarts'], 1)
+      self.assertEqual(statistics['running'], workerCount)
+      self.assertEqual(statistics['steps'], 3 * workerCount)
+      self.assertTrue(0.4 < statistics['utilisation'] < 0.6)
+      workerIDs = set([worker['workerID'] for worker in statistics['workers']])
+      self.assertEqual(len(workerIDs), workerCount)
+    finally:
+      supervisor.stop()
+      shutil.rmtree(statusDirectory)
+    self.assertEqual(supervisor.statistics()['running'], 0)
+
+  def test_headlessWorker(self, fileCount=4, timeout=180.):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_headlessWorker()
+    '''
+    import http.server
+    import io
+    import pydicom.dataset
+    import pydicom.uid
+    import shutil
+
+    # a study zip of small secondary captures, served locally
+    studyUID, seriesUID = pydicom.uid.generate_uid(), pydicom.uid.generate_uid()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zipFile:
+      for index in range(fileCount):
+        instanceUID = pydicom.uid.generate_uid()
+        dataset = pydicom.dataset.Dataset()
+        dataset.file_meta = pydicom.dataset.FileMetaDataset()
+        dataset.file_meta.MediaStorageSOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+        dataset.file_meta.MediaStorageSOPInstanceUID = instanceUID
+        dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dataset.SOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+        dataset.SOPInstanceUID = instanceUID
+        dataset.PatientID, dataset.PatientName = 'headlessWorker', 'Headless^Worker'
+        dataset.StudyInstanceUID, dataset.SeriesInstanceUID = studyUID, seriesUID
+        dataset.Modality, dataset.InstanceNumber = 'OT', index + 1
+        dataset.Rows, dataset.Columns = 8, 8
+        dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 16, 15
+        dataset.SamplesPerPixel, dataset.PixelRepresentation = 1, 0
+        dataset.PhotometricInterpretation = 'MONOCHROME2'
+        dataset.PixelData = os.urandom(8 * 8 * 2)
+        dicomBytes = io.BytesIO()
+        dataset.save_as(dicomBytes, enforce_file_format=True)
+        zipFile.writestr('%d.dcm' % index, dicomBytes.getvalue())
+    payload = archive.getvalue()
+    class ZipHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+      def log_message(self, *args):
+        pass
+    server = self.localServer(ZipHandler)
+
+    # one real worker, started the way the pool starts them
+    couch = couchdb.Server(default_couchDB_URL)
+    operationDB = couch['segmentation-server']
+    statusDirectory = tempfile.mkdtemp()
+    supervisor = WorkerPoolSupervisor(1, statusDirectory=statusDirectory, reportInterval=3600.)
+    doc_id = None
+    try:
+      supervisor.start()
+      self.assertTrue('--no-main-window' in supervisor.slicerCommand(0, supervisor.workers[0]['statusPath']))
+      deadline = time.time() + timeout
+      while not supervisor.workerStatus(supervisor.workers[0]) and time.time() < deadline:
+        time.sleep(0.5)
+      self.assertTrue(supervisor.workerStatus(supervisor.workers[0]), 'the worker did not start')
+      doc_id, doc_rev = operationDB.save({
+        'type': 'ch.step', 'status': 'open',
+        'desiredProvenance': {
+          'operation': 'Load', 'application': '3D Slicer', 'version': '*',
+          'inputData': [{
+            'studyUID': studyUID, 'dataFormat': 'zip', 'dataToken': '',
+            'dataURL': 'http://127.0.0.1:%d/study.zip' % server.server_address[1],
+          }],
+        },
+      })
+      while operationDB[doc_id]['status'] in ('open', 'working') and time.time() < deadline:
+        supervisor.poll()
+        time.sleep(0.5)
+      step = operationDB[doc_id]
+      self.assertEqual(step['status'], 'closed')
+      self.assertEqual(step['lease']['worker'], supervisor.workers[0]['workerID'])
+      self.assertEqual(supervisor.workers[0]['restarts'], 0)
+      # the worker's files are kept apart from other workers'
+      workerPath = os.path.join(slicer.app.temporaryPath, 'SlicerChronicle-%s' % supervisor.workers[0]['workerID'])
+      self.assertTrue(os.path.isdir(os.path.join(workerPath, 'SlicerChronicleInstanceCache')))
+    finally:
+      supervisor.stop()
+      server.shutdown()
+      shutil.rmtree(statusDirectory)
+      for worker in supervisor.workers:
+        shutil.rmtree(os.path.join(slicer.app.temporaryPath, 'SlicerChronicle-%s' % worker['workerID']), ignore_errors=True)
+      if doc_id:
+        operationDB.delete(operationDB[doc_id])
+    self.delayDisplay('A worker without a main window ran a Load step', 200)
+
+  def test_offscreenRenderBenchmark(self, shape=(200, 256, 256), renderCount=20):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_offscreenRenderBenchmark()
+    '''
+    import shutil
+
+    # an axial acquisition stored LPS the way DICOM volumes load, and a
+    # sagittal one; a marker at the right-anterior-superior corner
+    # should always end up on the last slice at the top left
+    random = numpy.random.RandomState(0)
+    array = random.randint(-1000, 1000, shape).astype(numpy.int16)
+    axial = numpy.array([[-0.7, 0, 0, 0], [0, -0.7, 0, 0], [0, 0, 2.5, 0], [0, 0, 0, 1]])
+    sagittal = numpy.array([[0, 0, 1.2, 0], [-0.9, 0, 0, 0], [0, -0.9, 0, 0], [0, 0, 0, 1]])
+    renderer = OffscreenRenderer()
+    for ijkToRAS in (axial, sagittal):
+      marked = array.copy()
+      corner = [0, 0, 0] # k, j, i
+      for ijkAxis in range(3):
+        rasAxis = int(numpy.argmax(numpy.abs(ijkToRAS[:3, ijkAxis])))
+        if ijkToRAS[rasAxis, ijkAxis] > 0:
+          corner[2 - ijkAxis] = shape[2 - ijkAxis] - 1
+      marked[tuple(corner)] = 5000
+      for orientation in ('Axial', 'Sagittal', 'Coronal'):
+        view, spacing = renderer.orient(marked, ijkToRAS, orientation)
+        self.assertEqual(view[-1, 0, 0], 5000)
+    view, spacing = renderer.orient(array, axial, 'Coronal')
+    self.assertEqual(view.shape, (256, 200, 256))
+    self.assertTrue(numpy.allclose(spacing, (2.5, 0.7)))
+    mosaic = renderer.lightbox(array, axial, 'Sagittal')
+    self.assertEqual(mosaic.shape, (4 * 256, 6 * 256))
+    self.assertEqual(mosaic.dtype, numpy.uint8)
+
+    rates = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+      for orientation in ('Axial', 'Sagittal', 'Coronal'):
+        start = time.time()
+        for index in range(renderCount):
+          mosaic = renderer.lightbox(array, axial, orientation)
+        renderTime = (time.time() - start) / renderCount
+        start = time.time()
+        renderer.writeJPEG(mosaic, os.path.join(tmpdir, '%s.jpg' % orientation))
+        encodeTime = time.time() - start
+        rates[orientation] = 1. / (renderTime + encodeTime)
+        self.delayDisplay("%s lightbox: %.1f renders/s (%.1fms render, %.1fms encode)" %
+                (orientation, rates[orientation], renderTime * 1000, encodeTime * 1000), 100)
+    finally:
+      shutil.rmtree(tmpdir)
+    return rates
+
+  def test_secondaryCaptureRecord(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_secondaryCaptureRecord()
+    '''
+    import email.parser
+    import http.server
+    import io
+    import pydicom.dataset
+    import pydicom.uid
+    import shutil
+
+    tmpdir = tempfile.mkdtemp()
+    jpgFilePath = os.path.join(tmpdir, 'mosaic.jpg')
+    mosaic = numpy.tile(numpy.arange(256, dtype=numpy.uint8), (192, 2))
+    OffscreenRenderer().writeJPEG(mosaic, jpgFilePath)
+    with open(jpgFilePath, 'rb') as fp:
+      jpegBytes = fp.read()
+
+    reference = pydicom.dataset.Dataset()
+    reference.PatientName = 'Chronicle^Test'
+    reference.PatientID = 'test_secondaryCaptureRecord'
+    reference.StudyInstanceUID = pydicom.uid.generate_uid()
+    reference.SeriesInstanceUID = pydicom.uid.generate_uid()
+    reference.StudyDate = '20150101'
+    reference.Modality = 'CT'
+
+    builder = SecondaryCaptureBuilder()
+    start = time.time()
+    dataset = builder.build(jpegBytes, 'Slicer Series Render', reference)
+    dicomBytes = builder.encode(dataset)
+    encodeTime = time.time() - start
+    decoded = pydicom.dcmread(io.BytesIO(dicomBytes))
+    self.assertEqual((decoded.Rows, decoded.Columns, decoded.SamplesPerPixel), (192, 512, 1))
+    self.assertEqual(decoded.StudyInstanceUID, reference.StudyInstanceUID)
+    self.assertEqual(str(decoded.PatientName), 'Chronicle^Test')
+    self.assertNotEqual(decoded.SeriesInstanceUID, reference.SeriesInstanceUID)
+    self.assertEqual(decoded.SOPClassUID, pydicom.uid.SecondaryCaptureImageStorage)
+    self.assertTrue(jpegBytes in dicomBytes)
+
+    # a stand-in for couchdb that accepts multipart document PUTs
+    puts = []
+    class CouchHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        parts = [part.get_payload(decode=True) for part in message.get_payload()]
+        puts.append((self.path, parts))
+        response = json.dumps({'ok': True, 'id': self.path.split('/')[-1], 'rev': '1-a'}).encode()
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(CouchHandler)
+    try:
+      db = couchdb.Database('http://127.0.0.1:%d/chronicle' % server.server_address[1])
+      recorder = ChronicleRecorder(db)
+      start = time.time()
+      id_, rev = recorder.record(dataset, collections.OrderedDict([
+        ('object.dcm', ('application/dicom', dicomBytes)),
+        ('image.jpg', ('image/jpeg', jpegBytes)),
+      ]))
+      recordTime = time.time() - start
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(tmpdir)
+    self.assertEqual(len(puts), 1)
+    path, (docJSON, objectBytes, imageBytes) = puts[0]
+    doc = json.loads(docJSON)
+    self.assertEqual(id_, dataset.SOPInstanceUID)
+    self.assertEqual(path, '/chronicle/' + dataset.SOPInstanceUID)
+    self.assertEqual(doc['dataset']['0020000D']['Value'], reference.StudyInstanceUID)
+    self.assertEqual(doc['dataset']['0008103E']['Value'], 'Slicer Series Render')
+    self.assertFalse('7FE00010' in doc['dataset'])
+    self.assertEqual(list(doc['_attachments'].keys()), ['object.dcm', 'image.jpg'])
+    self.assertEqual((objectBytes, imageBytes), (dicomBytes, jpegBytes))
+    self.delayDisplay("Secondary capture encoded in %.1fms and recorded in %.1fms with one request" %
+            (encodeTime * 1000, recordTime * 1000), 200)
+
+  def test_studyRenderPipeline(self, seriesCount=20, fetchTime=(0.05, 0.5), loadTime=0.02, renderTime=0.05, uploadTime=0.05):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_studyRenderPipeline()
+    '''
+    # stand-in stages with fixed costs, fetches vary by series size
+    random = numpy.random.RandomState(0)
+    fetchTimes = dict([('series-%d' % index, random.uniform(*fetchTime)) for index in range(seriesCount)])
+    loaded = []
+    uploaded = []
+    def fetch(seriesUID):
+      time.sleep(fetchTimes[seriesUID])
+      if seriesUID == 'series-3':
+        raise IOError('unavailable')
+      return ['%s/0.dcm' % seriesUID]
+    def load(seriesUID, files):
+      loaded.append(threading.current_thread())
+      time.sleep(loadTime)
+      return seriesUID
+    def renderSeries(volume, orientation):
+      time.sleep(renderTime)
+      return (volume, orientation)
+    def renderStudy(volumes, orientation):
+      time.sleep(renderTime)
+      return (len(volumes), orientation)
+    def upload(image, description, referenceFile):
+      time.sleep(uploadTime)
+      uploaded.append((image, description, referenceFile))
+
+    pipeline = StudyRenderPipeline(fetch, load, renderSeries, renderStudy, upload,
+                                   fetchWorkers=seriesCount, renderWorkers=4, uploadWorkers=4, uploadQueueSize=6)
+    statistics = pipeline.run([('series-%d' % index, 'description') for index in range(seriesCount)])
+    serial = (sum(fetchTimes.values()) + seriesCount * loadTime +
+                (seriesCount * 3 + 3) * (renderTime + uploadTime))
+    self.assertEqual(statistics['series'], seriesCount - 1)
+    self.assertEqual(statistics['errors'], 1)
+    self.assertEqual(statistics['uploaded'], (seriesCount - 1) * 3 + 3)
+    self.assertTrue(statistics['maxUploadQueueDepth'] <= 6)
+    self.assertTrue(all([thread is threading.main_thread() for thread in loaded]))
+    studyImages = [image for image, description, referenceFile in uploaded if description == 'Slicer Study Render']
+    self.assertEqual(sorted(studyImages), [(seriesCount - 1, orientation) for orientation in ('Axial', 'Coronal', 'Sagittal')])
+    self.assertTrue(statistics['seconds'] < serial / 3)
+    self.delayDisplay("%d series rendered in %.2fs, slowest fetch %.2fs, serially %.2fs" %
+            (statistics['series'], statistics['seconds'], max(fetchTimes.values()), serial), 200)
+    return serial / statistics['seconds']
+
+  def localContextServer(self, patientCount=20, studiesPerPatient=5, seriesPerStudy=4, instancesPerSeries=10):
+    """A stand-in for the chronicle context and seriesInstances views,
+    with ETags that change when instances are added.  Returns the
+    server, a database for it and the list of request paths."""
+    import http.server
+    instances = []
+    for patient in range(patientCount):
+      for study in range(studiesPerPatient):
+        for series in range(seriesPerStudy):
+          for instance in range(instancesPerSeries):
+            instances.append([['Hospital', 'mrn-%d' % patient],
+                              ['Study %d' % study, 'study-%d-%d' % (patient, study)],
+                              ['CT', 'Series %d' % series, 'series-%d-%d-%d' % (patient, study, series)],
+                              'instance-%d-%d-%d-%d' % (patient, study, series, instance)])
+    requests_ = []
+    sortedRows = {}
+    def collate(value):
+      if value is None:
+        return (0,)
+      if isinstance(value, bool):
+        return (1, value)
+      if isinstance(value, (int, float)):
+        return (2, value)
+      if isinstance(value, str):
+        return (3, value)
+      if isinstance(value, list):
+        return (4, [collate(item) for item in value])
+      return (5,)
+    class ViewHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      disable_nagle_algorithm = True
+      def do_GET(self):
+        self.respond()
+      def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.respond(json.loads(body)['keys'])
+      def respond(self, keys=None):
+        requests_.append(self.path)
+        parts = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        etag = '"%d"' % len(instances)
+        if self.headers.get('If-None-Match') == etag:
+          self.send_response(304)
+          self.send_header('ETag', etag)
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        rows = sortedRows.get((parts.path, query.get('group_level'), etag))
+        if rows is None:
+          if parts.path.endswith('/seriesInstances'):
+            rows = [{'id': instance[3], 'key': instance[2][2],
+                     'value': ['1.2.840.10008.5.1.4.1.1.2', instance[3]]} for instance in instances]
+          else:
+            groupLevel = int(query['group_level'])
+            counts = {}
+            for instance in instances:
+              key = json.dumps(instance[:groupLevel])
+              counts[key] = counts.get(key, 0) + 1
+            rows = [{'key': json.loads(key), 'value': count} for key, count in counts.items()]
+          rows.sort(key=lambda row: (collate(row['key']), row.get('id')))
+          sortedRows[(parts.path, query.get('group_level'), etag)] = rows
+        if keys is not None:
+          rows = [row for key in keys for row in rows if row['key'] == key]
+        if 'key' in query:
+          query['startkey'] = query['endkey'] = query['key']
+        if 'startkey' in query:
+          start = (collate(json.loads(query['startkey'])), query.get('startkey_docid', ''))
+          rows = [row for row in rows if (collate(row['key']), row.get('id', '')) >= start]
+        if 'endkey' in query:
+          end = collate(json.loads(query['endkey']))
+          rows = [row for row in rows if collate(row['key']) <= end]
+        if 'limit' in query:
+          rows = rows[:int(query['limit'])]
+        body = json.dumps({'rows': rows}).encode()
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      def log_message(self, *args):
+        pass
+    server = self.localServer(ViewHandler)
+    db = couchdb.Database('http://127.0.0.1:%d/chronicle' % server.server_address[1])
+    return server, db, requests_, instances
+
+  def test_viewRowStreaming(self, rowCount=1000000, chunkSize=16*1024):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_viewRowStreaming()
+    '''
+    import http.server
+    import tracemalloc
+
+    # a byTagAndValue response, sent chunked the way couchdb streams views
+    rows = ['{"id":"1.2.826.0.1.%d","key":["0020000D","1.2.826.0.9"],"value":null}' % row
+              for row in range(rowCount)]
+    body = ('{"total_rows":%d,"offset":0,"rows":[\r\n' % rowCount + ',\r\n'.join(rows) + '\r\n]}\n').encode()
+    del rows
+    class ViewHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+          for start in range(0, len(body), chunkSize):
+            chunk = body[start:start + chunkSize]
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+          self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+          pass # the client stopped early
+      def log_message(self, *args):
+        pass
+
+    # chunk boundaries anywhere give the same rows
+    sample = body[:body.index(b',\r\n{"id":"1.2.826.0.1.50"')] + b'\r\n],"update_seq":"7-g1"}'
+    for pieceSize in (1, 7, 100, 4096):
+      parser = ViewRowParser()
+      parsed = []
+      for start in range(0, len(sample), pieceSize):
+        parsed += parser.feed(sample[start:start + pieceSize])
+      parser.close()
+      self.assertEqual(parsed, json.loads(sample)['rows'])
+      self.assertEqual(parser.fields, {'total_rows': rowCount, 'offset': 0, 'update_seq': '7-g1'})
+
+    # brackets and quotes inside strings, decoded by couchdb.json
+    from unittest import mock
+    tricky = b'{"total_rows":2,"rows":[{"id":"a","value":"]} \\" {["},{"id":"b","value":[{"x":"}"}]}]}'
+    decoded = []
+    def decode(text):
+      decoded.append(text)
+      return json.loads(text)
+    with mock.patch.object(couchdb.json, 'decode', decode):
+      for pieceSize in (1, 3, len(tricky)):
+        parser = ViewRowParser()
+        parsed = []
+        for start in range(0, len(tricky), pieceSize):
+          parsed += parser.feed(tricky[start:start + pieceSize])
+        parser.close()
+        self.assertEqual(parsed, json.loads(tricky)['rows'])
+    self.assertTrue('{"id":"b","value":[{"x":"}"}]}' in decoded)
+
+    server = self.localServer(ViewHandler)
+    url = 'http://127.0.0.1:%d/chronicle/_design/tags/_view/byTagAndValue' % server.server_address[1]
+    session = requests.Session()
+    try:
+      # the whole body decoded at once
+      tracemalloc.start()
+      start = time.time()
+      decoded = session.get(url).json()
+      loadedFirst = time.time() - start
+      self.assertEqual(len(decoded['rows']), rowCount)
+      del decoded
+      loadedPeak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+
+      # rows as they arrive
+      tracemalloc.start()
+      parser = ViewRowParser()
+      start = time.time()
+      streamedFirst = None
+      count = 0
+      for row in parser.rows(session, url):
+        if streamedFirst is None:
+          streamedFirst = time.time() - start
+          self.assertEqual(parser.totalRows, rowCount)
+        count += 1
+      streamedTime = time.time() - start
+      streamedPeak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      self.assertEqual(count, rowCount)
+
+      # stopping early
+      start = time.time()
+      firstRows = ViewRowParser().rows(session, url)
+      ids = [next(firstRows)['id'] for row in range(100)]
+      firstRows.close()
+      earlyTime = time.time() - start
+      self.assertEqual(ids[-1], '1.2.826.0.1.99')
+    finally:
+      server.shutdown()
+      server.server_close()
+
+    self.assertLess(streamedPeak, loadedPeak / 10)
+    self.delayDisplay("%d rows: first row after %.2fs with %.0fMB decoding at once, "
+                      "after %.3fs with %.1fMB streamed (%.2fs for all), first 100 in %.3fs" %
+                      (rowCount, loadedFirst, loadedPeak / 1e6, streamedFirst,
+                       streamedPeak / 1e6, streamedTime, earlyTime), 200)
+    return loadedFirst / streamedFirst
+
+  def test_contextCache(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_contextCache()
+    '''
+    server, db, requests_, instances = self.localContextServer()
+    try:
+      # the old way: one request per node
+      context = SlicerChronicleContext(db, levelThreshold=1000)
+      start = time.time()
+      patients = context.patients()
+      studies = [study for patient in patients for study in context.studiesForPatient(patient['key'])]
+      series = [serie for study in studies for serie in context.seriesForStudy(study['key'])]
+      perNodeTime = time.time() - start
+      perNodeRequests = len(requests_)
+      self.assertEqual((len(patients), len(studies), len(series)), (20, 100, 400))
+
+      # whole levels, one request each
+      del requests_[:]
+      context = SlicerChronicleContext(db)
+      start = time.time()
+      patients = context.patients()
+      studyLists = context.studiesForPatients([patient['key'] for patient in patients])
+      studies = [study for studyList in studyLists for study in studyList]
+      seriesLists = context.seriesForStudies([study['key'] for study in studies])
+      levelTime = time.time() - start
+      self.assertEqual(len(requests_), 3)
+      self.assertEqual(sum([len(seriesList) for seriesList in seriesLists]), 400)
+      self.assertEqual(context.seriesForStudy(studies[7]['key']), seriesLists[7])
+      self.assertEqual(len(requests_), 4) # revalidated, not refetched
+      self.assertEqual(context.counters['notModified'], 1)
+
+      # many series expanded with one keys query
+      seriesList = [serie['key'] for serie in seriesLists[0] + seriesLists[1]]
+      instanceLists = context.instancesForSeriesList(seriesList)
+      self.assertEqual(len(requests_), 5)
+      self.assertEqual([len(instanceList) for instanceList in instanceLists], [10] * len(seriesList))
+      self.assertEqual(instanceLists[0], context.instancesForSeries(seriesList[0]))
+      self.assertEqual(instanceLists[4], context.instancesForSeries(seriesList[4]))
+
+      # a changed instance only drops what it touches
+      context.changes = True # as if watching the feed
+      requestCount = len(requests_)
+      context.seriesForStudy(studies[0]['key'])
+      context.instancesForSeries(seriesList[0])
+      context.instancesForSeries(seriesList[4])
+      self.assertEqual(len(requests_), requestCount)
+      instances.append([['Hospital', 'mrn-0'], ['Study 0', 'study-0-0'], ['CT', 'Series 0', 'series-0-0-0'], 'instance-new'])
+      change = {'id': 'instance-new', 'doc': {'_id': 'instance-new', 'dataset': {
+                  '00100020': {'vr': 'LO', 'Value': 'mrn-0'},
+                  '0020000D': {'vr': 'UI', 'Value': 'study-0-0'},
+                  '0020000E': {'vr': 'UI', 'Value': 'series-0-0-0'}}}}
+      context.onChange(db, json.dumps(change).encode())
+      self.assertEqual(len(context.instancesForSeries(seriesList[0])), 11)
+      context.instancesForSeries(seriesList[4])
+      self.assertEqual(len(requests_), requestCount + 1)
+      self.assertEqual(sum([serie['value'] for serie in context.seriesForStudy(studies[0]['key'])]), 41)
+      context.changes = None
+    finally:
+      server.shutdown()
+      server.server_close()
+    self.delayDisplay("Context tree: %d requests in %.2fs per node, 3 in %.2fs by level" %
+            (perNodeRequests, perNodeTime, levelTime), 200)
+
+  def test_contextPages(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_contextPages()
+    '''
+    server, db, requests_, instances = self.localContextServer(patientCount=50, studiesPerPatient=10, instancesPerSeries=2)
+    try:
+      context = SlicerChronicleContext(db)
+      allSeries = context.viewList(context.levelOptions(3))
+      self.assertEqual(len(allSeries), 2000)
+
+      for prefetch in (False, True):
+        del requests_[:]
+        start = time.time()
+        series = list(context.iterSeries(pageSize=100, prefetch=prefetch))
+        elapsed = time.time() - start
+        self.assertEqual(series, allSeries)
+        self.assertEqual(len(requests_), 20)
+        self.delayDisplay("Paged %d series (prefetch %s) in %.2fs" % (len(series), prefetch, elapsed), 200)
+
+      # stopping early doesn't read the rest of the level
+      del requests_[:]
+      pages = context.iterSeries(pageSize=100)
+      firstRows = [next(pages) for row in range(150)]
+      pages.close()
+      self.assertEqual(firstRows, allSeries[:150])
+      self.assertLessEqual(len(requests_), 3)
+
+      patient = allSeries[0]['key'][:1]
+      study = allSeries[0]['key'][:2]
+      self.assertEqual(list(context.iterStudies(patient, pageSize=3)), context.studiesForPatient(patient))
+      self.assertEqual(list(context.iterSeries(study, pageSize=3)), context.seriesForStudy(study))
+      self.assertEqual(len(list(context.iterPatients(pageSize=7))), 50)
+
+      # map rows page with startkey_docid
+      instances.extend([instances[0][:3] + ['instance-extra-%d' % index] for index in range(5)])
+      self.assertEqual(list(context.iterInstances(allSeries[0]['key'], pageSize=2)),
+                       context.instancesForSeries(allSeries[0]['key']))
+      self.assertEqual(len(context.instancesForSeries(allSeries[0]['key'])), 7)
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def localServer(self, handlerClass):
+    """Start an http server on a free localhost port in a background
+    thread.  Returns the server; call shutdown() when done.
+    """
+    import http.server
+    import threading
+    class Server(http.server.ThreadingHTTPServer):
+      request_queue_size = 128 # room for concurrent clients connecting at once
+      daemon_threads = True
+    server = Server(('127.0.0.1', 0), handlerClass)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+  def test_instanceDownloaderBenchmark(self, instanceCount=200, instanceSize=512*1024, latency=0.01):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_instanceDownloaderBenchmark()
+    '''
+    import http.server
+    import shutil
+
+    # a stand-in for the chronicle server: serves fixed size payloads after
+    # a fixed per-request latency, with keep-alive enabled
+    payload = os.urandom(instanceSize)
+    class InstanceHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        time.sleep(latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/dicom')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(InstanceHandler)
+    baseURL = 'http://127.0.0.1:%d' % server.server_address[1]
+    tmpdir = tempfile.mkdtemp()
+    throughputs = {}
+    try:
+      for workers in (1, 2, 4, 8, 16):
+        downloader = InstanceDownloader(maxWorkers=workers)
+        pairs = [('%s/%d/object.dcm' % (baseURL, index), os.path.join(tmpdir, 'object-%d.dcm' % index))
+                  for index in range(instanceCount)]
+        start = time.time()
+        errors = [error for url, filePath, error in downloader.fetchAll(pairs) if error]
+        elapsed = time.time() - start
+        self.assertEqual(errors, [])
+        throughputs[workers] = instanceCount / elapsed
+        self.delayDisplay("%2d workers: %7.1f instances/s, %6.1f MB/s" %
+                (workers, throughputs[workers], throughputs[workers] * instanceSize / 1e6), 100)
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(tmpdir)
+    return throughputs
+
+  def test_instanceDownloaderRetries(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_instanceDownloaderRetries()
+    '''
+    import http.server
+
+    # /<status>/<failures> answers with status that many times, then 200
+    requests_ = []
+    class FlakyHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        requests_.append(self.path)
+        status, failures = map(int, self.path.strip('/').split('/'))
+        if requests_.count(self.path) > failures:
+          status = 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(FlakyHandler)
+    baseURL = 'http://127.0.0.1:%d' % server.server_address[1]
+    downloader = InstanceDownloader(retries=3, backoff=0)
+    filePath = os.path.join(tempfile.mkdtemp(), 'object.dcm')
+    try:
+      for status in (500, 503, 429):
+        self.assertEqual(downloader.fetch('%s/%d/2' % (baseURL, status), filePath), filePath)
+      for status in (400, 401, 403, 404, 409):
+        with self.assertRaises(requests.HTTPError):
+          downloader.fetch('%s/%d/1' % (baseURL, status), filePath)
+      with self.assertRaises(requests.HTTPError):
+        downloader.fetch('%s/500/9' % baseURL, filePath)
+    finally:
+      downloader.session.close()
+      server.shutdown()
+      server.server_close()
+      os.remove(filePath)
+      os.rmdir(os.path.dirname(filePath))
+    self.assertEqual(collections.Counter(requests_),
+        {'/500/2': 3, '/503/2': 3, '/429/2': 3, '/400/1': 1, '/401/1': 1,
+         '/403/1': 1, '/404/1': 1, '/409/1': 1, '/500/9': 4})
+    self.delayDisplay('Retried only transient download failures')
+
+  def test_instanceCache(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_instanceCache()
+    '''
+    import http.server
+    import shutil
+
+    # serves 1000 byte attachments with etags, honoring If-None-Match
+    requests_ = []
+    class AttachmentHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        requests_.append(self.path)
+        etag = '"%s"' % self.path.split('/')[1]
+        if self.headers.get('If-None-Match') == etag:
+          self.send_response(304)
+          self.send_header('ETag', etag)
+          self.end_headers()
+          return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', '1000')
+        self.end_headers()
+        self.wfile.write(b'x' * 1000)
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(AttachmentHandler)
+    baseURL = 'http://127.0.0.1:%d' % server.server_address[1]
+    cacheDir = tempfile.mkdtemp()
+    try:
+      cache = InstanceCache(cacheDir, maxBytes=2500)
+      urls = ['%s/%d/object.dcm' % (baseURL, index) for index in range(3)]
+      filePath = cache.fetch(urls[0], '0', revision='1-a')
+      self.assertEqual(os.path.getsize(filePath), 1000)
+      cache.fetch(urls[0], '0', revision='1-a') # no request
+      cache.fetch(urls[0], '0') # revalidated with a 304
+      self.assertEqual(len(requests_), 2)
+      cache.fetch(urls[1], '1')
+      cache.fetch(urls[2], '2') # over budget, evicts '0'
+      cache.save()
+
+      statistics = InstanceCache(cacheDir, maxBytes=2500).statistics()
+      self.delayDisplay("Cache statistics: %s" % cache.statistics(), 200)
+      self.assertEqual(cache.statistics()['hits'], 2)
+      self.assertEqual(cache.statistics()['revalidated'], 1)
+      self.assertEqual(cache.statistics()['bytesSaved'], 2000)
+      self.assertEqual(cache.statistics()['evictions'], 1)
+      self.assertEqual(statistics['entries'], 2)
+      self.assertFalse(os.path.exists(filePath))
+
+      # a pinned group is kept over budget until it is unpinned
+      cache = InstanceCache(cacheDir, maxBytes=2500)
+      cache.pin('series')
+      pinned = [cache.fetch(url, key, group='series') for url, key in zip(urls, ['3', '4', '5'])]
+      self.assertTrue(all([os.path.exists(path) for path in pinned]))
+      self.assertEqual(cache.statistics()['entries'], 3)
+      cache.unpin('series')
+      self.assertEqual(cache.statistics()['entries'], 2)
+      self.assertFalse(os.path.exists(pinned[0]))
+      cache.save()
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(cacheDir)
+
+  def test_archetypeRevisions(self, instanceCount=5):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_archetypeRevisions()
+    '''
+    import http.server
+    import shutil
+
+    # a stand-in for the chronicle database with one series of CT instances
+    classUID = '1.2.840.10008.5.1.4.1.1.2'
+    instanceUIDs = ['1.2.3.%d' % index for index in range(instanceCount)]
+    revisions = dict([(uid, '1-a') for uid in instanceUIDs])
+    requests_ = []
+    class ChronicleHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      disable_nagle_algorithm = True
+      def send(self, body, contentType='application/json', headers={}):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+          self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+          self.wfile.write(body)
+      def do_HEAD(self):
+        self.send(b'{}')
+      def do_GET(self):
+        requests_.append(self.path)
+        path = urllib.parse.urlsplit(self.path).path
+        if path.endswith('/seriesInstances'):
+          rows = [{'id': uid, 'key': '1.2.3', 'value': [classUID, uid]} for uid in instanceUIDs]
+          self.send(json.dumps({'total_rows': len(rows), 'offset': 0, 'rows': rows}).encode())
+        elif path.endswith('/object.dcm'):
+          uid = path.split('/')[-2]
+          self.send(b'dicom', 'application/dicom', {'ETag': '"%s"' % revisions[uid]})
+        else:
+          self.send(json.dumps({'db_name': 'chronicle', 'update_seq': 0}).encode())
+      def do_POST(self):
+        requests_.append(self.path)
+        keys = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['keys']
+        rows = [{'id': key, 'key': key, 'value': {'rev': revisions[key]}} for key in keys]
+        self.send(json.dumps({'total_rows': len(revisions), 'offset': 0, 'rows': rows}).encode())
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(ChronicleHandler)
+    cacheDir = tempfile.mkdtemp()
+    try:
+      cache = InstanceCache(cacheDir)
+      logic = SlicerChronicleLogic('http://127.0.0.1:%d' % server.server_address[1], instanceCache=cache)
+      def downloads():
+        return len([path for path in requests_ if path.endswith('/object.dcm')])
+      files = logic.fetchSeriesArchetypeFiles('1.2.3')
+      self.assertEqual(len(files), instanceCount)
+      self.assertEqual(downloads(), instanceCount)
+      # unchanged revisions are answered from the cache
+      self.assertEqual(logic.fetchSeriesArchetypeFiles('1.2.3'), files)
+      self.assertEqual(downloads(), instanceCount)
+      self.assertEqual(len([path for path in requests_ if '_all_docs' in path]), 2)
+      # a new revision is revalidated, a changed file downloaded again
+      revisions[instanceUIDs[0]] = '2-b'
+      logic.fetchSeriesArchetypeFiles('1.2.3')
+      self.assertEqual(downloads(), instanceCount + 1)
+      logic.cleanup()
+      cache.save()
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(cacheDir)
+    self.delayDisplay('Cached instances are checked by document revision')
+
+  def test_instanceDataset(self):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_instanceDataset()
+    '''
+    import http.server
+    import io
+    import pydicom.dataset
+    import pydicom.uid
+    import shutil
+
+    # a CT slice, and one whose header is longer than the first range
+    objects = {}
+    for instanceUID, privateBytes in (('1.2.3.1', 0), ('1.2.3.2', 200*1024)):
+      dataset = pydicom.dataset.Dataset()
+      dataset.file_meta = pydicom.dataset.FileMetaDataset()
+      dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+      dataset.file_meta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage
+      dataset.file_meta.MediaStorageSOPInstanceUID = instanceUID
+      dataset.SOPClassUID = pydicom.uid.CTImageStorage
+      dataset.SOPInstanceUID = instanceUID
+      dataset.PatientName = 'Chronicle^Test'
+      if privateBytes:
+        dataset.add_new(0x00290010, 'LO', 'CHRONICLE TEST')
+        dataset.add_new(0x00291010, 'OB', b'\0' * privateBytes)
+      dataset.Rows = dataset.Columns = 512
+      dataset.SamplesPerPixel = 1
+      dataset.PhotometricInterpretation = 'MONOCHROME2'
+      dataset.BitsAllocated = dataset.BitsStored = 16
+      dataset.HighBit = 15
+      dataset.PixelRepresentation = 0
+      dataset.PixelData = numpy.arange(512*512, dtype=numpy.uint16).tobytes()
+      buffer = io.BytesIO()
+      dataset.save_as(buffer, enforce_file_format=True)
+      objects[instanceUID] = buffer.getvalue()
+
+    # serves attachments, honoring single byte ranges
+    sent = []
+    class AttachmentHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        body = objects[self.path.split('/')[2]]
+        byteRange = self.headers.get('Range')
+        if byteRange:
+          first, last = [int(value) for value in byteRange.split('=')[1].split('-')]
+          self.send_response(206)
+          self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, min(last, len(body) - 1), len(body)))
+          body = body[first:last + 1]
+        else:
+          self.send_response(200)
+        sent.append(len(body))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(AttachmentHandler)
+    cacheDir = tempfile.mkdtemp()
+    try:
+      db = couchdb.Database('http://127.0.0.1:%d/chronicle' % server.server_address[1])
+      cache = InstanceCache(cacheDir)
+      context = SlicerChronicleContext(db, instanceCache=cache)
+      slice_ = {'value': [pydicom.uid.CTImageStorage, '1.2.3.1']}
+      longHeader = {'value': [pydicom.uid.CTImageStorage, '1.2.3.2']}
+
+      # the old way, through a file in the cache
+      start = time.time()
+      filePath = cache.fetch(db.resource().url + '/1.2.3.1/object.dcm', '1.2.3.1')
+      fromFile = pydicom.dcmread(filePath)
+      fileTime = time.time() - start
+      cache.discard('1.2.3.1')
+
+      del sent[:]
+      start = time.time()
+      dataset = context.instanceDataset(slice_)
+      memoryTime = time.time() - start
+      self.assertEqual(dataset.PixelData, fromFile.PixelData)
+      self.assertEqual(sent, [len(objects['1.2.3.1'])])
+      self.assertEqual([files for root, subFolders, files in os.walk(cacheDir) if files], [])
+
+      # headers without the pixels
+      del sent[:]
+      header = context.instanceDataset(slice_, headerOnly=True)
+      self.assertEqual(str(header.PatientName), 'Chronicle^Test')
+      self.assertEqual(header.Rows, 512)
+      self.assertFalse('PixelData' in header)
+      self.assertEqual(sent, [context.headerBytes])
+      del sent[:]
+      header = context.instanceDataset(longHeader, headerOnly=True)
+      self.assertEqual(len(header[0x00291010].value), 200*1024)
+      self.assertFalse('PixelData' in header)
+      self.assertEqual(sent, [context.headerBytes, 4 * context.headerBytes])
+      self.assertLess(sum(sent), len(objects['1.2.3.2']))
+
+      # cached instances are read locally
+      cache.fetch(db.resource().url + '/1.2.3.2/object.dcm', '1.2.3.2')
+      del sent[:]
+      self.assertEqual(context.instanceDataset(longHeader).PixelData, dataset.PixelData)
+      self.assertFalse('PixelData' in context.instanceDataset(longHeader, headerOnly=True))
+      self.assertEqual(sent, [])
+      cache.save()
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(cacheDir)
+    self.delayDisplay("Instance through the cache file in %.3fs, in memory in %.3fs; header in %d bytes of %d" %
+                      (fileTime, memoryTime, context.headerBytes, len(objects['1.2.3.1'])), 200)
+
+  def test_changesFeedBenchmark(self, changeCount=50000, chunkSize=1500):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_changesFeedBenchmark()
+    '''
+    import http.server
+    import select
+
+    # a stand-in for a busy continuous feed: chunk boundaries fall in the
+    # middle of lines, the way tcp segments do
+    lines = [json.dumps({'seq': seq, 'id': 'doc-%d' % seq, 'changes': [{'rev': '1-%032x' % seq}]})
+                for seq in range(1, changeCount + 1)]
+    lines.append(json.dumps({'last_seq': changeCount}))
+    body = ('\n'.join(lines) + '\n').encode()
+    class ChangesHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        if '_changes' not in self.path:
+          info = json.dumps({'db_name': 'bench', 'update_seq': 0}).encode()
+          self.send_response(200)
+          self.send_header('Content-Type', 'application/json')
+          self.send_header('Content-Length', str(len(info)))
+          self.end_headers()
+          self.wfile.write(info)
+          return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(body), chunkSize):
+          chunk = body[start:start + chunkSize]
+          self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(ChangesHandler)
+    try:
+      db = couchdb.Database('http://127.0.0.1:%d/bench' % server.server_address[1])
+      received = []
+      start = time.time()
+      changes = CouchChanges(db, lambda db, line: received.append(line))
+      # drive the reader directly rather than through the event loop
+      changes.notifier.setEnabled(False)
+      # (the reader closes the socket when the feed ends)
+      while changes.changesSocket:
+        select.select([changes.changesSocket], [], [], 5)
+        changes.onSocketNotify(0)
+      changes.stop()
+      elapsed = time.time() - start
+    finally:
+      server.shutdown()
+      server.server_close()
+
+    self.assertEqual(len(received), changeCount + 1)
+    self.assertEqual(json.loads(received[-2])['seq'], changeCount)
+    self.delayDisplay("Read %d changes in %.2fs: %.0f changes/s" %
+            (changeCount, elapsed, changeCount / elapsed), 200)
+    return changeCount / elapsed
+
+  def test_zipIngestBenchmark(self, memberCount=200, memberSize=256*1024, bandwidth=100e6, insertTime=0.002):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_zipIngestBenchmark()
+    '''
+    import http.server
+    import io
+    import shutil
+
+    def archive(compression, seekable=True):
+      """a study zip with DICOM-like members and a few other files"""
+      class Unseekable(io.BytesIO):
+        def seekable(self):
+          return False
+      buffer = io.BytesIO() if seekable else Unseekable()
+      with zipfile.ZipFile(buffer, 'w', compression) as zipFile:
+        zipFile.writestr('README.txt', 'not dicom')
+        for index in range(memberCount):
+          payload = b'\0' * 128 + b'DICM' + os.urandom(memberSize // 2) + b'\0' * (memberSize // 2)
+          zipFile.writestr('study/series/%d.dcm' % index, payload)
+        zipFile.writestr('study/DICOMDIR.txt', 'also not dicom')
+      return buffer.getvalue()
+
+    # serves the archive in slices paced to the given bandwidth
+    archives = {
+      '/deflated.zip': archive(zipfile.ZIP_DEFLATED),
+      '/streamed.zip': archive(zipfile.ZIP_DEFLATED, seekable=False),
+      '/stored.zip': archive(zipfile.ZIP_STORED, seekable=False),
+    }
+    class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        data = archives[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        sliceSize = 64 * 1024
+        for offset in range(0, len(data), sliceSize):
+          self.wfile.write(data[offset:offset+sliceSize])
+          time.sleep(sliceSize / bandwidth)
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(ArchiveHandler)
+    baseURL = 'http://127.0.0.1:%d' % server.server_address[1]
+    tmpdir = tempfile.mkdtemp()
+    try:
+      # download, then extract, then insert
+      start = time.time()
+      zipPath = os.path.join(tmpdir, 'study.zip')
+      with open(zipPath, 'wb') as fp:
+        for chunk in requests.get(baseURL + '/deflated.zip', stream=True).iter_content(1024*128):
+          fp.write(chunk)
+      sequentialDir = os.path.join(tmpdir, 'sequential')
+      with zipfile.ZipFile(zipPath) as zipFile:
+        zipFile.extractall(sequentialDir)
+      for root, subFolders, files in os.walk(sequentialDir):
+        for file_ in files:
+          time.sleep(insertTime)
+      sequential = time.time() - start
+
+      # all three stages overlapped
+      speedups = {}
+      for name in ('deflated', 'streamed', 'stored'):
+        outputDir = os.path.join(tmpdir, name)
+        os.mkdir(outputDir)
+        start = time.time()
+        pipeline = ZipIngestPipeline('%s/%s.zip' % (baseURL, name), outputDir)
+        for filePath in pipeline.files():
+          time.sleep(insertTime)
+        elapsed = time.time() - start
+        speedups[name] = sequential / elapsed
+        statistics = pipeline.statistics()
+        self.assertEqual(statistics['extractFiles'], memberCount)
+        self.assertEqual(statistics['extractSkipped'], 2)
+        self.assertEqual(statistics['insertFiles'], memberCount)
+        with open(os.path.join(outputDir, 'member-1.dcm'), 'rb') as fp:
+          self.assertEqual(fp.read(), zipfile.ZipFile(io.BytesIO(archives['/%s.zip' % name])).read('study/series/0.dcm'))
+        self.delayDisplay("%s: %.2fs pipelined vs %.2fs sequential; download %.1f MB/s, extract %.0f files/s, insert %.0f files/s" %
+                (name, elapsed, sequential, statistics['downloadMBPerSecond'],
+                 statistics['extractFilesPerSecond'], statistics['insertFilesPerSecond']), 100)
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(tmpdir)
+    return speedups
+
+  def test_seriesGeometryIndex(self, sliceCount=200, seedCount=10000):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_seriesGeometryIndex()
+    '''
+    # an oblique series with non-square pixels, laid out the way the
+    # dicom database returns instance values
+    class Database:
+      def __init__(self):
+        self.instances = {}
+        self.lookups = 0
+      def addSlice(self, index):
+        self.instances['1.2.3.%d' % index] = {
+          '0020,0032': '%g\\%g\\%g' % (-120. + index, -80.5, 30. + 2.5 * index),
+          '0020,0037': '0.9\\0.1\\0.4\\-0.1\\0.95\\0.3',
+          '0028,0010': '512',
+          '0028,0011': '384',
+          '0028,0030': '0.7\\0.8',
+        }
+      def instancesForSeries(self, seriesUID):
+        return list(self.instances.keys())
+      def instanceValue(self, instanceUID, tag):
+        self.lookups += 1
+        return self.instances[instanceUID][tag]
+
+    def seedToRAS(database, seedInstanceUID, seed):
+      """the scalar conversion that fetchAndSegmentSeries used to do"""
+      values = lambda tag: list(map(float, database.instanceValue(seedInstanceUID, tag).split('\\')))
+      positionLPS = values('0020,0032')
+      orientationLPS = values('0020,0037')
+      spacing = values('0028,0030')
+      rows = values('0028,0010')[0]
+      colums = values('0028,0011')[0]
+      pixelSeed = [seed[0] * colums, seed[1] * rows]
+      position = [-1. * positionLPS[0], -1. * positionLPS[1], positionLPS[2]]
+      row = [-1. * spacing[0] * orientationLPS[0], -1. * spacing[0] * orientationLPS[1], orientationLPS[2]]
+      column = [-1. * spacing[1] * orientationLPS[3], -1. * spacing[1] * orientationLPS[4], orientationLPS[5]]
+      return [ position[0] + pixelSeed[0] * row[0] + pixelSeed[1] * column[0],
+               position[1] + pixelSeed[0] * row[1] + pixelSeed[1] * column[1],
+               position[2] + pixelSeed[0] * row[2] + pixelSeed[1] * column[2] ]
+
+    database = Database()
+    for index in range(sliceCount):
+      database.addSlice(index)
+    random = numpy.random.RandomState(0)
+    instanceUIDs = ['1.2.3.%d' % index for index in random.randint(0, sliceCount, seedCount)]
+    seeds = random.random_sample((seedCount, 2))
+
+    start = time.time()
+    expected = numpy.array([seedToRAS(database, instanceUID, seed) for instanceUID, seed in zip(instanceUIDs, seeds)])
+    scalarTime = time.time() - start
+
+    # one seed reads only its own instance
+    index = SeriesGeometryIndex(database)
+    lookups = database.lookups
+    index.seedToRAS('series', instanceUIDs[0], seeds[0])
+    self.assertEqual(database.lookups - lookups, 5)
+    index.seedsToRAS('series', instanceUIDs, seeds) # read the rest
+    start = time.time()
+    ras = index.seedsToRAS('series', instanceUIDs, seeds)
+    vectorTime = time.time() - start
+    self.assertTrue(numpy.allclose(ras, expected))
+    self.assertEqual(index.seedToRAS('series', instanceUIDs[0], seeds[0]), list(expected[0]))
+    self.assertEqual(index.counters['builds'], 1)
+
+    # new instances in the series rebuild the index
+    database.addSlice(sliceCount)
+    ras = index.seedsToRAS('series', ['1.2.3.%d' % sliceCount], [[0.5, 0.5]])
+    self.assertTrue(numpy.allclose(ras[0], seedToRAS(database, '1.2.3.%d' % sliceCount, [0.5, 0.5])))
+    self.assertEqual(index.counters['builds'], 2)
+    self.assertRaises(ValueError, index.seedsToRAS, 'series', ['not.in.series'], [[0, 0]])
+
+    self.delayDisplay("%d seeds: %.1fms vectorized vs %.1fms one at a time" %
+            (seedCount, vectorTime * 1000, scalarTime * 1000), 200)
+    return scalarTime / vectorTime
+
+  def test_instanceTagIndex(self, instanceCount=2000):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_instanceTagIndex()
+    '''
+    import http.server
+
+    # chronicle documents with a realistic number of header elements
+    docs = {}
+    for index in range(instanceCount):
+      instanceUID = '1.2.3.%d' % index
+      dataset = {'%08X' % (0x00090000 + element): {'vr': 'LO', 'Value': 'filler %d' % element} for element in range(150)}
+      dataset.update({
+        '00080018': {'vr': 'UI', 'Value': instanceUID},
+        '0020000D': {'vr': 'UI', 'Value': '1.2.3.study.%d' % (index // 500)},
+        '0020000E': {'vr': 'UI', 'Value': '1.2.3.series.%d' % (index // 100)},
+        '00200032': {'vr': 'DS', 'Value': [-120. + index, -80.5, 30. + 2.5 * index]},
+        '00200037': {'vr': 'DS', 'Value': [1, 0, 0, 0, 1, 0]},
+        '00280010': {'vr': 'US', 'Value': 512},
+        '00280011': {'vr': 'US', 'Value': 384},
+        '00280030': {'vr': 'DS', 'Value': [0.7, 0.8]},
+      })
+      docs[instanceUID] = {'_id': instanceUID, '_rev': '1-a', 'dataset': dataset}
+
+    # a stand-in for couchdb with _find projections, _all_docs keys and single document GETs
+    requests_ = []
+    sent = []
+    findAvailable = [True]
+    class DocumentHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      disable_nagle_algorithm = True
+      def do_GET(self):
+        requests_.append(self.path)
+        self.respond(docs[self.path.split('/')[2]])
+      def do_POST(self):
+        requests_.append(self.path)
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if '/_find' in self.path:
+          if not findAvailable[0]:
+            return self.respond({'error': 'not_found'}, 404)
+          found = []
+          for instanceUID in query['selector']['_id']['$in']:
+            if instanceUID in docs:
+              doc = {'_id': instanceUID, 'dataset': {}}
+              for field in query['fields'][1:]:
+                tag = field.split('.')[1]
+                if tag in docs[instanceUID]['dataset']:
+                  doc['dataset'][tag] = docs[instanceUID]['dataset'][tag]
+              found.append(doc)
+          self.respond({'docs': found})
+        else:
+          rows = []
+          for instanceUID in query['keys']:
+            if instanceUID in docs:
+              rows.append({'id': instanceUID, 'key': instanceUID, 'value': {'rev': '1-a'}, 'doc': docs[instanceUID]})
+            else:
+              rows.append({'key': instanceUID, 'error': 'not_found'})
+          self.respond({'total_rows': len(docs), 'offset': 0, 'rows': rows})
+      def respond(self, result, status=200):
+        body = json.dumps(result).encode()
+        sent.append(len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(DocumentHandler)
+    try:
+      db = couchdb.Database('http://127.0.0.1:%d/chronicle' % server.server_address[1])
+      instanceUIDs = ['1.2.3.%d' % index for index in range(instanceCount)]
+
+      # the old way: a document per lookup
+      session = requests.Session()
+      start = time.time()
+      expected = [session.get(db.resource().url + '/' + instanceUID).json()['dataset']['0020000D']['Value']
+                    for instanceUID in instanceUIDs[:200]]
+      documentTime = (time.time() - start) * instanceCount / 200
+      documentBytes = sum(sent) * instanceCount / 200
+
+      del requests_[:]
+      del sent[:]
+      index = InstanceTagIndex(db, session)
+      start = time.time()
+      studyUIDs = index.values('0020,000d', instanceUIDs + ['1.2.3.missing'])
+      indexTime = time.time() - start
+      self.assertEqual(studyUIDs[:200], expected)
+      self.assertEqual(studyUIDs[-1], None)
+      self.assertEqual(len(requests_), 5)
+      indexBytes = sum(sent)
+      self.assertLess(indexBytes * 20, documentBytes)
+
+      # repeated lookups come from memory
+      self.assertEqual(index.value(instanceUIDs[7], '0020000D'), '1.2.3.study.0')
+      self.assertEqual(len(requests_), 5)
+
+      # missing instances are remembered as absent until invalidated
+      self.assertEqual(index.value('1.2.3.missing', '0020000D'), None)
+      self.assertEqual(index.value('1.2.3.missing', '00200032'), None)
+      self.assertEqual(len(requests_), 5)
+      docs['1.2.3.missing'] = dict(docs[instanceUIDs[7]], _id='1.2.3.missing')
+      index.invalidate(['1.2.3.missing'])
+      self.assertEqual(index.value('1.2.3.missing', '0020000D'), '1.2.3.study.0')
+      self.assertEqual(len(requests_), 6)
+      del docs['1.2.3.missing']
+
+      # without _find the whole documents are read, still in batches
+      findAvailable[0] = False
+      fallback = InstanceTagIndex(db, session, batchSize=1000)
+      self.assertEqual(fallback.values('0020000E', instanceUIDs[:1500]), index.values('0020000E', instanceUIDs[:1500]))
+      self.assertFalse(fallback.useFind)
+      findAvailable[0] = True
+
+      # series geometry from chronicle rather than the dicom database
+      seriesInstanceUIDs = instanceUIDs[:100]
+      class Database:
+        lookups = 0
+        def instancesForSeries(self, seriesUID):
+          return seriesInstanceUIDs
+        def instanceValue(self, instanceUID, tag):
+          self.lookups += 1
+          return ''
+      database = Database()
+      del requests_[:]
+      geometry = SeriesGeometryIndex(database, tagIndex=InstanceTagIndex(db, session))
+      ras = geometry.seedToRAS('1.2.3.series.0', instanceUIDs[3], [0.5, 0.5])
+      self.assertEqual(database.lookups, 0)
+      self.assertEqual(len(requests_), 1)
+      self.assertTrue(numpy.allclose(ras, [117. - 0.7 * 192, 80.5 - 0.8 * 256, 30. + 2.5 * 3]))
+
+      # slices only in the dicom database cost one request per build
+      seriesInstanceUIDs = instanceUIDs[:100] + ['1.2.3.local.%d' % index for index in range(10)]
+      geometry.seedsToRAS('1.2.3.series.0', seriesInstanceUIDs[100:], [[0.5, 0.5]] * 10)
+      self.assertEqual(len(requests_), 2)
+      self.assertEqual(database.lookups, 50)
+    finally:
+      server.shutdown()
+      server.server_close()
+
+    self.delayDisplay("Study UIDs of %d instances: %.2fs and %.1fMB by document, %.2fs and %.1fMB from the index" %
+                      (instanceCount, documentTime, documentBytes / 1e6, indexTime, indexBytes / 1e6), 200)
+    return documentTime / indexTime
+
+  def test_asyncClientBenchmark(self, docCount=1000, latency=0.005, concurrency=100):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_asyncClientBenchmark()
+    '''
+    import http.server
+
+    # a stand-in for the chronicle database: documents with ETags after a
+    # fixed per-request latency, one redirect, and connections that are
+    # dropped without a response, once for a GET and always for a POST
+    docs = {'doc-%d' % index: {'_id': 'doc-%d' % index, '_rev': '1-a', 'index': index} for index in range(docCount)}
+    requests_ = []
+    dropped = []
+    posts = []
+    class DocumentHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      disable_nagle_algorithm = True
+      def send(self, status, body, headers={}):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+          self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+      def do_GET(self):
+        requests_.append(self.path)
+        time.sleep(latency)
+        id = urllib.parse.unquote(self.path.split('/')[-1])
+        if id == 'moved':
+          self.send_response(301)
+          self.send_header('Location', '/chronicle/doc-1')
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+        elif id == 'flaky' and not dropped:
+          dropped.append(id)
+          self.close_connection = True
+        elif id in docs or id == 'flaky':
+          doc = docs.get(id, {'_id': id})
+          etag = '"%s"' % doc.get('_rev', '0')
+          if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+          else:
+            self.send(200, doc, {'ETag': etag})
+        else:
+          self.send(404, {'error': 'not_found', 'reason': 'missing'})
+      def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        posts.append(self.path)
+        self.close_connection = True
+      def log_message(self, *args):
+        pass
+
+    server = self.localServer(DocumentHandler)
+    url = 'http://127.0.0.1:%d/chronicle' % server.server_address[1]
+    ids = sorted(docs.keys())
+    try:
+      start = time.time()
+      db = couchdb.Database(url)
+      syncDocs = [db[id] for id in ids]
+      syncTime = time.time() - start
+
+      async def fetch():
+        database = AsyncDatabase(url, AsyncSession(maxConnections=concurrency))
+        try:
+          start = time.time()
+          asyncDocs = await database.getMany(ids)
+          asyncTime = time.time() - start
+
+          # the same semantics as the synchronous session
+          del requests_[:]
+          self.assertEqual(await database.get(ids[0]), asyncDocs[0])
+          self.assertEqual(database.session.counters['revalidated'], 1)
+          self.assertEqual((await database.get('moved'))['_id'], 'doc-1')
+          self.assertEqual(await database.get('missing', 'default'), 'default')
+          with self.assertRaises(couchdb.ResourceNotFound):
+            await database.resource.get_json('missing')
+          self.assertEqual((await database.get('flaky'))['_id'], 'flaky')
+          self.assertEqual(dropped, ['flaky'])
+          self.assertLessEqual(database.session.counters['connections'], concurrency + 1)
+
+          # concurrent misses of one url leave a single cache entry
+          shared = AsyncDatabase(url, AsyncSession(maxConnections=5))
+          try:
+            await asyncio.gather(*[shared.get(ids[2]) for index in range(5)])
+            self.assertEqual(len(shared.session.cache), 1)
+            self.assertEqual(shared.session.cacheSize, sum(len(entry[3]) for entry in shared.session.cache.values()))
+          finally:
+            await shared.session.close()
+
+          # a GET dropped on a reused connection is sent again in the slot
+          # it holds, a POST is not
+          single = AsyncDatabase(url, AsyncSession(maxConnections=1, timeout=5))
+          try:
+            del dropped[:]
+            await single.get(ids[1])
+            self.assertEqual((await single.get('flaky'))['_id'], 'flaky')
+            self.assertEqual(single.session.counters['stale'], 1)
+            with self.assertRaises(AsyncSession.retryableErrors):
+              await single.resource.request('POST', '_bulk_docs', body={'docs': []})
+            self.assertEqual(posts, ['/chronicle/_bulk_docs'])
+          finally:
+            await single.session.close()
+          return asyncDocs, asyncTime
+        finally:
+          await database.session.close()
+      asyncDocs, asyncTime = asyncio.run(fetch())
+    finally:
+      server.shutdown()
+      server.server_close()
+
+    self.assertEqual([dict(doc) for doc in syncDocs], asyncDocs)
+    self.delayDisplay("%d documents: %.2fs with couchdb.Database, %.2fs with AsyncDatabase (%d concurrent)" %
+                      (docCount, syncTime, asyncTime, concurrency), 200)
+    return syncTime / asyncTime
+
+  def test_bulkIndexerDatabase(self, fileCount=20):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_bulkIndexerDatabase()
+    '''
+    import pydicom.dataset
+    import pydicom.uid
+    import shutil
+
+    # one series of small secondary captures, streamed in with a repeat
+    tmpdir = tempfile.mkdtemp()
+    studyUID, seriesUID = pydicom.uid.generate_uid(), pydicom.uid.generate_uid()
+    filePaths = []
+    for index in range(fileCount):
+      instanceUID = pydicom.uid.generate_uid()
+      dataset = pydicom.dataset.Dataset()
+      dataset.file_meta = pydicom.dataset.FileMetaDataset()
+      dataset.file_meta.MediaStorageSOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+      dataset.file_meta.MediaStorageSOPInstanceUID = instanceUID
+      dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+      dataset.SOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+      dataset.SOPInstanceUID = instanceUID
+      dataset.PatientID, dataset.PatientName = 'bulkIndexer', 'Bulk^Indexer'
+      dataset.StudyInstanceUID, dataset.SeriesInstanceUID = studyUID, seriesUID
+      dataset.Modality, dataset.InstanceNumber = 'OT', index + 1
+      dataset.Rows, dataset.Columns = 8, 8
+      dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 16, 15
+      dataset.SamplesPerPixel, dataset.PixelRepresentation = 1, 0
+      dataset.PhotometricInterpretation = 'MONOCHROME2'
+      dataset.PixelData = os.urandom(8 * 8 * 2)
+      filePath = os.path.join(tmpdir, '%d.dcm' % index)
+      dataset.save_as(filePath, enforce_file_format=True)
+      filePaths.append(filePath)
+
+    # through ctkDICOMIndexer into a temporary database, as chronicleLoad does
+    originalDatabaseDirectory = DICOMUtils.openTemporaryDatabase('SlicerChronicleBulkIndexerTest')
+    try:
+      progress = []
+      indexer = BulkDICOMIndexer(slicer.dicomDatabase, batchSize=8, scanChunkSize=5)
+      statistics = indexer.indexFiles(iter(filePaths + filePaths[:1]), progress.append)
+      self.assertEqual(statistics['inserted'], fileCount)
+      self.assertEqual(statistics['duplicates'], 1)
+      self.assertEqual(statistics['batches'], 3)
+      self.assertEqual(len(progress), 3)
+      self.assertEqual(len(slicer.dicomDatabase.filesForSeries(seriesUID)), fileCount)
+    finally:
+      DICOMUtils.closeTemporaryDatabase(originalDatabaseDirectory)
+      shutil.rmtree(tmpdir)
+    self.delayDisplay("Indexed %d files in %d batches" % (fileCount, statistics['batches']), 200)
+
+  def test_bulkIndexerBenchmark(self, fileCount=10000, duplicateFraction=0.1, transactionTime=0.001):
+    '''
+    import SlicerChronicleComponentsTest; SlicerChronicleComponentsTest.SlicerChronicleComponentsTest().test_bulkIndexerBenchmark()
+    '''
+    import pydicom.dataset
+    import pydicom.uid
+    import shutil
+
+    # small secondary captures, some repeated and some already indexed,
+    # plus a few files that are not DICOM at all
+    tmpdir = tempfile.mkdtemp()
+    instanceUIDs = []
+    for index in range(fileCount):
+      if instanceUIDs and index % int(1 / duplicateFraction) == 0:
+        instanceUID = instanceUIDs[index // 2]
+      else:
+        instanceUID = pydicom.uid.generate_uid()
+      instanceUIDs.append(instanceUID)
+      dataset = pydicom.dataset.Dataset()
+      dataset.file_meta = pydicom.dataset.FileMetaDataset()
+      dataset.file_meta.MediaStorageSOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+      dataset.file_meta.MediaStorageSOPInstanceUID = instanceUID
+      dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+      dataset.SOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+      dataset.SOPInstanceUID = instanceUID
+      dataset.Rows, dataset.Columns = 64, 64
+      dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 16, 15
+      dataset.SamplesPerPixel, dataset.PixelRepresentation = 1, 0
+      dataset.PhotometricInterpretation = 'MONOCHROME2'
+      dataset.PixelData = os.urandom(64 * 64 * 2)
+      subdir = os.path.join(tmpdir, 'series-%d' % (index // 1000))
+      if not os.path.exists(subdir):
+        os.mkdir(subdir)
+      dataset.save_as(os.path.join(subdir, '%d.dcm' % index), enforce_file_format=True)
+    for index in range(10):
+      with open(os.path.join(tmpdir, 'notes-%d.txt' % index), 'w') as fp:
+        fp.write('not dicom')
+    alreadyIndexed = set(instanceUIDs[:100])
+
+    # a stand-in for the dicom database, each insert call is one transaction
+    class Database:
+      def __init__(self):
+        self.files = {}
+      def fileForInstance(self, instanceUID):
+        return self.files.get(instanceUID, tmpdir if instanceUID in alreadyIndexed else '')
+      def insert(self, filePaths):
+        time.sleep(transactionTime)
+        for filePath in filePaths:
+          self.files[pydicom.dcmread(filePath, stop_before_pixels=True).SOPInstanceUID] = filePath
+
+    try:
+      # one file at a time, as chronicleLoad used to
+      database = Database()
+      start = time.time()
+      for root, subFolders, files in os.walk(tmpdir):
+        for file_ in files:
+          filePath = os.path.join(root, file_)
+          try:
+            database.insert([filePath])
+          except pydicom.errors.InvalidDicomError:
+            pass
+      perFile = time.time() - start
+
+      database = Database()
+      indexer = BulkDICOMIndexer(database, insertBatch=database.insert)
+      statistics = indexer.index(tmpdir)
+      uniqueCount = len(set(instanceUIDs) - alreadyIndexed)
+      self.assertEqual(statistics['files'], fileCount + 10)
+      self.assertEqual(statistics['skipped'], 10)
+      self.assertEqual(statistics['inserted'], uniqueCount)
+      self.assertEqual(statistics['duplicates'], fileCount - uniqueCount)
+      self.assertEqual(len(database.files), uniqueCount)
+      self.delayDisplay("Indexed %d files in %.2fs (%.0f files/s, %d batches) vs %.2fs one at a time" %
+              (statistics['files'], statistics['totalSeconds'], statistics['filesPerSecond'],
+               statistics['batches'], perFile), 200)
+    finally:
+      shutil.rmtree(tmpdir)
+    return perFile / statistics['totalSeconds']
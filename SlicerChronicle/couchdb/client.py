@@ -23,9 +23,12 @@ False
 >>> del server['python-tests']
 """
 
+from collections import deque
 import itertools
 import mimetypes
 import os
+import re
+import threading
 from types import FunctionType
 from inspect import getsource
 from textwrap import dedent
@@ -33,8 +36,10 @@ import re
 import warnings
 
 from couchdb import http, json
+from SlicerChronicleLib.CouchStreams import ViewRowParser
 
-__all__ = ['Server', 'Database', 'Document', 'ViewResults', 'Row']
+__all__ = ['Server', 'Database', 'Document', 'ViewResults', 'RowStream',
+           'Row']
 __docformat__ = 'restructuredtext en'
 
 
@@ -553,6 +558,53 @@ class Database(object):
         else:
             return data
 
+    def get_many(self, ids, default=None, chunk_size=500, workers=1,
+                 **options):
+        """Return an iterator over the documents with the given IDs, in the
+        same order, with `default` in place of any missing or deleted
+        document.
+
+        >>> server = Server()
+        >>> db = server.create('python-tests')
+        >>> db['gotham'] = dict(type='City', name='Gotham City')
+        >>> db['metropolis'] = dict(type='City', name='Metropolis')
+        >>> for doc in db.get_many(['metropolis', 'smallville', 'gotham']):
+        ...     print doc and doc['name']
+        Metropolis
+        None
+        Gotham City
+
+        >>> del server['python-tests']
+
+        The IDs are sent in chunks of `chunk_size` to ``_all_docs`` with
+        ``include_docs=true``, so N documents take N / chunk_size requests
+        instead of N, and each response is decoded as it is read.  With
+        `workers` greater than one, that many chunks are requested at once
+        on separate threads; the chunks after the first are then held in
+        memory until their turn.  `ids` may be any iterable, including a
+        generator, and is consumed only as far as the chunks in flight.
+
+        :param ids: the document IDs
+        :param default: the value returned for documents that are not found
+        :param chunk_size: the number of IDs per request
+        :param workers: the number of requests in flight at a time
+        :param options: optional query string parameters for ``_all_docs``
+        :return: an iterator over `Document` objects or `default`
+        """
+        if chunk_size <= 0:
+            raise ValueError('chunk_size must be 1 or more')
+        ids = iter(ids)
+        chunks = iter(lambda: list(itertools.islice(ids, chunk_size)), [])
+        return _pipelined(lambda chunk: self._get_chunk(chunk, default, options),
+                          chunks, workers)
+
+    def _get_chunk(self, ids, default, options):
+        options = dict(options, keys=ids, include_docs=True)
+        _, _, body = _stream_viewlike(self.resource('_all_docs'), options)
+        for row in RowStream(body):
+            # missing documents have an error, deleted ones a null doc
+            yield row.doc or default
+
     def revisions(self, id, **options):
         """Return all available revisions of the given document.
 
@@ -781,6 +833,122 @@ class Database(object):
 
         return results
 
+    def update_many(self, documents, batch_size=500, batch_bytes=1024 * 1024,
+                    workers=1, resolve=None, retries=3, **options):
+        """Perform a bulk update or insertion of a stream of documents in
+        batches, yielding the result of each document as its batch completes.
+
+        >>> server = Server()
+        >>> db = server.create('python-tests')
+        >>> docs = (Document(type='Person', index=i) for i in range(5))
+        >>> for result in db.update_many(docs, batch_size=2):
+        ...     print repr(result) #doctest: +ELLIPSIS
+        (True, '...', '...')
+        (True, '...', '...')
+        (True, '...', '...')
+        (True, '...', '...')
+        (True, '...', '...')
+
+        >>> del server['python-tests']
+
+        The results are the ``(success, docid, rev_or_exc)`` tuples of
+        `update`, in the order of `documents`, which may be any iterable
+        and is only read as far as the batches in flight.  A batch is sent
+        to ``_bulk_docs`` once it holds `batch_size` documents or the next
+        document would take its encoded size past `batch_bytes`; with
+        `workers` greater than one, that many batches are sent at once on
+        separate threads.
+
+        Documents rejected with a conflict are passed to `resolve` along
+        with the current version from the database (or `None` if it has
+        since been deleted); it returns the document to save in their place,
+        typically with the current ``_rev`` and merged content, or `None` to
+        report the conflict.  Resolved documents are sent again, at most
+        `retries` times.
+
+        With ``new_edits=False`` the server reports only the documents it
+        could not store, if any, and the others are reported saved with
+        the ``_rev`` they were given.  A document missing from any other
+        response is reported as failed with a `ServerError`.
+
+        :param documents: an iterable of dictionaries or `Document` objects,
+                          or objects providing a ``items()`` method
+        :param batch_size: the most documents per request
+        :param batch_bytes: the most encoded bytes of documents per request,
+                            unless a single document is larger
+        :param workers: the number of requests in flight at a time
+        :param resolve: an optional callable ``resolve(doc, current)``
+                        returning the document to retry a conflict with
+        :param retries: the most times a conflicted document is retried
+        :param options: further ``_bulk_docs`` request fields, such as
+                        ``all_or_nothing``
+        :return: an iterator over the resulting documents
+        """
+        if batch_size <= 0:
+            raise ValueError('batch_size must be 1 or more')
+
+        def batches():
+            batch, size = [], 0
+            for doc in documents:
+                doc = _as_doc_dict(doc)
+                data = json.encode(doc).encode('utf-8')
+                if batch and (len(batch) >= batch_size or
+                              size + len(data) > batch_bytes):
+                    yield batch
+                    batch, size = [], 0
+                batch.append((doc, data))
+                size += len(data) + 1
+            if batch:
+                yield batch
+
+        return _pipelined(lambda batch: self._update_batch(batch, resolve,
+                                                           retries, options),
+                          batches(), workers)
+
+    def _update_batch(self, batch, resolve, retries, options):
+        tail = '}'
+        if options:
+            tail = ',' + json.encode(options).encode('utf-8')[1:]
+        results = [None] * len(batch)
+        todo = range(len(batch))
+        for attempt in range(retries + 1):
+            body = '{"docs":[' + ','.join(batch[idx][1] for idx in todo) + \
+                   ']' + tail
+            _, _, data = self.resource.post_json('_bulk_docs', body=body,
+                headers={'Content-Type': 'application/json'})
+            if len(data) != len(todo):
+                data = _match_bulk_results([batch[idx][0] for idx in todo],
+                                           data, options)
+
+            conflicts = []
+            for idx, result in zip(todo, data):
+                if 'error' in result:
+                    if result['error'] == 'conflict':
+                        exc_type = http.ResourceConflict
+                        conflicts.append(idx)
+                    else:
+                        exc_type = http.ServerError
+                    results[idx] = (False, result['id'],
+                                    exc_type(result['reason']))
+                else:
+                    batch[idx][0].update({'_id': result['id'],
+                                          '_rev': result['rev']})
+                    results[idx] = (True, result['id'], result['rev'])
+            if not conflicts or resolve is None or attempt == retries:
+                break
+
+            todo = []
+            ids = [results[idx][1] for idx in conflicts]
+            for idx, current in zip(conflicts, self.get_many(ids)):
+                doc = resolve(batch[idx][0], current)
+                if doc is not None:
+                    doc = _as_doc_dict(doc)
+                    batch[idx] = (doc, json.encode(doc).encode('utf-8'))
+                    todo.append(idx)
+            if not todo:
+                break
+        return results
+
     def purge(self, docs):
         """Perform purging (complete removing) of the given documents.
 
@@ -946,6 +1114,69 @@ class Database(object):
         return data
 
 
+def _as_doc_dict(doc):
+    """Return the document as a dictionary for a bulk update."""
+    if isinstance(doc, dict):
+        return doc
+    elif hasattr(doc, 'items'):
+        return dict(doc.items())
+    raise TypeError('expected dict, got %s' % type(doc))
+
+
+def _match_bulk_results(docs, data, options):
+    """Line up a ``_bulk_docs`` response that has fewer results than
+    documents with the documents, by id."""
+    by_id = dict((result.get('id'), result) for result in data)
+    matched = []
+    for doc in docs:
+        result = by_id.get(doc.get('_id'))
+        if result is None:
+            if options.get('new_edits') is False:
+                result = {'id': doc.get('_id'), 'rev': doc.get('_rev')}
+            else:
+                result = {'id': doc.get('_id'), 'error': 'missing',
+                          'reason': 'No result in the _bulk_docs response'}
+        matched.append(result)
+    return matched
+
+
+def _pipelined(func, chunks, workers):
+    """Yield the items of ``func(chunk)`` for each chunk in turn, with up
+    to `workers` chunks processed at once on separate threads.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            for item in func(chunk):
+                yield item
+        return
+
+    def run(chunk, result):
+        try:
+            result.append(list(func(chunk)))
+        except Exception, e:
+            result.append(e)
+
+    def join(thread, result):
+        thread.join()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    pending = deque()
+    for chunk in chunks:
+        result = []
+        thread = threading.Thread(target=run, args=(chunk, result))
+        thread.daemon = True
+        thread.start()
+        pending.append((thread, result))
+        if len(pending) >= workers:
+            for item in join(*pending.popleft()):
+                yield item
+    while pending:
+        for item in join(*pending.popleft()):
+            yield item
+
+
 def _doc_resource(base, doc_id):
     """Return the resource for the given document id.
     """
@@ -1014,6 +1245,9 @@ class View(object):
     def _exec(self, options):
         raise NotImplementedError
 
+    def _stream(self, options):
+        raise NotImplementedError
+
 
 class PermanentView(View):
     """Representation of a permanent view on the server."""
@@ -1029,6 +1263,10 @@ class PermanentView(View):
         _, _, data = _call_viewlike(self.resource, options)
         return data
 
+    def _stream(self, options):
+        _, _, data = _stream_viewlike(self.resource, options)
+        return data
+
 
 class TemporaryView(View):
     """Representation of a temporary view."""
@@ -1051,6 +1289,12 @@ class TemporaryView(View):
                                self.reduce_fun)
 
     def _exec(self, options):
+        return self._post(self.resource.post_json, options)
+
+    def _stream(self, options):
+        return self._post(self.resource.post, options)
+
+    def _post(self, post, options):
         body = {'map': self.map_fun, 'language': self.language}
         if self.reduce_fun:
             body['reduce'] = self.reduce_fun
@@ -1058,7 +1302,7 @@ class TemporaryView(View):
             options = options.copy()
             body['keys'] = options.pop('keys')
         content = json.encode(body).encode('utf-8')
-        _, _, data = self.resource.post_json(body=content, headers={
+        _, _, data = post(body=content, headers={
             'Content-Type': 'application/json'
         }, **_encode_view_options(options))
         return data
@@ -1088,6 +1332,18 @@ def _call_viewlike(resource, options):
         return resource.get_json(**_encode_view_options(options))
 
 
+def _stream_viewlike(resource, options):
+    """Call a resource that takes view-like options, leaving the response
+    body unread.
+    """
+    if 'keys' in options:
+        options = options.copy()
+        keys = {'keys': options.pop('keys')}
+        return resource.post(body=keys, **_encode_view_options(options))
+    else:
+        return resource.get(**_encode_view_options(options))
+
+
 class ViewResults(object):
     """Representation of a parameterized view (either permanent or temporary)
     and the results it produces.
@@ -1160,11 +1416,33 @@ class ViewResults(object):
         return len(self.rows)
 
     def _fetch(self):
-        data = self.view._exec(self.options)
-        wrapper = self.view.wrapper or Row
-        self._rows = [wrapper(row) for row in data['rows']]
-        self._total_rows = data.get('total_rows')
-        self._offset = data.get('offset', 0)
+        stream = self.stream()
+        self._rows = list(stream)
+        self._total_rows = stream.total_rows
+        self._offset = stream.offset or 0
+
+    def stream(self):
+        """Request the view again and return its rows as they are read
+        from the response, without keeping them.
+
+        >>> server = Server()
+        >>> db = server.create('python-tests')
+        >>> db['johndoe'] = dict(type='Person', name='John Doe')
+        >>> db['maryjane'] = dict(type='Person', name='Mary Jane')
+        >>> rows = db.view('_all_docs').stream()
+        >>> for row in rows:
+        ...     print row.id
+        ...     break
+        johndoe
+        >>> rows.close()
+        >>> rows.total_rows
+        2
+
+        >>> del server['python-tests']
+
+        :rtype: `RowStream`
+        """
+        return RowStream(self.view._stream(self.options), self.view.wrapper)
 
     @property
     def rows(self):
@@ -1201,6 +1479,87 @@ class ViewResults(object):
         return self._offset
 
 
+class RowStream(object):
+    """Rows of a view response, decoded one at a time as the body is read.
+
+    Only the row being decoded and the unparsed remainder of the last read
+    are kept in memory.  `total_rows`, `offset` and any other top level
+    fields of the response are available once the parser has seen them,
+    which for CouchDB is before the first row; they are `None` until then.
+
+    >>> from StringIO import StringIO
+    >>> body = StringIO('{"total_rows":3,"offset":1,"rows":[\\r\\n'
+    ...                 '{"id":"a","key":1,"value":null},\\r\\n'
+    ...                 '{"id":"b","key":2,"value":"]"}\\r\\n'
+    ...                 ']}')
+    >>> rows = RowStream(body, chunk_size=8)
+    >>> [row.id for row in rows]
+    [u'a', u'b']
+    >>> rows.total_rows, rows.offset
+    (3, 1)
+
+    Stop early by calling `close()`; a streamed response is then abandoned
+    along with its connection rather than read to the end.
+
+    Rows are decoded with `couchdb.json`, so a decoder chosen with
+    `json.use()` applies, by the `ViewRowParser` of
+    `SlicerChronicleLib.CouchStreams`, which the SlicerChronicle module
+    uses as well.
+    """
+
+    def __init__(self, body, wrapper=None, chunk_size=http.CHUNK_SIZE * 8):
+        self.body = body
+        self.wrapper = wrapper or Row
+        self.chunk_size = chunk_size
+        # The generator must not refer back to the stream: Python 2 never
+        # collects a cycle through a suspended generator, so a stream that
+        # was dropped part way would keep its response, and the pooled
+        # connection, forever.
+        parser = ViewRowParser(json.decode)
+        self.fields = parser.fields
+        self._rows = _iter_rows(body, parser, self.wrapper, chunk_size)
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.fields)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._rows.next()
+
+    def close(self):
+        """Stop reading the response."""
+        self._rows.close()
+
+    @property
+    def total_rows(self):
+        return self.fields.get('total_rows')
+
+    @property
+    def offset(self):
+        return self.fields.get('offset')
+
+
+def _iter_rows(body, parser, wrapper, chunk_size):
+    """Feed the body to the parser, yielding the wrapped rows."""
+    eof = False
+    try:
+        while True:
+            data = body.read(chunk_size)
+            if not data:
+                eof = True
+                parser.close()
+                return
+            for row in parser.feed(data):
+                yield wrapper(row)
+    finally:
+        if not eof and hasattr(body, 'abort'):
+            body.abort()
+        elif hasattr(body, 'close'):
+            body.close()
+
+
 class Row(dict):
     """Representation of a row as returned by database views."""
 
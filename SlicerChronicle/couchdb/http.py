@@ -12,9 +12,12 @@ standard library.
 """
 
 from base64 import b64encode
-from datetime import datetime
+from collections import OrderedDict
 import errno
+from hashlib import sha1
 from httplib import BadStatusLine, HTTPConnection, HTTPSConnection
+import os
+import select
 import socket
 import time
 try:
@@ -23,18 +26,17 @@ except ImportError:
     from StringIO import StringIO
 import sys
 try:
-    from threading import Lock
+    from threading import Condition, Lock
 except ImportError:
-    from dummy_threading import Lock
+    from dummy_threading import Condition, Lock
 import urllib
 from urlparse import urlsplit, urlunsplit
-from email.Utils import parsedate
 
 from couchdb import json
 
 __all__ = ['HTTPError', 'PreconditionFailed', 'ResourceNotFound',
            'ResourceConflict', 'ServerError', 'Unauthorized', 'RedirectLimit',
-           'Session', 'Resource']
+           'PoolTimeout', 'Session', 'Resource']
 __docformat__ = 'restructuredtext en'
 
 
@@ -163,13 +165,20 @@ class RedirectLimit(Exception):
     """
 
 
+class PoolTimeout(Exception):
+    """Exception raised when no connection became available within the
+    connection pool's acquire timeout.
+    """
+
+
 CHUNK_SIZE = 1024 * 8
 
 class ResponseBody(object):
 
-    def __init__(self, resp, callback):
+    def __init__(self, resp, callback, conn=None):
         self.resp = resp
         self.callback = callback
+        self.conn = conn
 
     def read(self, size=None):
         bytes = self.resp.read(size)
@@ -184,6 +193,27 @@ class ResponseBody(object):
             self.callback()
             self.callback = None
 
+    def abort(self):
+        """Stop reading the body before its end.
+
+        Rather than draining the rest of the body like `close()`, the
+        connection is closed (it reconnects when next used) and released.
+        """
+        if self.resp.isclosed() or self.conn is None:
+            self.close()
+            return
+        self.conn.close()
+        self.resp.close()
+        if self.callback:
+            self.callback()
+            self.callback = None
+
+    def __del__(self):
+        # A body dropped before its end would otherwise hold on to its
+        # connection, and its place in the pool, forever.
+        if self.callback:
+            self.abort()
+
     def iterchunks(self):
         assert self.resp.msg.get('transfer-encoding') == 'chunked'
         while True:
@@ -193,7 +223,9 @@ class ResponseBody(object):
             if not chunksz:
                 self.resp.fp.read(2) #crlf
                 self.resp.close()
-                self.callback()
+                if self.callback:
+                    self.callback()
+                    self.callback = None
                 break
             chunk = self.resp.fp.read(chunksz)
             for ln in chunk.splitlines():
@@ -212,32 +244,35 @@ RETRYABLE_ERRORS = frozenset([
 class Session(object):
 
     def __init__(self, cache=None, timeout=None, max_redirects=5,
-                 retry_delays=[0], retryable_errors=RETRYABLE_ERRORS):
+                 retry_delays=[0], retryable_errors=RETRYABLE_ERRORS,
+                 pool=None):
         """Initialize an HTTP client session.
 
-        :param cache: an instance with a dict-like interface or None to allow
-                      Session to create a dict for caching.
+        :param cache: a `Cache`, or any object with its `get`, `put` and
+                      `remove` methods, or a dict of initial responses by
+                      URL, or `None` for a default `Cache`.
         :param timeout: socket timeout in number of seconds, or `None` for no
                         timeout (the default)
         :param retry_delays: list of request retry delays.
+        :param pool: a `ConnectionPool` with other limits than the defaults,
+                     or `None`
         """
         from couchdb import __version__ as VERSION
         self.user_agent = 'CouchDB-Python/%s' % VERSION
-        # XXX We accept a `cache` dict arg, but the ref gets overwritten later
-        # during cache cleanup. Do we remove the cache arg (does using a shared
-        # Session instance cover the same use cases?) or fix the cache cleanup?
-        # For now, let's just assign the dict to the Cache instance to retain
-        # current behaviour.
-        if cache is not None:
-            cache_by_url = cache
+        if cache is None:
             cache = Cache()
-            cache.by_url = cache_by_url
-        else:
+        elif not hasattr(cache, 'put'):
+            responses = cache
             cache = Cache()
+            for url, response in responses.items():
+                cache.put(url, response)
         self.cache = cache
+        self.cache_counters = {'revalidated': 0}
         self.max_redirects = max_redirects
         self.perm_redirects = {}
-        self.connection_pool = ConnectionPool(timeout)
+        if pool is None:
+            pool = ConnectionPool(timeout)
+        self.connection_pool = pool
         self.retry_delays = list(retry_delays) # We don't want this changing on us.
         self.retryable_errors = set(retryable_errors)
 
@@ -324,13 +359,18 @@ class Session(object):
                 else:
                     raise
 
-        resp = _try_request_with_retries(iter(self.retry_delays))
+        try:
+            resp = _try_request_with_retries(iter(self.retry_delays))
+        except:
+            self.connection_pool.discard(url, conn)
+            raise
         status = resp.status
 
         # Handle conditional response
         if status == 304 and method in ('GET', 'HEAD'):
             resp.read()
             self.connection_pool.release(url, conn)
+            self.cache_counters['revalidated'] += 1
             status, msg, data = cached_resp
             if data is not None:
                 data = StringIO(data)
@@ -363,8 +403,9 @@ class Session(object):
             resp.read()
             self.connection_pool.release(url, conn)
 
-        # Buffer small non-JSON response bodies
-        elif int(resp.getheader('content-length', sys.maxint)) < CHUNK_SIZE:
+        # Buffer small non-JSON response bodies, and those to be cached
+        elif int(resp.getheader('content-length', sys.maxint)) < CHUNK_SIZE \
+                or self._cacheable(method, resp):
             data = resp.read()
             self.connection_pool.release(url, conn)
 
@@ -372,20 +413,23 @@ class Session(object):
         # and instead return a minimal file-like object
         else:
             data = ResponseBody(resp,
-                                lambda: self.connection_pool.release(url, conn))
+                                lambda: self.connection_pool.release(url, conn),
+                                conn)
             streamed = True
 
         # Handle errors
         if status >= 400:
             ctype = resp.getheader('content-type')
             if data is not None and 'application/json' in ctype:
+                if streamed:
+                    data = data.read()
                 data = json.decode(data)
                 error = data.get('error'), data.get('reason')
-            elif method != 'HEAD':
-                error = resp.read()
-                self.connection_pool.release(url, conn)
+            elif streamed:
+                error = data.read()
             else:
-                error = ''
+                # the connection was released when the body was read
+                error = data or ''
             if status == 401:
                 raise Unauthorized(error)
             elif status == 404:
@@ -406,68 +450,262 @@ class Session(object):
 
         return status, resp.msg, data
 
+    def _cacheable(self, method, resp):
+        # only JSON documents and views are read ahead for the cache, so
+        # attachments keep streaming through a ResponseBody
+        accepts = getattr(self.cache, 'accepts', None)
+        length = resp.getheader('content-length')
+        ctype = resp.getheader('content-type') or ''
+        return method == 'GET' and 'etag' in resp.msg and length is not None \
+                and 'application/json' in ctype \
+                and accepts is not None and accepts(int(length))
+
+    def stats(self):
+        """Return counters of the session's connection and cache use."""
+        cache = {}
+        if hasattr(self.cache, 'stats'):
+            cache.update(self.cache.stats())
+        cache.update(self.cache_counters)
+        return {'connections': self.connection_pool.stats(), 'cache': cache}
 
-def cache_sort(i):
-    return datetime.fromtimestamp(time.mktime(parsedate(i[1][1]['Date'])))
 
 class Cache(object):
-    """Content cache."""
+    """Content cache.
+
+    Responses are kept in least recently used order within `max_bytes` of
+    body and headers.  A put that goes over the budget evicts the least
+    recently used responses, so each get, put and eviction takes constant
+    time.  With a `ttl`, responses stored more than that many seconds ago
+    are dropped rather than returned.  With a `directory`, bodies larger
+    than `disk_threshold` bytes are written to files there instead, within
+    `max_disk_bytes`.
+
+    `Session` also reads and caches larger JSON responses that the cache
+    `accepts()`.  Any object with `get`, `put` and `remove` methods can
+    be given to a `Session` instead.
+    """
 
-    # Some random values to limit memory use
-    keep_size, max_size = 10, 75
+    def __init__(self, max_bytes=4 * 1024 * 1024, ttl=None, directory=None,
+                 disk_threshold=64 * 1024, max_disk_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_threshold = disk_threshold
+        self.max_disk_bytes = max_disk_bytes
+        # least recently used first
+        self.by_url = OrderedDict() # url -> (response, size, stored)
+        self.on_disk = OrderedDict() # url -> (status, msg, path, size, stored)
+        self.size = self.disk_size = 0
+        self.lock = Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0,
+                         'stored': 0}
 
-    def __init__(self):
-        self.by_url = {}
+    def accepts(self, size):
+        """Return whether a body of `size` bytes would be kept."""
+        if self.directory is not None and size > self.disk_threshold:
+            return size <= self.max_disk_bytes
+        return size <= self.max_bytes
 
     def get(self, url):
-        return self.by_url.get(url)
+        self.lock.acquire()
+        try:
+            if url in self.by_url:
+                response, size, stored = entry = self.by_url.pop(url)
+                if not self._expired(stored):
+                    self.by_url[url] = entry
+                    self.counters['hits'] += 1
+                    return response
+                self.size -= size
+                self.counters['expired'] += 1
+            elif url in self.on_disk:
+                status, msg, path, size, stored = entry = self.on_disk.pop(url)
+                if not self._expired(stored):
+                    try:
+                        fileobj = open(path, 'rb')
+                        try:
+                            data = fileobj.read()
+                        finally:
+                            fileobj.close()
+                    except IOError:
+                        self.disk_size -= size
+                    else:
+                        self.on_disk[url] = entry
+                        self.counters['hits'] += 1
+                        return status, msg, data
+                else:
+                    self._unlink(path, size)
+                    self.counters['expired'] += 1
+            self.counters['misses'] += 1
+            return None
+        finally:
+            self.lock.release()
 
     def put(self, url, response):
-        self.by_url[url] = response
-        if len(self.by_url) > self.max_size:
-            self._clean()
+        status, msg, data = response
+        size = len(data or '')
+        if msg is not None:
+            size += len(str(msg))
+        self.remove(url)
+        if not self.accepts(size):
+            return
+        self.lock.acquire()
+        try:
+            self.counters['stored'] += 1
+            if self.directory is not None and size > self.disk_threshold:
+                path = os.path.join(self.directory, sha1(url).hexdigest())
+                fileobj = open(path, 'wb')
+                try:
+                    fileobj.write(data or '')
+                finally:
+                    fileobj.close()
+                self.on_disk[url] = status, msg, path, size, time.time()
+                self.disk_size += size
+                while self.disk_size > self.max_disk_bytes:
+                    entry = self.on_disk.popitem(last=False)[1]
+                    self._unlink(entry[2], entry[3])
+                    self.counters['evicted'] += 1
+            else:
+                self.by_url[url] = response, size, time.time()
+                self.size += size
+                while self.size > self.max_bytes:
+                    self.size -= self.by_url.popitem(last=False)[1][1]
+                    self.counters['evicted'] += 1
+        finally:
+            self.lock.release()
 
     def remove(self, url):
-        self.by_url.pop(url, None)
+        self.lock.acquire()
+        try:
+            if url in self.by_url:
+                self.size -= self.by_url.pop(url)[1]
+            if url in self.on_disk:
+                entry = self.on_disk.pop(url)
+                self._unlink(entry[2], entry[3])
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the counters and the number and size of cached responses."""
+        self.lock.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.by_url) + len(self.on_disk)
+            stats['bytes'] = self.size
+            stats['disk_bytes'] = self.disk_size
+            return stats
+        finally:
+            self.lock.release()
 
-    def _clean(self):
-        ls = sorted(self.by_url.iteritems(), key=cache_sort)
-        self.by_url = dict(ls[-self.keep_size:])
+    def _expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def _unlink(self, path, size):
+        self.disk_size -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 
 class ConnectionPool(object):
-    """HTTP connection pool."""
+    """HTTP connection pool.
+
+    At most `max_host_connections` connections are open to each
+    (scheme, host) and `max_connections` in all.  When a limit is reached
+    `get()` waits for a connection to be released, for at most
+    `acquire_timeout` seconds (forever if `None`) before raising
+    `PoolTimeout`.  Idle connections are closed after `idle_timeout`
+    seconds, and an idle connection the server has closed in the meantime
+    is replaced rather than reused.
+    """
 
-    def __init__(self, timeout):
+    def __init__(self, timeout, max_connections=100, max_host_connections=20,
+                 acquire_timeout=30, idle_timeout=60):
         self.timeout = timeout
-        self.conns = {} # HTTP connections keyed by (scheme, host)
-        self.lock = Lock()
+        self.max_connections = max_connections
+        self.max_host_connections = max_host_connections
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.conns = {} # idle (connection, release time) keyed by (scheme, host)
+        self.open = {} # number of connections in use or idle, by (scheme, host)
+        self.total = 0
+        self.lock = Condition(Lock())
+        self.counters = {
+            'created': 0, # new connections
+            'reused': 0, # idle connections handed out again
+            'evicted': 0, # idle connections closed after idle_timeout
+            'stale': 0, # idle connections found closed by the server
+            'discarded': 0, # connections closed after a failed request
+            'waits': 0, # get() calls that had to wait for a connection
+            'wait_time': 0.0, # seconds spent waiting
+            'timeouts': 0, # waits that ended in PoolTimeout
+        }
 
     def get(self, url):
 
         scheme, host = urlsplit(url, 'http', False)[:2]
+        key = scheme, host
+        if scheme == 'http':
+            cls = HTTPConnection
+        elif scheme == 'https':
+            cls = HTTPSConnection
+        else:
+            raise ValueError('%s is not a supported scheme' % scheme)
 
-        # Try to reuse an existing connection.
+        # Reuse an idle connection or reserve room for a new one.
         self.lock.acquire()
         try:
-            conns = self.conns.setdefault((scheme, host), [])
-            if conns:
-                conn = conns.pop(-1)
-            else:
-                conn = None
+            conn = None
+            started = None
+            while True:
+                self._evict(time.time())
+                conns = self.conns.get(key)
+                if conns:
+                    conn = conns.pop()[0]
+                    if self._alive(conn):
+                        self.counters['reused'] += 1
+                        break
+                    self.counters['stale'] += 1
+                    self._close(key, conn)
+                    conn = None
+                    continue
+                if self.open.get(key, 0) < self.max_host_connections:
+                    if self.total < self.max_connections:
+                        self.open[key] = self.open.get(key, 0) + 1
+                        self.total += 1
+                        break
+                    # make room by closing an idle connection to another host
+                    if self._close_idle():
+                        continue
+                now = time.time()
+                if started is None:
+                    started = now
+                    self.counters['waits'] += 1
+                remaining = None
+                if self.acquire_timeout is not None:
+                    remaining = started + self.acquire_timeout - now
+                    if remaining <= 0:
+                        self.counters['timeouts'] += 1
+                        self.counters['wait_time'] += now - started
+                        raise PoolTimeout('No connection to %s within %s seconds'
+                                          % (host, self.acquire_timeout))
+                self.lock.wait(remaining)
+            if started is not None:
+                self.counters['wait_time'] += time.time() - started
         finally:
             self.lock.release()
 
         # Create a new connection if nothing was available.
         if conn is None:
-            if scheme == 'http':
-                cls = HTTPConnection
-            elif scheme == 'https':
-                cls = HTTPSConnection
-            else:
-                raise ValueError('%s is not a supported scheme' % scheme)
             conn = cls(host, timeout=self.timeout)
-            conn.connect()
+            try:
+                conn.connect()
+            except:
+                self.discard(url, conn)
+                raise
+            self.lock.acquire()
+            self.counters['created'] += 1
+            self.lock.release()
 
         return conn
 
@@ -475,13 +713,82 @@ class ConnectionPool(object):
         scheme, host = urlsplit(url, 'http', False)[:2]
         self.lock.acquire()
         try:
-            self.conns.setdefault((scheme, host), []).append(conn)
+            self.conns.setdefault((scheme, host), []).append((conn, time.time()))
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def discard(self, url, conn):
+        """Close a connection that is not going to be released."""
+        scheme, host = urlsplit(url, 'http', False)[:2]
+        self.lock.acquire()
+        try:
+            self.counters['discarded'] += 1
+            self._close((scheme, host), conn)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the counters and the number of open and idle connections."""
+        self.lock.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['open'] = self.total
+            stats['idle'] = sum([len(conns) for conns in self.conns.values()])
+            return stats
         finally:
             self.lock.release()
 
+    def close(self):
+        """Close the idle connections."""
+        self.lock.acquire()
+        try:
+            for key, conns in list(self.conns.items()):
+                while conns:
+                    self._close(key, conns.pop()[0])
+        finally:
+            self.lock.release()
+
+    def _alive(self, conn):
+        # An idle connection has nothing to read unless the server closed it.
+        if conn.sock is None:
+            return True # reconnects on use
+        try:
+            return not select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def _close(self, key, conn):
+        # Called with the lock held.
+        conn.close()
+        self.open[key] -= 1
+        self.total -= 1
+        self.lock.notify_all()
+
+    def _close_idle(self):
+        # Close the longest idle connection, if any.
+        oldest = None
+        for key, conns in self.conns.items():
+            if conns and (oldest is None or conns[0][1] < oldest[1]):
+                oldest = key, conns[0][1]
+        if oldest is None:
+            return False
+        self._close(oldest[0], self.conns[oldest[0]].pop(0)[0])
+        self.counters['evicted'] += 1
+        return True
+
+    def _evict(self, now):
+        # Idle lists are in release order, so expired connections come first.
+        if self.idle_timeout is None:
+            return
+        for key, conns in self.conns.items():
+            while conns and now - conns[0][1] > self.idle_timeout:
+                self._close(key, conns.pop(0)[0])
+                self.counters['evicted'] += 1
+
     def __del__(self):
         for key, conns in list(self.conns.items()):
-            for conn in conns:
+            for conn, released in conns:
                 conn.close()
 
 
@@ -6,11 +6,13 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import BaseHTTPServer
 from datetime import datetime
 import doctest
 import os
 import os.path
 import shutil
+import SocketServer
 from StringIO import StringIO
 import time
 import tempfile
@@ -18,7 +20,7 @@ import threading
 import unittest
 import urlparse
 
-from couchdb import client, http
+from couchdb import client, http, json
 from couchdb.tests import testutil
 
 
@@ -793,6 +795,292 @@ class ViewIterationTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         self.assertEqual(len(list(self.db.iterview('test/nulls', 10))), self.num_docs)
 
 
+class RowStreamTestCase(unittest.TestCase):
+
+    def response(self, count, tail='}'):
+        rows = ['{"id":"%d","key":["%d","]},"],"value":{"n":%d}}' % (i, i, i)
+                for i in range(count)]
+        return ('{"total_rows":%d,"offset":0,"rows":[\r\n' % count +
+                ',\r\n'.join(rows) + '\r\n]' + tail + '\n')
+
+    def test_chunk_boundaries(self):
+        body = self.response(20, tail=',\r\n"update_seq":7}')
+        for chunk_size in (1, 2, 5, 17, 64, 4096):
+            rows = client.RowStream(StringIO(body), chunk_size=chunk_size)
+            self.assertEqual([row.value['n'] for row in rows], range(20))
+            self.assertEqual(rows.fields, {'total_rows': 20, 'offset': 0,
+                                           'update_seq': 7})
+
+    def test_fields_before_first_row(self):
+        rows = client.RowStream(StringIO(self.response(3)), chunk_size=10)
+        self.assertEqual(rows.total_rows, None)
+        row = rows.next()
+        self.assertEqual((row.id, row.key), ('0', ['0', ']},']))
+        self.assertEqual((rows.total_rows, rows.offset), (3, 0))
+
+    def test_reduce(self):
+        rows = client.RowStream(StringIO('{"rows":[\n{"key":null,"value":9}\n]}'))
+        self.assertEqual([row.value for row in rows], [9])
+        self.assertEqual(rows.total_rows, None)
+
+    def test_close_early(self):
+        class Body(StringIO):
+            aborted = False
+            def abort(self):
+                self.aborted = True
+        body = Body(self.response(10000))
+        rows = client.RowStream(body, chunk_size=1024)
+        self.assertEqual(rows.next().id, '0')
+        rows.close()
+        self.assertTrue(body.aborted)
+        self.assertEqual(body.tell(), 1024)
+        self.assertRaises(StopIteration, rows.next)
+
+    def test_dropped_early(self):
+        class Body(StringIO):
+            aborted = False
+            def abort(self):
+                self.aborted = True
+        body = Body(self.response(10000))
+        rows = client.RowStream(body, chunk_size=1024)
+        self.assertEqual(rows.next().id, '0')
+        del rows
+        self.assertTrue(body.aborted)
+
+    def test_truncated(self):
+        body = self.response(5)[:-20]
+        rows = client.RowStream(StringIO(body), chunk_size=16)
+        self.assertRaises(ValueError, list, rows)
+
+    def test_json_use(self):
+        decoded = []
+        def decode(string, decode=json.decode):
+            decoded.append(string)
+            return decode(string)
+        self.addCleanup(setattr, json, 'decode', json.decode)
+        json.decode = decode
+        body = '{"rows":[{"id":"a","value":"]} \\" {["},{"id":"b","value":[{}]}]}'
+        for chunk_size in (1, 3, 4096):
+            rows = client.RowStream(StringIO(body), chunk_size=chunk_size)
+            self.assertEqual([row.value for row in rows], [u']} " {[', [{}]])
+        self.assertTrue('{"id":"b","value":[{}]}' in decoded)
+
+
+class LocalDatabaseMixin(object):
+    """Serve an in-memory database at `self.db`, answering ``_all_docs`` key
+    lookups and ``_bulk_docs`` updates after a short latency.  `self.docs`
+    maps ids to documents, or to `None` for deleted ones."""
+
+    latency = 0.05
+
+    def setUp(self):
+        docs = self.docs = {}
+        requests = self.requests = []
+        active = self.active = [0, 0] # current, maximum
+        lock = threading.Lock()
+        latency = self.latency
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_POST(self):
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                body = json.decode(self.rfile.read(
+                    int(self.headers['Content-Length'])))
+                requests.append((self.path, body))
+                time.sleep(latency)
+                with lock:
+                    if '_bulk_docs' in self.path and \
+                            body.get('new_edits') is False:
+                        for doc in body['docs']:
+                            docs[doc['_id']] = doc
+                        rows = []
+                    elif '_bulk_docs' in self.path:
+                        rows = [self.save(doc) for doc in body['docs']]
+                    else:
+                        rows = [self.lookup(key) for key in body['keys']]
+                        rows = {'total_rows': len(docs), 'rows': rows}
+                    active[0] -= 1
+                data = json.encode(rows)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def lookup(self, key):
+                if key not in docs:
+                    return {'key': key, 'error': 'not_found'}
+                elif docs[key] is None:
+                    return {'id': key, 'key': key, 'doc': None,
+                            'value': {'rev': '2-b', 'deleted': True}}
+                return {'id': key, 'key': key, 'doc': docs[key],
+                        'value': {'rev': docs[key]['_rev']}}
+            def save(self, doc):
+                id = doc.get('_id') or 'new-%d' % len(docs)
+                current = docs.get(id)
+                if current and current['_rev'] != doc.get('_rev'):
+                    return {'id': id, 'error': 'conflict',
+                            'reason': 'Document update conflict.'}
+                rev = '%d-a' % (int((current or {'_rev': '0'})['_rev'][0]) + 1)
+                docs[id] = dict(doc, _id=id, _rev=rev)
+                return {'id': id, 'rev': rev}
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.db = client.Database('http://127.0.0.1:%d/chronicle' %
+                                  self.server.server_address[1])
+
+    def tearDown(self):
+        self.db.resource.session.connection_pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class GetManyTestCase(LocalDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        LocalDatabaseMixin.setUp(self)
+        for id in ['a', 'b'] + ['doc-%d' % i for i in range(40)]:
+            self.docs[id] = {'_id': id, '_rev': '1-a'}
+        self.docs['deleted'] = None
+
+    def test_order_and_missing(self):
+        ids = ['b', 'missing-1', 'a', 'deleted', 'b']
+        docs = list(self.db.get_many(ids, default=False))
+        self.assertEqual([doc and doc.id for doc in docs],
+                         ['b', False, 'a', False, 'b'])
+        self.assertTrue(isinstance(docs[0], client.Document))
+        path, body = self.requests[0]
+        self.assertEqual(path, '/chronicle/_all_docs?include_docs=true')
+        self.assertEqual(body['keys'], ids)
+
+    def test_chunks(self):
+        ids = ['doc-%d' % i for i in range(25)]
+        docs = self.db.get_many(iter(ids), chunk_size=10)
+        self.assertEqual(docs.next().id, 'doc-0')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual([doc.id for doc in docs], ids[1:])
+        self.assertEqual([len(body['keys']) for path, body in self.requests],
+                         [10, 10, 5])
+        self.assertEqual(list(self.db.get_many([])), [])
+        self.assertRaises(ValueError, self.db.get_many, ids, chunk_size=0)
+
+    def test_workers(self):
+        ids = ['doc-%d' % i for i in range(40)] + ['missing']
+        start = time.time()
+        docs = list(self.db.get_many(ids, chunk_size=5, workers=9))
+        elapsed = time.time() - start
+        self.assertEqual([doc and doc.id for doc in docs], ids[:-1] + [None])
+        self.assertEqual(len(self.requests), 9)
+        self.assertTrue(self.active[1] > 1)
+        self.assertTrue(elapsed < 9 * self.latency, elapsed)
+
+    def test_worker_error(self):
+        self.server.RequestHandlerClass.do_POST = lambda handler: \
+            handler.send_error(500)
+        docs = self.db.get_many(['a', 'b', 'c'], chunk_size=1, workers=2)
+        self.assertRaises(http.ServerError, list, docs)
+
+
+class UpdateManyTestCase(LocalDatabaseMixin, unittest.TestCase):
+
+    latency = 0.02
+
+    def test_batch_size(self):
+        docs = [{'_id': 'doc-%d' % i} for i in range(25)]
+        results = self.db.update_many(iter(docs), batch_size=10)
+        self.assertEqual(results.next(), (True, 'doc-0', '1-a'))
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual([id for success, id, rev in results],
+                         ['doc-%d' % i for i in range(1, 25)])
+        self.assertEqual([len(body['docs']) for path, body in self.requests],
+                         [10, 10, 5])
+        self.assertEqual(docs[24]['_rev'], '1-a')
+        self.assertEqual(list(self.db.update_many([])), [])
+        self.assertRaises(ValueError, self.db.update_many, docs, batch_size=0)
+
+    def test_batch_bytes(self):
+        docs = [client.Document(_id='doc-%d' % i, data='x' * 100)
+                for i in range(7)]
+        docs.insert(3, {'_id': 'large', 'data': 'x' * 1000})
+        size = len(json.encode(docs[0])) + 1
+        results = list(self.db.update_many(docs, batch_bytes=3 * size))
+        self.assertTrue(all(success for success, id, rev in results))
+        self.assertEqual([[doc['_id'] for doc in body['docs']]
+                          for path, body in self.requests],
+                         [['doc-0', 'doc-1', 'doc-2'], ['large'],
+                          ['doc-3', 'doc-4', 'doc-5'], ['doc-6']])
+
+    def test_options(self):
+        list(self.db.update_many([{'_id': 'a'}], all_or_nothing=True))
+        self.assertEqual(self.requests[0][1],
+                         {'docs': [{'_id': 'a'}], 'all_or_nothing': True})
+
+    def test_conflicts(self):
+        self.docs['a'] = {'_id': 'a', '_rev': '1-a', 'tags': ['x']}
+        self.docs['b'] = {'_id': 'b', '_rev': '1-a'}
+        results = list(self.db.update_many([{'_id': 'a'}, {'_id': 'c'}]))
+        self.assertEqual(results[0][:2], (False, 'a'))
+        self.assertTrue(isinstance(results[0][2], http.ResourceConflict))
+        self.assertEqual(results[1], (True, 'c', '1-a'))
+
+        def merge(doc, current):
+            if doc['_id'] == 'b':
+                return None
+            doc = dict(doc, _rev=current['_rev'])
+            doc['tags'] = current['tags'] + doc['tags']
+            return doc
+        docs = [{'_id': 'a', 'tags': ['y']}, {'_id': 'b'}, {'_id': 'd'}]
+        results = list(self.db.update_many(docs, resolve=merge))
+        self.assertEqual([result[:2] for result in results],
+                         [(True, 'a'), (False, 'b'), (True, 'd')])
+        self.assertEqual(self.docs['a']['tags'], ['x', 'y'])
+        self.assertEqual(results[0][2], '2-a')
+
+    def test_retries(self):
+        self.docs['a'] = {'_id': 'a', '_rev': '1-a'}
+        stale = lambda doc, current: dict(doc, _rev='0-z')
+        results = list(self.db.update_many([{'_id': 'a'}], resolve=stale,
+                                           retries=2))
+        self.assertEqual(results[0][:2], (False, 'a'))
+        self.assertEqual([path.split('/')[2].split('?')[0]
+                          for path, body in self.requests],
+                         ['_bulk_docs', '_all_docs'] * 2 + ['_bulk_docs'])
+
+    def test_new_edits(self):
+        docs = [{'_id': 'doc-%d' % i, '_rev': '3-c'} for i in range(3)]
+        results = list(self.db.update_many(docs, new_edits=False))
+        self.assertEqual(results, [(True, 'doc-%d' % i, '3-c')
+                                   for i in range(3)])
+        self.assertEqual(self.docs['doc-2']['_rev'], '3-c')
+
+    def test_short_response(self):
+        post_json = self.db.resource.post_json
+        def drop_last(*args, **kwargs):
+            status, headers, data = post_json(*args, **kwargs)
+            return status, headers, data[:-1]
+        self.db.resource.post_json = drop_last
+        results = list(self.db.update_many([{'_id': 'a'}, {'_id': 'b'}]))
+        self.assertEqual(results[0], (True, 'a', '1-a'))
+        self.assertEqual(results[1][:2], (False, 'b'))
+        self.assertTrue(isinstance(results[1][2], http.ServerError))
+
+    def test_workers(self):
+        docs = ({'_id': 'doc-%d' % i} for i in range(40))
+        start = time.time()
+        results = list(self.db.update_many(docs, batch_size=5, workers=8))
+        elapsed = time.time() - start
+        self.assertEqual([id for success, id, rev in results],
+                         ['doc-%d' % i for i in range(40)])
+        self.assertTrue(self.active[1] > 1)
+        self.assertTrue(elapsed < 8 * self.latency, elapsed)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ServerTestCase, 'test'))
@@ -801,6 +1089,9 @@ def suite():
     suite.addTest(unittest.makeSuite(ShowListTestCase, 'test'))
     suite.addTest(unittest.makeSuite(UpdateHandlerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ViewIterationTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(RowStreamTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(GetManyTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(UpdateManyTestCase, 'test'))
     suite.addTest(doctest.DocTestSuite(client))
     return suite
 
@@ -6,8 +6,14 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import BaseHTTPServer
 import doctest
+import os
+import shutil
 import socket
+import SocketServer
+import tempfile
+import threading
 import time
 import unittest
 from StringIO import StringIO
@@ -66,6 +72,31 @@ class ResponseBodyTestCase(unittest.TestCase):
         self.assertEqual(list(response.iterchunks()), ['foobarbaz'])
         self.assertEqual(list(response.iterchunks()), [])
 
+    def test_abort(self):
+        class TestStream(StringIO):
+            finished = False
+
+            def isclosed(self):
+                return self.finished
+
+            def close(self):
+                self.finished = True
+
+        class TestConnection(object):
+            closed = False
+            def close(self):
+                self.closed = True
+
+        released = []
+        stream = TestStream('foobar' * 1000)
+        conn = TestConnection()
+        response = http.ResponseBody(stream, lambda: released.append(1), conn)
+        response.read(6)
+        response.abort() # the rest is not drained, the connection is closed
+        self.assertTrue(conn.closed)
+        self.assertEqual(stream.tell(), 6)
+        self.assertEqual(released, [1])
+
 
 class CacheTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
 
@@ -78,12 +109,254 @@ class CacheTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         cache.remove(url)
 
 
+class LocalServerMixin(object):
+    """Serve {"ok":true} at / and, at /sized/<n>, n bytes with an ETag
+    honoring If-None-Match.  /binary/<n> serves the same bytes as an
+    attachment would."""
+
+    def setUp(self):
+        requests = self.requests = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                requests.append(self.path)
+                ctype = 'application/json'
+                if self.path.startswith('/binary/'):
+                    ctype = 'application/octet-stream'
+                if self.path.startswith(('/sized/', '/binary/')):
+                    body = 'x' * int(self.path.split('/')[2])
+                    etag = '"%s"' % self.path
+                    if self.headers.get('If-None-Match') == etag:
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header('ETag', etag)
+                else:
+                    body = '{"ok":true}'
+                    self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def handle(self):
+                try:
+                    BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+                except socket.error:
+                    pass # the client aborted a response
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ConnectionPoolTestCase(LocalServerMixin, unittest.TestCase):
+
+    def test_reuse(self):
+        session = http.Session()
+        for i in range(3):
+            status, headers, body = session.request('GET', self.url)
+            self.assertEqual(body.read(), '{"ok":true}')
+        stats = session.stats()['connections']
+        self.assertEqual((stats['created'], stats['reused']), (1, 2))
+        self.assertEqual((stats['open'], stats['idle']), (1, 1))
+
+    def test_host_limit(self):
+        pool = http.ConnectionPool(None, max_host_connections=2,
+                                   acquire_timeout=0.1)
+        conns = [pool.get(self.url), pool.get(self.url)]
+        start = time.time()
+        self.assertRaises(http.PoolTimeout, pool.get, self.url)
+        self.assertTrue(time.time() - start >= 0.1)
+        # a waiting get() takes the connection released meanwhile
+        pool.acquire_timeout = 5
+        timer = threading.Timer(0.1, pool.release, (self.url, conns[0]))
+        timer.start()
+        self.assertTrue(pool.get(self.url) is conns[0])
+        stats = pool.stats()
+        self.assertEqual((stats['waits'], stats['timeouts']), (2, 1))
+        self.assertEqual((stats['created'], stats['reused'], stats['open']),
+                         (2, 1, 2))
+        self.assertTrue(stats['wait_time'] >= 0.2)
+
+    def test_total_limit(self):
+        other = self.url.replace('127.0.0.1', 'localhost')
+        pool = http.ConnectionPool(None, max_connections=1, acquire_timeout=0)
+        pool.release(self.url, pool.get(self.url))
+        # the idle connection to the other host makes room
+        conn = pool.get(other)
+        self.assertEqual(pool.stats()['evicted'], 1)
+        self.assertRaises(http.PoolTimeout, pool.get, self.url)
+        pool.discard(other, conn)
+        pool.get(self.url)
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_idle_timeout(self):
+        pool = http.ConnectionPool(None, idle_timeout=0.05)
+        conn = pool.get(self.url)
+        pool.release(self.url, conn)
+        time.sleep(0.1)
+        self.assertFalse(pool.get(self.url) is conn)
+        stats = pool.stats()
+        self.assertEqual((stats['created'], stats['evicted']), (2, 1))
+        self.assertEqual(conn.sock, None)
+
+    def test_stale(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        url = 'http://127.0.0.1:%d/' % listener.getsockname()[1]
+        pool = http.ConnectionPool(None)
+        conn = pool.get(url)
+        accepted, address = listener.accept()
+        pool.release(url, conn)
+        accepted.close() # the server gives up on the idle connection
+        time.sleep(0.05)
+        self.assertFalse(pool.get(url) is conn)
+        self.assertEqual(pool.stats()['stale'], 1)
+        listener.close()
+
+    def test_failed_request_frees_connection(self):
+        pool = http.ConnectionPool(None, max_host_connections=1,
+                                   acquire_timeout=0)
+        session = http.Session(pool=pool, retry_delays=[])
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d/' % listener.getsockname()[1]
+        listener.close()
+        for i in range(2):
+            self.assertRaises(socket.error, session.request, 'GET', url)
+        stats = session.stats()['connections']
+        self.assertEqual((stats['open'], stats['timeouts']), (0, 0))
+
+    def test_dropped_body_frees_connection(self):
+        pool = http.ConnectionPool(None, max_host_connections=2,
+                                   acquire_timeout=1)
+        session = http.Session(cache=http.Cache(max_bytes=10 * 1024),
+                               pool=pool)
+        for i in range(5):
+            status, headers, body = session.request('GET',
+                                                    self.url + 'sized/20000')
+            self.assertTrue(isinstance(body, http.ResponseBody))
+            self.assertEqual(len(body.read(100)), 100)
+            del body # read part way and dropped
+        stats = session.stats()['connections']
+        self.assertEqual((stats['timeouts'], stats['discarded']), (0, 0))
+        self.assertEqual((stats['open'], stats['idle']), (1, 1))
+
+
+class CacheBudgetTestCase(unittest.TestCase):
+
+    def response(self, size):
+        return 200, None, 'x' * size
+
+    def test_lru(self):
+        cache = http.Cache(max_bytes=300)
+        for url in 'abc':
+            cache.put(url, self.response(100))
+        cache.get('a') # now b is the least recently used
+        cache.put('d', self.response(100))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual([url for url in 'acd' if cache.get(url)], ['a', 'c', 'd'])
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['evicted']),
+                         (3, 300, 1))
+        self.assertEqual((stats['hits'], stats['misses']), (4, 1))
+
+    def test_replace_and_oversize(self):
+        cache = http.Cache(max_bytes=300)
+        cache.put('a', self.response(100))
+        cache.put('a', self.response(200))
+        self.assertEqual(cache.stats()['bytes'], 200)
+        cache.put('b', self.response(301)) # never fits
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), self.response(200))
+
+    def test_ttl(self):
+        cache = http.Cache(ttl=0.05)
+        cache.put('a', self.response(10))
+        self.assertEqual(cache.get('a'), self.response(10))
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual((cache.stats()['expired'], cache.stats()['bytes']), (1, 0))
+
+    def test_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = http.Cache(max_bytes=1000, directory=directory,
+                               disk_threshold=100, max_disk_bytes=1000)
+            self.assertTrue(cache.accepts(1000))
+            self.assertFalse(cache.accepts(1001))
+            cache.put('small', self.response(50))
+            for url in 'ab':
+                cache.put(url, self.response(500))
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertEqual(cache.get('a'), self.response(500))
+            cache.put('c', self.response(500)) # evicts b from disk
+            self.assertEqual(cache.get('b'), None)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertEqual(cache.stats()['disk_bytes'], 1000)
+            self.assertEqual(cache.stats()['bytes'], 50)
+            cache.remove('a')
+            cache.remove('c')
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+class SessionCacheTestCase(LocalServerMixin, unittest.TestCase):
+
+    def test_revalidation(self):
+        session = http.Session(cache=http.Cache(max_bytes=100 * 1024))
+        url = self.url + 'sized/20000' # larger than a buffered response
+        for i in range(3):
+            status, headers, body = session.request('GET', url)
+            self.assertEqual(len(body.read()), 20000)
+        stats = session.stats()['cache']
+        self.assertEqual((stats['stored'], stats['hits'], stats['revalidated']),
+                         (1, 2, 2))
+        self.assertEqual(len(self.requests), 3)
+
+    def test_streamed_when_too_large(self):
+        session = http.Session(cache=http.Cache(max_bytes=10 * 1024))
+        status, headers, body = session.request('GET', self.url + 'sized/20000')
+        self.assertTrue(isinstance(body, http.ResponseBody))
+        body.read()
+        self.assertEqual(session.stats()['cache']['entries'], 0)
+
+    def test_attachment_streamed(self):
+        session = http.Session(cache=http.Cache(max_bytes=100 * 1024))
+        status, headers, body = session.request('GET', self.url + 'binary/20000')
+        self.assertTrue(isinstance(body, http.ResponseBody))
+        self.assertEqual(len(body.read()), 20000)
+        self.assertEqual(session.stats()['cache']['entries'], 0)
+
+    def test_dict(self):
+        session = http.Session(cache={})
+        session.request('GET', self.url + 'sized/10')[2].read()
+        self.assertEqual(session.stats()['cache']['entries'], 1)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(doctest.DocTestSuite(http))
     suite.addTest(unittest.makeSuite(SessionTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ResponseBodyTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase, 'test'))
     suite.addTest(unittest.makeSuite(CacheTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CacheBudgetTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SessionCacheTestCase, 'test'))
     return suite
 
 
@@ -28,11 +28,16 @@ def dump_db(dburl, username=None, password=None, boundary=None,
         db.resource.credentials = username, password
 
     envelope = write_multipart(output, boundary=boundary)
-    for docid in db:
+    for doc in db.get_many(db, attachments=True):
+        if doc is None: # deleted since it was listed
+            continue
 
-        doc = db.get(docid, attachments=True)
         print >> sys.stderr, 'Dumping document %r' % doc.id
         attachments = doc.pop('_attachments', {})
+        if any(info.get('stub') for info in attachments.values()):
+            # servers without inline attachments in _all_docs
+            doc = db.get(doc.id, attachments=True)
+            attachments = doc.pop('_attachments', {})
         jsondoc = json.encode(doc)
 
         if attachments: